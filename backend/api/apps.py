@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        if settings.MEDICINE_ENGINE_WARMUP:
+            from .medicine_engine import get_engine
+            get_engine().warm_up_in_background()
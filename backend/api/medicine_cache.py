@@ -0,0 +1,125 @@
+"""
+Content-addressed cache of identify-medicine results.
+
+Results are keyed by a hash of the uploaded image bytes plus the catalog version,
+so replaying the same image skips the vision model and the catalog entirely, and
+a catalog update never serves results matched against the old catalog.
+
+The cache has an in-memory tier and an optional on-disk tier, both Django cache
+backends configured in settings (see MEDICINE_CACHE_* and CACHES).
+"""
+
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Only deterministic outcomes are cached; errors are always retried
+CACHEABLE_STATUSES = ('success', 'low_confidence')
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_SOS = 0xDA
+JPEG_COM = 0xFE
+
+
+def iter_normalized_image_bytes(data):
+    """
+    Yield the parts of `data` (bytes or a zero-copy buffer) that define the image.
+
+    For JPEGs the APP1-APP15 and comment segments are skipped: phones and editors
+    rewrite EXIF (timestamps, thumbnails) on re-save without touching the pixels.
+    Anything that doesn't parse as a JPEG is used as is.
+    """
+    if bytes(data[:2]) != JPEG_SOI:
+        yield data
+        return
+
+    parts = [data[:2]]
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker == JPEG_SOS:
+            parts.append(data[i:])
+            yield from parts
+            return
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        if not (0xE1 <= marker <= 0xEF or marker == JPEG_COM):
+            parts.append(data[i:i + 2 + length])
+        i += 2 + length
+    # Malformed header: fall back to the raw bytes
+    yield data
+
+
+def image_digest(data):
+    digest = hashlib.sha256()
+    for part in iter_normalized_image_bytes(data):
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class MedicineResultCache:
+    """Tiered lookup over Django caches (memory first, then disk) with hit/miss counters."""
+
+    def __init__(self, aliases, timeout):
+        self.aliases = aliases
+        self.timeout = timeout
+        self.hits = {alias: 0 for alias in aliases}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, digest, catalog_version):
+        """Cache key of an image, from its image_digest()."""
+        return f'identify:{catalog_version}:{digest}'
+
+    def get(self, key):
+        for depth, alias in enumerate(self.aliases):
+            value = caches[alias].get(key)
+            if value is not None:
+                # Promote disk hits into the faster tiers
+                for faster_alias in self.aliases[:depth]:
+                    caches[faster_alias].set(key, value, self.timeout)
+                with self._lock:
+                    self.hits[alias] += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, result):
+        if result.get('status') not in CACHEABLE_STATUSES:
+            return
+        for alias in self.aliases:
+            caches[alias].set(key, result, self.timeout)
+
+    def stats(self):
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            'tiers': self.aliases,
+            'hits': dict(self.hits),
+            'misses': self.misses,
+            'hit_rate': round(hits / lookups, 3) if lookups else None,
+        }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Return the per-process result cache, or None when MEDICINE_CACHE_ENABLED is off."""
+    global _result_cache
+    if not settings.MEDICINE_CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                aliases = ['medicine_results']
+                if 'medicine_results_disk' in settings.CACHES:
+                    aliases.append('medicine_results_disk')
+                _result_cache = MedicineResultCache(aliases, settings.MEDICINE_CACHE_TTL)
+    return _result_cache
@@ -0,0 +1,260 @@
+"""
+Resident medicine analysis engine.
+
+Loads the Gemini model and the medicine catalog once per worker process and
+runs `ml/analyze_medicine.py` in-process, instead of starting a new Python
+interpreter for every uploaded image.
+
+Under gunicorn (see backend/gunicorn.conf.py) the catalog is loaded once in the
+master before it forks, so workers share its pages copy-on-write; each worker
+then only loads the vision extractor. The catalog endpoints (search, substitutes,
+autocomplete) only need the catalog, and keep working when the extractor fails.
+
+Once ready, a background thread checks the catalog file every
+MEDICINE_CATALOG_RELOAD_INTERVAL seconds and hot-swaps a new version in
+without a restart (see MedicineAnalyzer.reload_catalog). The first worker to see
+the change rebuilds the shared snapshot under a file lock; the others wait for it
+and map the new files instead of each compiling the CSV.
+"""
+
+import logging
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+
+# The ml folder sits next to the backend folder
+ML_DIR = settings.BASE_DIR.parent / 'ml'
+if str(ML_DIR) not in sys.path:
+    sys.path.insert(0, str(ML_DIR))
+
+from analyze_medicine import MedicineAnalyzer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+class MedicineEngine:
+    """Long-lived wrapper around MedicineAnalyzer with warm-up and readiness state."""
+
+    COLD = 'cold'
+    WARMING = 'warming'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self.analyzer = MedicineAnalyzer()
+        self.state = self.COLD
+        self.error = None
+        self.ready_at = None
+        self.warmup_seconds = None
+        self.analyses = 0
+        # Recent per-stage durations (ms): decode, resize, encode, extraction, ...
+        self.stage_timings = defaultdict(lambda: deque(maxlen=500))
+        self.catalog_reloads = {
+            'checks': 0,
+            'reloads': 0,
+            'failures': 0,
+            'last_reason': None,
+            'last_reload_at': None,
+            'last_reload_seconds': None,
+            'last_error': None,
+        }
+        self._lock = threading.Lock()
+        self._catalog_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._catalog_watcher = None
+
+    @property
+    def is_ready(self):
+        return self.state == self.READY
+
+    def warm_up(self):
+        """Load the catalog and the vision extractor. Safe to call concurrently; only one load runs."""
+        if self.state == self.READY:
+            return True
+        with self._lock:
+            if self.state == self.READY:
+                return True
+            self.state = self.WARMING
+            start_time = time.time()
+            try:
+                self.load_catalog()
+                self.analyzer.load_extractor()
+            except Exception as e:
+                self.state = self.FAILED
+                self.error = str(e)
+                logger.error(f"Medicine engine warm-up failed: {self.error}")
+                return False
+            self.warmup_seconds = round(time.time() - start_time, 3)
+            self.ready_at = time.time()
+            self.state = self.READY
+            self.error = None
+            logger.info(f"Medicine engine ready in {self.warmup_seconds}s")
+        self.start_catalog_watcher(settings.MEDICINE_CATALOG_RELOAD_INTERVAL)
+        return True
+
+    def load_catalog(self):
+        """Load the catalog and its matchers unless loaded, raising RuntimeError on failure. Safe to call concurrently."""
+        if self.analyzer.catalog is not None:
+            return
+        with self._catalog_lock:
+            self.analyzer.load_catalog_state()
+
+    def preload_catalog(self):
+        """Load the catalog and its matchers without the vision extractor, e.g. in a server master before fork."""
+        start_time = time.time()
+        try:
+            self.load_catalog()
+        except RuntimeError as e:
+            # Each worker retries on warm-up and reports the error from there
+            logger.error(f"Medicine catalog preload failed: {e}")
+            return False
+        logger.info(f"Medicine catalog preloaded in {round(time.time() - start_time, 3)}s")
+        return True
+
+    def after_fork(self):
+        """Reset state that must not be inherited from the parent process: locks and threads."""
+        self._lock = threading.Lock()
+        self._catalog_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._catalog_watcher = None
+
+    def reload_catalog_if_changed(self):
+        """
+        Reload the catalog when the file on disk changed. The new catalog and matchers are
+        built in the calling thread while requests keep using the old ones, then swapped in.
+        Returns True when a new version went live.
+        """
+        if self.analyzer.catalog is None:
+            return False
+        with self._reload_lock:
+            self.catalog_reloads['checks'] += 1
+            changed, reason = self.analyzer.catalog_changed()
+            if not changed:
+                return False
+            old_version = self.catalog_version
+            start_time = time.time()
+            try:
+                version = self.analyzer.reload_catalog()
+            except Exception as e:
+                self.catalog_reloads['failures'] += 1
+                self.catalog_reloads['last_error'] = str(e)
+                logger.error(f"Medicine catalog reload failed, keeping {old_version}: {e}")
+                return False
+            self.catalog_reloads.update({
+                'reloads': self.catalog_reloads['reloads'] + 1,
+                'last_reason': reason,
+                'last_reload_at': time.time(),
+                'last_reload_seconds': round(time.time() - start_time, 3),
+                'last_error': None,
+            })
+            logger.info(f"Medicine catalog reloaded ({reason}): {old_version} -> {version}")
+            return True
+
+    def start_catalog_watcher(self, interval):
+        """Check the catalog file every `interval` seconds in a daemon thread; 0 disables."""
+        if interval <= 0 or self._catalog_watcher is not None:
+            return
+        with self._catalog_lock:
+            if self._catalog_watcher is not None:
+                return
+
+            def watch():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.reload_catalog_if_changed()
+                    except Exception:
+                        logger.exception("Medicine catalog check failed")
+
+            self._catalog_watcher = threading.Thread(target=watch, name='medicine-catalog-watcher', daemon=True)
+            self._catalog_watcher.start()
+
+    def warm_up_in_background(self):
+        thread = threading.Thread(target=self.warm_up, name='medicine-engine-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def analyze(self, image):
+        """Identify the medicine in `image` (a path or file-like object) and return the result dict."""
+        if not self.is_ready and not self.warm_up():
+            return {'status': 'error', 'message': self.error}
+        self.analyses += 1
+        timings = {}
+        result = self.analyzer.analyze(image, timings=timings)
+        self.record_timings([timings])
+        return result
+
+    @property
+    def catalog(self):
+        """The loaded medicine catalog, loading it first if needed (None if that fails). Needs no vision extractor."""
+        try:
+            self.load_catalog()
+        except RuntimeError as e:
+            self.error = str(e)
+            return None
+        self.start_catalog_watcher(settings.MEDICINE_CATALOG_RELOAD_INTERVAL)
+        return self.analyzer.catalog
+
+    @property
+    def catalog_version(self):
+        catalog = self.analyzer.catalog
+        return catalog.version if catalog else None
+
+    def analyze_many(self, images, max_workers):
+        """Identify several images with bounded-concurrency vision calls and one batched catalog match."""
+        if not self.is_ready and not self.warm_up():
+            return [{'status': 'error', 'message': self.error} for _ in images]
+        self.analyses += len(images)
+        timings = [{} for _ in images]
+        results = self.analyzer.analyze_many(images, max_workers=max_workers, timings=timings)
+        self.record_timings(timings)
+        return results
+
+    def record_timings(self, timings):
+        for stage_timings in timings:
+            for stage, milliseconds in stage_timings.items():
+                self.stage_timings[stage].append(milliseconds)
+
+    def stage_timing_summary(self):
+        summary = {}
+        for stage, values in list(self.stage_timings.items()):
+            ordered = sorted(values)
+            if ordered:
+                summary[stage] = {
+                    'p50_ms': ordered[len(ordered) // 2],
+                    'p95_ms': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+                    'samples': len(ordered),
+                }
+        return summary
+
+    def health(self):
+        return {
+            'state': self.state,
+            'ready': self.is_ready,
+            'error': self.error,
+            'warmup_seconds': self.warmup_seconds,
+            'uptime_seconds': round(time.time() - self.ready_at, 1) if self.ready_at else None,
+            'analyses': self.analyses,
+            'stage_timings': self.stage_timing_summary(),
+            'catalog': self.analyzer.catalog.describe() if self.analyzer.catalog else None,
+            'catalog_version': self.catalog_version,
+            'catalog_reloads': dict(self.catalog_reloads),
+            'vision': {**self.analyzer.extractor.describe(), **self.analyzer.vision_guard.stats()},
+        }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the per-process engine, creating it (cold) on first use."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = MedicineEngine()
+    return _engine
@@ -0,0 +1,147 @@
+"""
+Asynchronous identify-medicine jobs.
+
+In async mode the view hands the analysis to a local worker pool and returns a
+job id straight away, so web workers never wait on the vision API. Job records
+are kept in the 'medicine_jobs' Django cache (file based by default), so any
+worker on the host can answer a status poll.
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import caches
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+class MedicineJobQueue:
+    """Bounded local worker pool with job records in a Django cache."""
+
+    def __init__(self, workers, max_pending, result_ttl, cache_alias='medicine_jobs'):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.cache_alias = cache_alias
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='medicine-job')
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_times = deque(maxlen=1000)
+        self.run_times = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _save(self, record):
+        self.cache.set(f"job:{record['job_id']}", record, self.result_ttl)
+
+    def get(self, job_id):
+        return self.cache.get(f'job:{job_id}')
+
+    def submit(self, func, *args):
+        """Queue `func(*args)`, whose return value becomes the job result. Returns the job record."""
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise QueueFullError(f'{self.pending} jobs already queued')
+            self.pending += 1
+
+        record = {
+            'job_id': uuid.uuid4().hex,
+            'state': QUEUED,
+            'submitted_at': time.time(),
+            'started_at': None,
+            'finished_at': None,
+            'result': None,
+        }
+        self._save(record)
+        self.pool.submit(self._run, dict(record), func, args)
+        return record
+
+    def _run(self, record, func, args):
+        record['started_at'] = time.time()
+        record['state'] = RUNNING
+        with self._lock:
+            self.pending -= 1
+            self.running += 1
+            self.wait_times.append(record['started_at'] - record['submitted_at'])
+        self._save(record)
+
+        try:
+            record['result'] = func(*args)
+            record['state'] = DONE
+        except Exception as e:
+            record['result'] = {'status': 'error', 'message': str(e)}
+            record['state'] = FAILED
+        record['finished_at'] = time.time()
+
+        with self._lock:
+            self.running -= 1
+            if record['state'] == DONE:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self.run_times.append(record['finished_at'] - record['started_at'])
+        self._save(record)
+
+    def stats(self):
+        with self._lock:
+            wait_times = list(self.wait_times)
+            run_times = list(self.run_times)
+            return {
+                'workers': self.workers,
+                'queue_depth': self.pending,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_seconds_p50': percentile(wait_times, 0.5),
+                'wait_seconds_p95': percentile(wait_times, 0.95),
+                'run_seconds_p50': percentile(run_times, 0.5),
+                'run_seconds_p95': percentile(run_times, 0.95),
+            }
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = MedicineJobQueue(
+                    workers=settings.MEDICINE_JOB_WORKERS,
+                    max_pending=settings.MEDICINE_JOB_MAX_PENDING,
+                    result_ttl=settings.MEDICINE_JOB_RESULT_TTL,
+                )
+    return _job_queue
+
+
+def job_queue_stats():
+    """Stats of this process's queue, without starting a pool just to report on it."""
+    return _job_queue.stats() if _job_queue is not None else None
@@ -0,0 +1,144 @@
+"""
+Near-duplicate lookup for identify-medicine uploads.
+
+A rescan of the same strip is rarely byte-identical (angle, crop, JPEG
+re-encode), so the exact-hash result cache misses it. Each confidently
+identified image is remembered by its 64-bit difference hash (dHash). A new
+upload whose dHash is within a small Hamming distance of a remembered one gets
+that identification back without a vision-model call. The hash is computed
+by dhash in ml/image_preprocessing.py.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance."""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key, value):
+        node = [key, value, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(key, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def nearest(self, key, max_distance):
+        """(distance, value) of the closest entry within `max_distance`, or None."""
+        if self.root is None:
+            return None
+        best = None
+        stack = [self.root]
+        while stack:
+            node_key, node_value, children = stack.pop()
+            distance = hamming(key, node_key)
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node_value)
+                if distance == 0:
+                    break
+            # Triangle inequality: only subtrees at distance d +/- max_distance can hold matches
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return best
+
+
+class NearDuplicateIndex:
+    """Bounded dHash index of confident identifications, with one BK-tree per catalog version."""
+
+    # Requests that started before a catalog reload still finish on the old version; older ones are dropped
+    MAX_CATALOG_VERSIONS = 2
+
+    def __init__(self, max_distance, capacity, min_confidence):
+        self.max_distance = max_distance
+        self.capacity = capacity
+        self.min_confidence = min_confidence
+        # (catalog_version, image_hash) -> result, oldest first
+        self.entries = OrderedDict()
+        # catalog_version -> BKTree, newest last
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, image_hash, catalog_version):
+        """(distance, result) of a stored near-duplicate for this catalog version, or None."""
+        with self._lock:
+            tree = self.trees.get(catalog_version)
+            match = tree.nearest(image_hash, self.max_distance) if tree is not None else None
+            if match is not None:
+                self.hits += 1
+                return match
+            self.misses += 1
+            return None
+
+    def add(self, image_hash, catalog_version, result):
+        if result.get('status') != 'success' or result.get('match_confidence', 0) < self.min_confidence:
+            return
+        with self._lock:
+            if (catalog_version, image_hash) in self.entries:
+                return
+            if catalog_version not in self.trees:
+                self.trees[catalog_version] = BKTree()
+                if len(self.trees) > self.MAX_CATALOG_VERSIONS:
+                    dropped, _ = self.trees.popitem(last=False)
+                    for key in [key for key in self.entries if key[0] == dropped]:
+                        del self.entries[key]
+            self.entries[(catalog_version, image_hash)] = result
+            self.trees[catalog_version].add(image_hash, result)
+            if len(self.entries) > self.capacity:
+                # BK-trees don't support deletion: drop the oldest tenth and rebuild
+                for _ in range(max(1, self.capacity // 10)):
+                    self.entries.popitem(last=False)
+                self.trees = OrderedDict((version, BKTree()) for version in self.trees)
+                for (version, key), value in self.entries.items():
+                    self.trees[version].add(key, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'catalog_versions': len(self.trees),
+            'max_distance': self.max_distance,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_near_duplicate_index():
+    """Return the per-process index, or None when MEDICINE_NEAR_DUPLICATE_ENABLED is off."""
+    global _index
+    if not settings.MEDICINE_NEAR_DUPLICATE_ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = NearDuplicateIndex(
+                    max_distance=settings.MEDICINE_NEAR_DUPLICATE_DISTANCE,
+                    capacity=settings.MEDICINE_NEAR_DUPLICATE_SIZE,
+                    min_confidence=settings.MEDICINE_NEAR_DUPLICATE_MIN_CONFIDENCE,
+                )
+    return _index
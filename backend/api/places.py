@@ -0,0 +1,305 @@
+"""
+Google Places Nearby Search for the hospital and doctor finders, behind a
+geohash-bucketed cache.
+
+Users in the same neighbourhood ask for nearly the same search. A request is
+bucketed by the geohash cell of its coordinates, the place type and a radius
+bucket. The upstream search for a bucket is centred on the cell and widened by
+the cell's half-diagonal, so its results cover the circle of any caller inside
+the cell. Each caller then gets the cached places re-filtered to their own radius
+and sorted by distance from their exact coordinates. Identical upstream searches
+that overlap in time are coalesced into one call (see single_flight.py).
+
+Every upstream search is also ingested into the local place index (see
+places_index.py), which answers queries inside recently searched areas without
+the Places API, and stands in for it when it fails.
+
+search_healthcare runs the searches for several place types concurrently and
+merges them into one list, for the combined finder endpoint.
+"""
+
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.cache import caches
+
+from .places_index import get_place_index
+from .single_flight import get_single_flight
+from .upstream import get_upstream_session
+
+NEARBY_SEARCH_URL = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+# Places Nearby Search accepts radii up to 50 km
+MAX_RADIUS_METERS = 50000
+RADIUS_BUCKETS = (500, 1000, 2000, 5000, 10000, 20000, MAX_RADIUS_METERS)
+# An empty area is a valid answer, and worth caching like any other
+OK_STATUSES = ('OK', 'ZERO_RESULTS')
+# Nearby Search stops at 3 pages of 20, even when more places match
+MAX_RESULTS = 60
+# A next_page_token only becomes valid a moment after it is issued; until then the API answers INVALID_REQUEST
+PAGE_TOKEN_DELAY_SECONDS = 2.0
+PAGE_TOKEN_ATTEMPTS = 3
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+EARTH_RADIUS_METERS = 6371008.8
+
+
+class PlacesAPIError(Exception):
+    """The Places API answered with an HTTP error or a non-OK status (`places_status`)."""
+
+    def __init__(self, message, places_status=None):
+        super().__init__(message)
+        self.places_status = places_status
+
+
+def geohash_cell(latitude, longitude, precision):
+    """(geohash, (south, west, north, east)) of the cell of `precision` characters containing a point."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    value = 0
+    bits = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, starting with longitude
+        value_range, coordinate = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (value_range[0] + value_range[1]) / 2
+        if coordinate >= mid:
+            value = (value << 1) | 1
+            value_range[0] = mid
+        else:
+            value <<= 1
+            value_range[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            value = 0
+            bits = 0
+    return ''.join(chars), (lat_range[0], lng_range[0], lat_range[1], lng_range[1])
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def radius_bucket(radius):
+    """Smallest bucket at least as large as `radius`."""
+    for bucket in RADIUS_BUCKETS:
+        if radius <= bucket:
+            return bucket
+    return MAX_RADIUS_METERS
+
+
+def format_place(place):
+    location = place.get('geometry', {}).get('location', {})
+    return {
+        'place_id': place.get('place_id'),
+        'name': place.get('name'),
+        'address': place.get('vicinity'),
+        'rating': place.get('rating'),
+        'user_ratings_total': place.get('user_ratings_total'),
+        'latitude': location.get('lat'),
+        'longitude': location.get('lng'),
+        'opening_hours': place.get('opening_hours', {}).get('open_now'),
+        'price_level': place.get('price_level'),
+        'types': place.get('types', []),
+        'photos': [photo.get('photo_reference') for photo in place.get('photos', [])][:3]  # First 3 photos
+    }
+
+
+def within_radius(places, latitude, longitude, radius):
+    """Places within `radius` meters of the point, nearest first, each with its distance_meters."""
+    nearby = []
+    for place in places:
+        if place['latitude'] is None or place['longitude'] is None:
+            continue
+        distance = haversine_meters(latitude, longitude, place['latitude'], place['longitude'])
+        if distance <= radius:
+            nearby.append({**place, 'distance_meters': round(distance)})
+    nearby.sort(key=lambda place: place['distance_meters'])
+    return nearby
+
+
+def fetch_page(params):
+    try:
+        response = get_upstream_session('places').get(NEARBY_SEARCH_URL, params=params)
+    except requests.RequestException as e:
+        raise PlacesAPIError(f"{type(e).__name__}: {e}")
+    if response.status_code != 200:
+        raise PlacesAPIError(f"HTTP {response.status_code}")
+    data = response.json()
+    if data.get('status') not in OK_STATUSES:
+        raise PlacesAPIError(f"status {data.get('status')}", places_status=data.get('status'))
+    return data
+
+
+def search_nearby(latitude, longitude, radius, place_type, pages=1):
+    """
+    Upstream Nearby Search, following next_page_token for up to `pages` pages of 20:
+    (formatted places, next_page_token of the last page fetched).
+    """
+    data = fetch_page({
+        'location': f"{latitude},{longitude}",
+        'radius': radius,
+        'type': place_type,
+        'key': settings.GOOGLE_PLACES_API_KEY
+    })
+    results = data.get('results', [])
+    for _ in range(pages - 1):
+        if not data.get('next_page_token'):
+            break
+        # Each token comes from the page before it, so one type's pages are fetched in turn
+        for attempt in range(PAGE_TOKEN_ATTEMPTS):
+            time.sleep(PAGE_TOKEN_DELAY_SECONDS)
+            try:
+                next_data = fetch_page({'pagetoken': data['next_page_token'], 'key': settings.GOOGLE_PLACES_API_KEY})
+                break
+            except PlacesAPIError as e:
+                if e.places_status != 'INVALID_REQUEST' or attempt == PAGE_TOKEN_ATTEMPTS - 1:
+                    raise
+        data = next_data
+        results.extend(data.get('results', []))
+    places = [format_place(place) for place in results]
+    index = get_place_index()
+    if index is not None:
+        # Only a search that returned every match in its circle can answer for it later
+        exhausted = not data.get('next_page_token') and len(results) < MAX_RESULTS
+        index.add_search(places, latitude, longitude, radius, place_type, exhausted)
+    return places, data.get('next_page_token')
+
+
+class PlacesCache:
+    """Nearby Search results per (type, geohash cell, radius bucket) in a Django cache, with hit/miss counters."""
+
+    def __init__(self, alias, timeout, precision):
+        self.alias = alias
+        self.timeout = timeout
+        self.precision = precision
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, latitude, longitude, radius, place_type):
+        """(key, latitude, longitude, radius) of the upstream search covering this request."""
+        cell, (south, west, north, east) = geohash_cell(latitude, longitude, self.precision)
+        bucket = radius_bucket(radius)
+        # Any point of the cell is at most half a diagonal from its centre
+        search_radius = min(MAX_RADIUS_METERS, math.ceil(bucket + haversine_meters(south, west, north, east) / 2))
+        return f'places:{place_type}:{cell}:{bucket}', (south + north) / 2, (west + east) / 2, search_radius
+
+    def get_or_search(self, latitude, longitude, radius, place_type, search, pages=1):
+        """
+        (places, next_page_token) for the request's bucket, calling `search` on a miss.
+        An entry with fewer than `pages` pages is a miss unless there were no more pages. Errors are not cached.
+        """
+        key, search_latitude, search_longitude, search_radius = self.bucket(latitude, longitude, radius, place_type)
+        entry = caches[self.alias].get(key)
+        if entry is not None and entry['pages'] < pages and entry['next_page_token']:
+            entry = None
+        with self._lock:
+            counters = self.hits if entry is not None else self.misses
+            counters[place_type] = counters.get(place_type, 0) + 1
+        if entry is None:
+            # Concurrent misses on the bucket wait for one search; it is cached before they are released
+            entry = get_single_flight('places').do(
+                f'{key}:{pages}', self.search_and_store, key, search,
+                search_latitude, search_longitude, search_radius, place_type, pages,
+            )
+        return entry['places'], entry['next_page_token']
+
+    def search_and_store(self, key, search, latitude, longitude, radius, place_type, pages):
+        places, next_page_token = search(latitude, longitude, radius, place_type, pages)
+        entry = {'places': places, 'next_page_token': next_page_token, 'pages': pages, 'fetched_at': time.time()}
+        caches[self.alias].set(key, entry, self.timeout)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            hits, misses = dict(self.hits), dict(self.misses)
+        lookups = sum(hits.values()) + sum(misses.values())
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(sum(hits.values()) / lookups, 3) if lookups else None,
+            'geohash_precision': self.precision,
+            'ttl_seconds': self.timeout,
+        }
+
+
+def nearby_places(latitude, longitude, radius, place_type, pages=1, limit=None):
+    """
+    (places within `radius` meters nearest first, at most `limit` of them; next_page_token; source).
+    source is 'index' when a recent search returned every place in an area around the
+    circle and the place index answered, 'places_api' for an upstream or cached search,
+    and 'index_stale' when the Places API failed and older index data was served instead.
+    Index answers are complete, so they have no next_page_token.
+    """
+    index = get_place_index()
+    if index is not None and index.covered(latitude, longitude, radius, place_type):
+        index.record('served')
+        return index.query(latitude, longitude, radius, place_type, limit), None, 'index'
+
+    cache = get_places_cache()
+    try:
+        if cache is None:
+            places, next_page_token = get_single_flight('places').do(
+                f'places:{place_type}:{latitude},{longitude}:{radius}:{pages}',
+                search_nearby, latitude, longitude, radius, place_type, pages,
+            )
+        else:
+            places, next_page_token = cache.get_or_search(latitude, longitude, radius, place_type, search_nearby, pages)
+    except PlacesAPIError:
+        if index is None or not index.covered(latitude, longitude, radius, place_type, max_age=math.inf):
+            raise
+        index.record('served_stale')
+        return index.query(latitude, longitude, radius, place_type, limit), None, 'index_stale'
+    return within_radius(places, latitude, longitude, radius)[:limit], next_page_token, 'places_api'
+
+
+def search_healthcare(latitude, longitude, radius, place_types, pages=1, limit=None):
+    """
+    Nearby places of several types, one concurrent search per type, merged by place_id
+    and sorted nearest first, at most `limit` of them. Returns (places, errors, sources):
+    errors maps a failed type to its PlacesAPIError and sources the others to where their
+    results came from (see nearby_places); each place lists the types it was found under.
+    """
+    with ThreadPoolExecutor(max_workers=len(place_types)) as pool:
+        futures = {
+            place_type: pool.submit(nearby_places, latitude, longitude, radius, place_type, pages)
+            for place_type in place_types
+        }
+    merged = {}
+    errors = {}
+    sources = {}
+    for place_type, future in futures.items():
+        try:
+            places, _, sources[place_type] = future.result()
+        except PlacesAPIError as e:
+            errors[place_type] = e
+            continue
+        for place in places:
+            entry = merged.setdefault(place['place_id'], {**place, 'matched_types': []})
+            entry['matched_types'].append(place_type)
+    return sorted(merged.values(), key=lambda place: place['distance_meters'])[:limit], errors, sources
+
+
+_places_cache = None
+_places_cache_lock = threading.Lock()
+
+
+def get_places_cache():
+    """Return the per-process places cache, or None when PLACES_CACHE_ENABLED is off."""
+    global _places_cache
+    if not settings.PLACES_CACHE_ENABLED:
+        return None
+    if _places_cache is None:
+        with _places_cache_lock:
+            if _places_cache is None:
+                _places_cache = PlacesCache('places', settings.PLACES_CACHE_TTL, settings.PLACES_CACHE_GEOHASH_PRECISION)
+    return _places_cache
@@ -0,0 +1,248 @@
+"""
+Local spatial index of the healthcare places seen in Places API results.
+
+Every upstream Nearby Search is ingested: its places go into a uniform lat/lng
+grid, and a search that returned every place in its circle is remembered as
+coverage (its centre, radius, place type and time). A search cut off by a page
+limit is not: it only holds the top results of its circle, and would hide the
+places it left out. A later query whose circle lies inside a fresh coverage circle
+of the same type is answered from the index alone (the containment test is one
+vectorized pass over the coverage arrays): candidate rows come from the
+grid cells overlapping the circle, and their distances are computed in one
+vectorized haversine pass. When the Places API fails, the index also answers
+from older coverage, so the finders keep working through an upstream outage.
+
+opening_hours (open_now) is as of the search that found a place.
+"""
+
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+MAX_COVERAGE = 10000
+
+
+def haversine_meters_many(latitude, longitude, latitudes, longitudes):
+    """Distances in meters from one point to arrays of points (all in degrees)."""
+    lat1, lng1 = math.radians(latitude), math.radians(longitude)
+    lat2, lng2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class Coverage:
+    """The circles of one place type's exhausted searches: a ring of the last MAX_COVERAGE, as arrays."""
+
+    def __init__(self, capacity=MAX_COVERAGE):
+        self.latitudes = np.empty(capacity)
+        self.longitudes = np.empty(capacity)
+        self.radii = np.empty(capacity)
+        self.searched_at = np.empty(capacity)
+        self.size = 0
+        self.next = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, latitude, longitude, radius, searched_at):
+        i = self.next
+        self.latitudes[i], self.longitudes[i], self.radii[i], self.searched_at[i] = latitude, longitude, radius, searched_at
+        self.next = (i + 1) % len(self.latitudes)
+        self.size = min(self.size + 1, len(self.latitudes))
+
+    def contains(self, latitude, longitude, radius, since):
+        """Whether one circle searched after `since` contains the whole circle."""
+        fresh = np.flatnonzero(self.searched_at[:self.size] >= since)
+        if not len(fresh):
+            return False
+        distances = haversine_meters_many(latitude, longitude, self.latitudes[fresh], self.longitudes[fresh])
+        return bool(np.any(distances + radius <= self.radii[fresh]))
+
+    def expire(self, searched_until):
+        """Forget the circles searched at or before `searched_until`."""
+        keep = self.searched_at[:self.size] > searched_until
+        if keep.all():
+            return
+        order = np.roll(np.arange(self.size), -self.next if self.size == len(self.latitudes) else 0)
+        kept = order[keep[order]]
+        for array in (self.latitudes, self.longitudes, self.radii, self.searched_at):
+            array[:len(kept)] = array[kept]
+        self.size = len(kept)
+        self.next = self.size % len(self.latitudes)
+
+
+class PlaceIndex:
+    """Places in a lat/lng grid, with a bitmask of the searched types each was found under."""
+
+    def __init__(self, cell_degrees, max_age, max_places):
+        self.cell_degrees = cell_degrees
+        self.max_age = max_age
+        self.max_places = max_places
+        self.lng_cells = math.ceil(360 / cell_degrees)
+        self.rows = {}
+        self.places = []
+        self.size = 0
+        self.latitudes = np.empty(1024)
+        self.longitudes = np.empty(1024)
+        self.type_masks = np.zeros(1024, dtype=np.uint64)
+        self.seen_at = np.empty(1024)
+        self.grid = defaultdict(list)
+        self.type_bits = {}
+        self.coverage = defaultdict(Coverage)
+        self.counts = {'ingested_searches': 0, 'served': 0, 'served_stale': 0}
+        self._lock = threading.Lock()
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_degrees), math.floor(longitude / self.cell_degrees) % self.lng_cells)
+
+    def type_bit(self, place_type):
+        if place_type not in self.type_bits:
+            self.type_bits[place_type] = np.uint64(1 << len(self.type_bits))
+        return self.type_bits[place_type]
+
+    def _grow(self):
+        capacity = len(self.latitudes) * 2
+        for name in ('latitudes', 'longitudes', 'type_masks', 'seen_at'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            setattr(self, name, grown)
+
+    def _compact(self):
+        """
+        Drop the places seen least recently, keeping half of max_places, and rebuild the grid.
+        A search sees every place in its circle, so only circles searched no later than the
+        last time a dropped place was seen can have lost places; they stop being coverage.
+        """
+        keep = np.sort(np.argsort(-self.seen_at[:self.size], kind='stable')[:self.max_places // 2])
+        dropped = np.ones(self.size, dtype=bool)
+        dropped[keep] = False
+        if dropped.any():
+            last_seen = self.seen_at[:self.size][dropped].max()
+            for coverage in self.coverage.values():
+                coverage.expire(last_seen)
+        self.places = [self.places[row] for row in keep]
+        for name in ('latitudes', 'longitudes', 'type_masks', 'seen_at'):
+            array = getattr(self, name)
+            array[:len(keep)] = array[keep]
+        self.size = len(keep)
+        self.rows = {place['place_id']: row for row, place in enumerate(self.places)}
+        self.grid = defaultdict(list)
+        for row in range(self.size):
+            self.grid[self.cell(self.latitudes[row], self.longitudes[row])].append(row)
+
+    def add_search(self, places, latitude, longitude, radius, place_type, exhausted):
+        """Ingest one upstream search: its places, and its circle as coverage if it was `exhausted` (had no more results)."""
+        now = time.time()
+        with self._lock:
+            bit = self.type_bit(place_type)
+            for place in places:
+                if place['latitude'] is None or place['longitude'] is None:
+                    continue
+                row = self.rows.get(place['place_id'])
+                if row is None:
+                    if self.size == self.max_places:
+                        self._compact()
+                    if self.size == len(self.latitudes):
+                        self._grow()
+                    row = self.rows[place['place_id']] = self.size
+                    self.size += 1
+                    self.places.append(place)
+                    self.type_masks[row] = 0
+                else:
+                    self.grid[self.cell(self.latitudes[row], self.longitudes[row])].remove(row)
+                    self.places[row] = place
+                self.latitudes[row] = place['latitude']
+                self.longitudes[row] = place['longitude']
+                self.type_masks[row] |= bit
+                self.seen_at[row] = now
+                self.grid[self.cell(place['latitude'], place['longitude'])].append(row)
+            if exhausted:
+                self.coverage[place_type].add(latitude, longitude, radius, now)
+            self.counts['ingested_searches'] += 1
+
+    def covered(self, latitude, longitude, radius, place_type, max_age=None):
+        """Whether one exhausted search of `place_type`, at most `max_age` old, covered this whole circle."""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            coverage = self.coverage.get(place_type)
+            return coverage is not None and coverage.contains(latitude, longitude, radius, time.time() - max_age)
+
+    def candidate_rows(self, latitude, longitude, radius):
+        """Rows in the grid cells overlapping the circle's bounding box."""
+        lat_span = radius / METERS_PER_DEGREE
+        # Longitude degrees shrink towards the poles; clamp so the box stays finite near them
+        lng_span = lat_span / max(math.cos(math.radians(min(89.0, abs(latitude) + lat_span))), 0.01)
+        south, north = self.cell(latitude - lat_span, 0)[0], self.cell(latitude + lat_span, 0)[0]
+        first_lng = math.floor((longitude - lng_span) / self.cell_degrees)
+        last_lng = math.floor((longitude + lng_span) / self.cell_degrees)
+        lng_cells = {i % self.lng_cells for i in range(first_lng, min(last_lng, first_lng + self.lng_cells - 1) + 1)}
+        rows = []
+        for lat_cell in range(south, north + 1):
+            for lng_cell in lng_cells:
+                rows.extend(self.grid.get((lat_cell, lng_cell), ()))
+        return np.array(rows, dtype=np.int64)
+
+    def nearby(self, latitude, longitude, radius, place_type, limit=None):
+        """Indexed places of `place_type` within `radius` meters, nearest first, each with its distance_meters."""
+        with self._lock:
+            bit = self.type_bits.get(place_type)
+            if bit is None:
+                return []
+            rows = self.candidate_rows(latitude, longitude, radius)
+            rows = rows[(self.type_masks[rows] & bit) != 0]
+            distances = haversine_meters_many(latitude, longitude, self.latitudes[rows], self.longitudes[rows])
+            inside = distances <= radius
+            rows, distances = rows[inside], distances[inside]
+            order = np.argsort(distances, kind='stable')[:limit]
+            return [{**self.places[row], 'distance_meters': round(float(distances[i]))} for row, i in zip(rows[order], order)]
+
+    def nearest(self, latitude, longitude, k, place_type, max_radius):
+        """The k indexed places of `place_type` nearest to the point, within `max_radius` meters."""
+        radius = min(max_radius, self.cell_degrees * METERS_PER_DEGREE)
+        while True:
+            places = self.nearby(latitude, longitude, radius, place_type, limit=k)
+            # The k nearest within a circle are the k nearest overall once the circle holds k
+            if len(places) >= k or radius >= max_radius:
+                return places
+            radius = min(max_radius, radius * 4)
+
+    def query(self, latitude, longitude, radius, place_type, limit=None):
+        if limit:
+            return self.nearest(latitude, longitude, limit, place_type, radius)
+        return self.nearby(latitude, longitude, radius, place_type)
+
+    def record(self, outcome):
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                **self.counts,
+                'places': self.size,
+                'coverage': {place_type: len(coverage) for place_type, coverage in self.coverage.items()},
+                'max_age_seconds': self.max_age,
+            }
+
+
+_place_index = None
+_place_index_lock = threading.Lock()
+
+
+def get_place_index():
+    """Return the per-process place index, or None when PLACES_INDEX_ENABLED is off."""
+    global _place_index
+    if not settings.PLACES_INDEX_ENABLED:
+        return None
+    if _place_index is None:
+        with _place_index_lock:
+            if _place_index is None:
+                _place_index = PlaceIndex(settings.PLACES_INDEX_CELL_DEGREES, settings.PLACES_INDEX_MAX_AGE, settings.PLACES_INDEX_MAX_PLACES)
+    return _place_index
@@ -0,0 +1,79 @@
+"""
+Single-flight coalescing of identical upstream calls.
+
+When many identical requests arrive at once (a trending location, a burst of
+logins, the same photo uploaded by several people), only the first one calls
+upstream; the others wait for that call and share its result, or its exception.
+Nothing is kept once the call finishes: caching is the caller's business, this
+only stops duplicate calls that overlap in time.
+"""
+
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, with counters of calls made and requests coalesced."""
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {'calls': 0, 'coalesced': 0, 'errors': 0}
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """fn(*args, **kwargs), unless a call with the same key is in flight: then that call's outcome."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.counts['calls'] += 1
+            else:
+                self.counts['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.counts['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {**self.counts, 'in_flight': len(self._calls)}
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_single_flight(name):
+    """Return the per-process single-flight group `name` (e.g. 'places'), creating it on first use."""
+    flight = _flights.get(name)
+    if flight is None:
+        with _flights_lock:
+            flight = _flights.setdefault(name, SingleFlight(name))
+    return flight
+
+
+def single_flight_stats():
+    return {name: flight.stats() for name, flight in list(_flights.items())}
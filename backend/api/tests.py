@@ -1,3 +1,888 @@
-from django.test import TestCase
+import io
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from . import places, views
+from .medicine_cache import MedicineResultCache, image_digest
+from .medicine_engine import MedicineEngine
+from .medicine_jobs import MedicineJobQueue, QueueFullError
+from .medicine_near_duplicates import BKTree, NearDuplicateIndex, hamming
+from .places import PlacesCache, geohash_cell, haversine_meters, radius_bucket
+from .places_index import Coverage, PlaceIndex
+from .single_flight import SingleFlight
+from .upstream import UpstreamSession
+
+# ml/ is on sys.path once medicine_engine is imported
+from analyze_medicine import MedicineAnalyzer
+from image_preprocessing import dhash_image, preprocess_image
+from vision_extractors import StandInExtractor
+
+ML_DIR = settings.BASE_DIR.parent / 'ml'
+TEST_CATALOG_PATH = str(ML_DIR / 'fixtures' / 'test_catalog.csv')
+IMAGES_DIR = ML_DIR / 'Medicine_data' / 'Medicine_data'
+# Stand-in answers for two of the images: Telma 40 Forte Tablet ER (5 cheaper substitutes)
+# and Omez 20 Tablet ER (none)
+TELMA_IMAGE = IMAGES_DIR / 'images03.jpg'
+OMEZ_IMAGE = IMAGES_DIR / 'images04.jpg'
+
+
+TEST_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'tests-{alias}'}
+    for alias in ('default', 'medicine_jobs', 'medicine_results', 'medicine_results_disk', 'places')
+}
+
+
+def jpeg_segment(marker, payload):
+    return bytes([0xFF, marker]) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+
+def with_segments(jpeg, *segments):
+    """`jpeg` with `segments` inserted right after its SOI marker."""
+    return jpeg[:2] + b''.join(segments) + jpeg[2:]
+
+
+def confident(name):
+    return {'status': 'success', 'match_confidence': 100, 'data': {'brand_name': name}}
+
+
+class BKTreeTests(SimpleTestCase):
+    def test_nearest_matches_brute_force(self):
+        rng = random.Random(0)
+        keys = [rng.getrandbits(64) for _ in range(500)]
+        tree = BKTree()
+        for key in keys:
+            tree.add(key, key)
+        for _ in range(200):
+            # Queries near stored keys, so many have a match within the distance
+            query = rng.choice(keys) ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64))
+            distances = [hamming(query, key) for key in keys]
+            best = min(distances)
+            match = tree.nearest(query, 3)
+            if best > 3:
+                self.assertIsNone(match)
+            else:
+                self.assertEqual(match[0], best)
+                self.assertEqual(hamming(query, match[1]), best)
+
+    def test_empty_tree(self):
+        self.assertIsNone(BKTree().nearest(0, 64))
+
+
+class NearDuplicateIndexTests(SimpleTestCase):
+    def test_lookup_within_distance(self):
+        index = NearDuplicateIndex(max_distance=4, capacity=100, min_confidence=95)
+        index.add(0b1111, 'v1', confident('Dolo 650 Tablet'))
+        self.assertEqual(index.lookup(0b1111 ^ 0b0011, 'v1'), (2, confident('Dolo 650 Tablet')))
+        self.assertIsNone(index.lookup(0b1111 ^ 0b11111, 'v1'))
+
+    def test_only_confident_results_are_stored(self):
+        index = NearDuplicateIndex(max_distance=4, capacity=100, min_confidence=95)
+        index.add(1, 'v1', {**confident('Dolo 650 Tablet'), 'match_confidence': 90})
+        index.add(2, 'v1', {'status': 'low_confidence', 'match_confidence': 99})
+        self.assertEqual(index.stats()['entries'], 0)
+
+    def test_other_catalog_versions_do_not_match(self):
+        index = NearDuplicateIndex(max_distance=4, capacity=100, min_confidence=95)
+        index.add(0, 'v1', confident('old'))
+        self.assertIsNone(index.lookup(0, 'v2'))
+
+    def test_old_version_does_not_hide_current_version(self):
+        index = NearDuplicateIndex(max_distance=4, capacity=100, min_confidence=95)
+        index.add(0, 'v1', confident('old'))
+        index.add(0b11, 'v2', confident('new'))
+        self.assertEqual(index.lookup(0, 'v2'), (2, confident('new')))
+        self.assertEqual(index.lookup(0, 'v1'), (0, confident('old')))
+
+    def test_old_catalog_versions_are_evicted(self):
+        index = NearDuplicateIndex(max_distance=4, capacity=100, min_confidence=95)
+        for version in ('v1', 'v2', 'v3'):
+            index.add(0, version, confident(version))
+        self.assertEqual(index.stats()['entries'], NearDuplicateIndex.MAX_CATALOG_VERSIONS)
+        self.assertIsNone(index.lookup(0, 'v1'))
+        self.assertEqual(index.lookup(0, 'v3'), (0, confident('v3')))
+
+    def test_capacity_drops_oldest_entries(self):
+        index = NearDuplicateIndex(max_distance=0, capacity=10, min_confidence=95)
+        for key in range(11):
+            index.add(key << 8, 'v1', confident(str(key)))
+        self.assertEqual(index.stats()['entries'], 10)
+        self.assertIsNone(index.lookup(0, 'v1'))
+        self.assertEqual(index.lookup(10 << 8, 'v1'), (0, confident('10')))
+
+
+class ImageDigestTests(SimpleTestCase):
+    def setUp(self):
+        self.jpeg = TELMA_IMAGE.read_bytes()
+
+    def test_exif_and_comments_are_ignored(self):
+        digest = image_digest(self.jpeg)
+        rewritten = with_segments(self.jpeg, jpeg_segment(0xE1, b'Exif\x00\x00re-saved'), jpeg_segment(0xFE, b'edited'))
+        self.assertEqual(image_digest(rewritten), digest)
+        self.assertEqual(image_digest(memoryview(rewritten)), digest)
+
+    def test_image_data_is_not_ignored(self):
+        digest = image_digest(self.jpeg)
+        # APP0 (JFIF) and the scan data both define the image
+        self.assertNotEqual(image_digest(with_segments(self.jpeg, jpeg_segment(0xE0, b'JFIF\x00'))), digest)
+        self.assertNotEqual(image_digest(self.jpeg[:-3] + b'\x00' + self.jpeg[-2:]), digest)
+
+    def test_other_data_is_hashed_as_is(self):
+        png = b'\x89PNG\r\n\x1a\n' + b'\x00' * 10
+        self.assertNotEqual(image_digest(png), image_digest(png + b'\x00'))
+        # No SOS marker after the SOI: the raw bytes, so different files never share a digest
+        malformed = b'\xff\xd8' + jpeg_segment(0xE1, b'a')
+        self.assertNotEqual(image_digest(malformed), image_digest(b'\xff\xd8' + jpeg_segment(0xE1, b'b')))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MedicineResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = MedicineResultCache(['medicine_results', 'medicine_results_disk'], timeout=60)
+        for alias in self.cache.aliases:
+            self.addCleanup(caches[alias].clear)
+
+    def test_only_deterministic_outcomes_are_cached(self):
+        self.cache.set('success', confident('Dolo 650 Tablet'))
+        self.cache.set('low', {'status': 'low_confidence', 'match_confidence': 60})
+        self.cache.set('error', {'status': 'error', 'message': 'Gemini API response took too long'})
+        self.assertEqual(self.cache.get('success'), confident('Dolo 650 Tablet'))
+        self.assertEqual(self.cache.get('low')['status'], 'low_confidence')
+        self.assertIsNone(self.cache.get('error'))
+
+    def test_disk_hits_are_promoted(self):
+        caches['medicine_results_disk'].set('key', confident('Dolo 650 Tablet'))
+        self.assertEqual(self.cache.get('key'), confident('Dolo 650 Tablet'))
+        self.assertEqual(caches['medicine_results'].get('key'), confident('Dolo 650 Tablet'))
+        self.cache.get('key')
+        self.cache.get('missing')
+        self.assertEqual(self.cache.stats()['hits'], {'medicine_results': 1, 'medicine_results_disk': 1})
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_keys_include_the_catalog_version(self):
+        self.assertNotEqual(self.cache.key('abc', 'v1'), self.cache.key('abc', 'v2'))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def run_concurrently(self, flight, fn, callers=8):
+        """Calls flight.do('key', fn) from `callers` threads; fn must block until release is set."""
+        outcomes = [None] * callers
+
+        def caller(i):
+            try:
+                outcomes[i] = ('result', flight.do('key', fn))
+            except Exception as e:
+                outcomes[i] = ('error', e)
+
+        threads = [threading.Thread(target=caller, args=(i,)) for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        # Let the leader return only once every other caller is waiting on it
+        deadline = time.monotonic() + 5
+        while flight.stats()['coalesced'] < callers - 1 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight('test')
+
+        def fn():
+            self.calls += 1
+            self.release.wait(5)
+            return 'places'
+
+        outcomes = self.run_concurrently(flight, fn)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [('result', 'places')] * 8)
+        self.assertEqual(flight.stats(), {'calls': 1, 'coalesced': 7, 'errors': 0, 'in_flight': 0})
+
+    def test_exception_reaches_every_caller(self):
+        flight = SingleFlight('test')
+        error = ValueError('upstream down')
+
+        def fn():
+            self.calls += 1
+            self.release.wait(5)
+            raise error
+
+        outcomes = self.run_concurrently(flight, fn)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [('error', error)] * 8)
+        self.assertEqual(flight.stats(), {'calls': 1, 'coalesced': 7, 'errors': 1, 'in_flight': 0})
+
+    def test_finished_calls_are_not_shared(self):
+        flight = SingleFlight('test')
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+        self.assertEqual(flight.do('other', lambda: 3), 3)
+        self.assertEqual(flight.stats()['calls'], 3)
+
+
+def response(status_code):
+    result = requests.Response()
+    result.status_code = status_code
+    result.raw = io.BytesIO(b'{}')
+    return result
+
+
+class UpstreamSessionTests(SimpleTestCase):
+    def setUp(self):
+        # No backoff, so retries don't sleep
+        self.session = UpstreamSession('test', connect_timeout=3, read_timeout=10, max_retries=2, backoff_seconds=0, pool_size=1)
+
+    def send(self, method, outcomes, **kwargs):
+        """session.request(method) with each attempt answered by the next outcome; returns (result, attempts)."""
+        with mock.patch.object(requests.Session, 'request', side_effect=outcomes) as send:
+            return self.session.request(method, 'https://example.com/', **kwargs), send
+
+    def test_get_is_retried_on_retryable_status(self):
+        result, send = self.send('GET', [response(503), response(200)])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(self.session.counts['retries'], 1)
+
+    def test_get_is_retried_on_connection_error(self):
+        result, send = self.send('GET', [requests.ConnectionError(), requests.Timeout(), response(200)])
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(send.call_count, 3)
+
+    def test_retries_are_bounded(self):
+        result, send = self.send('GET', [response(503)] * 5)
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(send.call_count, 3)
+        with self.assertRaises(requests.ConnectionError):
+            self.send('GET', [requests.ConnectionError()] * 5)
+
+    def test_other_errors_are_not_retried(self):
+        result, send = self.send('GET', [response(404), response(200)])
+        self.assertEqual(result.status_code, 404)
+        self.assertEqual(send.call_count, 1)
+
+    def test_post_is_not_retried(self):
+        result, send = self.send('POST', [response(503), response(200)])
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(send.call_count, 1)
+        with self.assertRaises(requests.ConnectionError):
+            self.send('POST', [requests.ConnectionError(), response(200)])
+        self.assertEqual(self.session.counts['retries'], 0)
+
+    def test_timeouts_are_clamped_to_the_configured_ones(self):
+        self.assertEqual(self.session._timeout(None), (3, 10))
+        self.assertEqual(self.session._timeout(100), (3, 10))
+        self.assertEqual(self.session._timeout(1), (1, 1))
+        self.assertEqual(self.session._timeout((1, 60)), (1, 10))
+        self.assertEqual(self.session._timeout((None, 5)), (3, 5))
+        _, send = self.send('GET', [response(200)], timeout=100)
+        self.assertEqual(send.call_args.kwargs['timeout'], (3, 10))
+
+
+def nearby_search_page(count, next_page_token=None, latitude=12.97, longitude=77.59):
+    """A Nearby Search page of `count` places spread north of the point, about 100 m apart."""
+    results = [
+        {'place_id': f'p{i}', 'name': f'Hospital {i}', 'geometry': {'location': {'lat': latitude + i * 0.0009, 'lng': longitude}}}
+        for i in range(count)
+    ]
+    return {'status': 'OK', 'results': results, 'next_page_token': next_page_token}
+
+
+class GeohashTests(SimpleTestCase):
+    def test_geohash_cell(self):
+        cell, (south, west, north, east) = geohash_cell(57.64911, 10.40744, 11)
+        self.assertEqual(cell, 'u4pruydqqvj')
+        self.assertTrue(south <= 57.64911 <= north and west <= 10.40744 <= east)
+        # A shorter geohash is a prefix of a longer one, and its cell contains it
+        cell6, (south6, west6, north6, east6) = geohash_cell(57.64911, 10.40744, 6)
+        self.assertEqual(cell6, cell[:6])
+        self.assertTrue(south6 <= south and north <= north6 and west6 <= west and east <= east6)
+
+    def test_radius_bucket(self):
+        self.assertEqual([radius_bucket(radius) for radius in (1, 500, 501, 5000, 49999, 80000)], [500, 500, 1000, 5000, 50000, 50000])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PlacesCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = PlacesCache('places', timeout=60, precision=6)
+        self.addCleanup(caches['places'].clear)
+        for target, value in (('get_places_cache', self.cache), ('get_place_index', None)):
+            patcher = mock.patch.object(places, target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        _, (self.south, self.west, self.north, self.east) = geohash_cell(12.97, 77.59, 6)
+        self.longitude = (self.west + self.east) / 2
+
+    def nearby(self, pages, latitude, longitude, radius):
+        """nearby_places with each upstream page answered by the next of `pages`: (result, fetch_page mock)."""
+        with mock.patch.object(places, 'fetch_page', side_effect=pages) as fetch_page:
+            return places.nearby_places(latitude, longitude, radius, 'hospital'), fetch_page
+
+    def test_callers_in_a_cell_share_one_search(self):
+        key, latitude, longitude, search_radius = self.cache.bucket(self.south + 0.0001, self.west + 0.0001, 800, 'hospital')
+        self.assertEqual(self.cache.bucket(self.north - 0.0001, self.east - 0.0001, 1000, 'hospital')[0], key)
+        self.assertNotEqual(self.cache.bucket(self.south + 0.0001, self.west + 0.0001, 2000, 'hospital')[0], key)
+        self.assertNotEqual(self.cache.bucket(self.south + 0.0001, self.west + 0.0001, 800, 'doctor')[0], key)
+        self.assertNotEqual(self.cache.bucket(self.south - 0.0001, self.west + 0.0001, 800, 'hospital')[0], key)
+        # The search circle holds the bucket's circle around any point of the cell
+        for corner in ((self.south, self.west), (self.south, self.east), (self.north, self.west), (self.north, self.east)):
+            self.assertLessEqual(haversine_meters(latitude, longitude, *corner) + 1000, search_radius)
+
+    def test_hit_is_refiltered_to_the_caller(self):
+        # 20 places about 100 m apart, north from the south edge of the cell
+        page = nearby_search_page(20, latitude=self.south, longitude=self.longitude)
+        (first, _, source), fetch_page = self.nearby([page], self.south + 0.0001, self.longitude, 1000)
+        self.assertEqual((source, fetch_page.call_count), ('places_api', 1))
+        key, latitude, longitude, search_radius = self.cache.bucket(self.south, self.longitude, 1000, 'hospital')
+        self.assertEqual(fetch_page.call_args.args[0]['location'], f'{latitude},{longitude}')
+        self.assertEqual(fetch_page.call_args.args[0]['radius'], search_radius)
+        self.assertEqual([place['place_id'] for place in first], [f'p{i}' for i in range(11)])
+
+        (second, _, _), fetch_page = self.nearby([], self.north - 0.0001, self.longitude, 600)
+        self.assertEqual(fetch_page.call_count, 0)
+        expected = [
+            (haversine_meters(self.north - 0.0001, self.longitude, result['geometry']['location']['lat'], self.longitude), result['place_id'])
+            for result in page['results']
+        ]
+        expected = [place_id for distance, place_id in sorted(expected) if distance <= 600]
+        self.assertEqual([place['place_id'] for place in second], expected)
+        self.assertTrue(expected)
+        distances = [place['distance_meters'] for place in second]
+        self.assertEqual(distances, sorted(distances))
+        self.assertLessEqual(distances[-1], 600)
+        self.assertEqual(self.cache.stats()['hits'], {'hospital': 1})
+
+    def test_more_pages_than_cached_is_a_miss(self):
+        search = mock.Mock(return_value=([], 'token'))
+        self.cache.get_or_search(12.97, 77.59, 1000, 'hospital', search, pages=1)
+        self.cache.get_or_search(12.97, 77.59, 1000, 'hospital', search, pages=1)
+        self.assertEqual(search.call_count, 1)
+        self.cache.get_or_search(12.97, 77.59, 1000, 'hospital', search, pages=2)
+        self.assertEqual(search.call_count, 2)
+        # No more pages to fetch: a shorter entry is complete
+        search.return_value = ([], None)
+        self.cache.get_or_search(12.97, 77.59, 5000, 'hospital', search, pages=1)
+        self.cache.get_or_search(12.97, 77.59, 5000, 'hospital', search, pages=3)
+        self.assertEqual(search.call_count, 3)
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(places.PlacesAPIError):
+            self.nearby(places.PlacesAPIError('HTTP 503'), 12.97, 77.59, 1000)
+        (found, _, _), fetch_page = self.nearby([nearby_search_page(3)], 12.97, 77.59, 1000)
+        self.assertEqual((fetch_page.call_count, len(found)), (1, 3))
+
+
+class NearbyPlacesIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = PlaceIndex(cell_degrees=0.05, max_age=600, max_places=10000)
+        for target, value in (('get_place_index', self.index), ('get_places_cache', None)):
+            patcher = mock.patch.object(places, target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def nearby(self, pages, latitude, longitude, radius):
+        """nearby_places with each upstream page answered by the next of `pages`: (result, pages fetched)."""
+        with mock.patch.object(places, 'fetch_page', side_effect=pages) as fetch_page:
+            return places.nearby_places(latitude, longitude, radius, 'hospital'), fetch_page.call_count
+
+    def test_truncated_wide_search_does_not_cover_narrow_queries(self):
+        (_, next_page_token, source), _ = self.nearby([nearby_search_page(20, 'token')], 12.97, 77.59, 50000)
+        self.assertEqual((next_page_token, source), ('token', 'places_api'))
+        # Inside the wide circle, but none of its top 20 results is near this point
+        far = nearby_search_page(5, latitude=13.05, longitude=77.65)
+        (found, _, source), fetched = self.nearby([far], 13.05, 77.65, 5000)
+        self.assertEqual((source, fetched, len(found)), ('places_api', 1, 5))
+
+    def test_exhausted_search_answers_from_the_index(self):
+        self.nearby([nearby_search_page(10)], 12.97, 77.59, 5000)
+        (found, next_page_token, source), fetched = self.nearby([], 12.97, 77.59, 500)
+        self.assertEqual((source, next_page_token, fetched), ('index', None, 0))
+        self.assertEqual([place['place_id'] for place in found], ['p0', 'p1', 'p2', 'p3', 'p4'])
+
+    def test_search_at_the_result_cap_is_not_exhausted(self):
+        # The third page never has a next_page_token, even when more places match
+        pages = [nearby_search_page(20, 'token'), nearby_search_page(20, 'token'), nearby_search_page(20)]
+        with mock.patch.object(places, 'fetch_page', side_effect=pages), mock.patch.object(places.time, 'sleep'):
+            found, next_page_token = places.search_nearby(12.97, 77.59, 5000, 'hospital', pages=3)
+        self.assertEqual((len(found), next_page_token), (60, None))
+        self.assertFalse(self.index.covered(12.97, 77.59, 500, 'hospital'))
+
+    def test_outage_is_not_answered_from_a_truncated_search(self):
+        self.nearby([nearby_search_page(20, 'token')], 12.97, 77.59, 50000)
+        with self.assertRaises(places.PlacesAPIError):
+            self.nearby(places.PlacesAPIError('HTTP 503'), 12.97, 77.59, 1000)
+
+    def test_outage_is_answered_from_an_old_exhausted_search(self):
+        self.nearby([nearby_search_page(10)], 12.97, 77.59, 5000)
+        with mock.patch.object(places.time, 'time', return_value=time.time() + 3600):
+            (found, _, source), _ = self.nearby(places.PlacesAPIError('HTTP 503'), 12.97, 77.59, 500)
+        self.assertEqual((source, len(found)), ('index_stale', 5))
+
+
+class FindHealthcareTests(SimpleTestCase):
+    def setUp(self):
+        hospitals = nearby_search_page(3)
+        doctors = nearby_search_page(3)
+        # p1 and p2 are listed under both types; d0 is a doctor only, between p0 and p1
+        doctors['results'] = doctors['results'][1:] + [
+            {'place_id': 'd0', 'name': 'Clinic', 'geometry': {'location': {'lat': 12.97045, 'lng': 77.59}}},
+        ]
+        self.pages = {'hospital': hospitals, 'doctor': doctors}
+        for target in ('get_places_cache', 'get_place_index'):
+            patcher = mock.patch.object(places, target, return_value=None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def fetch_page(self, params):
+        page = self.pages[params['type']]
+        if isinstance(page, Exception):
+            raise page
+        return page
+
+    def find(self, **data):
+        with mock.patch.object(places, 'fetch_page', side_effect=self.fetch_page):
+            payload = {'latitude': 12.97, 'longitude': 77.59, 'radius': 1000, **data}
+            return self.client.post(reverse('find_healthcare'), payload, content_type='application/json')
+
+    def test_types_are_merged_by_place(self):
+        response = self.find(types=['hospital', 'doctor', 'hospital'])
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['types'], ['hospital', 'doctor'])
+        self.assertEqual([place['place_id'] for place in body['places']], ['p0', 'd0', 'p1', 'p2'])
+        self.assertEqual([place['matched_types'] for place in body['places']], [
+            ['hospital'], ['doctor'], ['hospital', 'doctor'], ['hospital', 'doctor'],
+        ])
+        self.assertEqual((body['count'], body['errors']), (4, {}))
+        self.assertEqual(body['sources'], {'hospital': 'places_api', 'doctor': 'places_api'})
+        self.assertEqual([place['place_id'] for place in self.find(limit=2).json()['places']], ['p0', 'd0'])
+
+    def test_failed_type_does_not_fail_the_others(self):
+        self.pages['doctor'] = places.PlacesAPIError('status OVER_QUERY_LIMIT', places_status='OVER_QUERY_LIMIT')
+        with self.assertLogs(views.logger, 'ERROR'):
+            body = self.find().json()
+        self.assertEqual([place['place_id'] for place in body['places']], ['p0', 'p1', 'p2'])
+        self.assertEqual(body['errors'], {'doctor': 'Google Places API error: OVER_QUERY_LIMIT'})
+        self.assertEqual(body['sources'], {'hospital': 'places_api'})
+
+    def test_every_type_failing_is_an_error(self):
+        self.pages = {place_type: places.PlacesAPIError('HTTP 503') for place_type in self.pages}
+        with self.assertLogs(views.logger, 'ERROR'):
+            self.assertEqual(self.find().status_code, 500)
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.find(types=['restaurant']).status_code, 400)
+        self.assertEqual(self.find(types='hospital').status_code, 400)
+        self.assertEqual(self.find(pages=4).status_code, 400)
+        self.assertEqual(self.find(limit=0).status_code, 400)
+        self.assertEqual(self.find(latitude=None).status_code, 400)
+
+
+def place(place_id, latitude, longitude=77.59):
+    return {'place_id': place_id, 'latitude': latitude, 'longitude': longitude}
+
+
+class PlaceIndexTests(SimpleTestCase):
+    def test_covered_needs_one_fresh_circle_around_the_query(self):
+        index = PlaceIndex(cell_degrees=0.05, max_age=600, max_places=100)
+        index.add_search([], 12.97, 77.59, 1000, 'hospital', exhausted=True)
+        self.assertTrue(index.covered(12.97, 77.59, 500, 'hospital'))
+        self.assertFalse(index.covered(12.97, 77.59, 1500, 'hospital'))
+        self.assertFalse(index.covered(12.97, 77.59, 500, 'doctor'))
+        with mock.patch('api.places_index.time.time', return_value=time.time() + 601):
+            self.assertFalse(index.covered(12.97, 77.59, 500, 'hospital'))
+            self.assertTrue(index.covered(12.97, 77.59, 500, 'hospital', max_age=math.inf))
+
+    def test_coverage_keeps_the_latest_circles(self):
+        coverage = Coverage(capacity=3)
+        for i in range(5):
+            coverage.add(12.0 + i, 77.0, 1000, searched_at=i)
+        self.assertEqual(len(coverage), 3)
+        self.assertFalse(coverage.contains(13.0, 77.0, 10, since=0))
+        self.assertTrue(coverage.contains(16.0, 77.0, 10, since=0))
+        coverage.expire(searched_until=3)
+        self.assertEqual(len(coverage), 1)
+        self.assertFalse(coverage.contains(15.0, 77.0, 10, since=0))
+        coverage.add(17.0, 77.0, 1000, searched_at=5)
+        self.assertTrue(coverage.contains(16.0, 77.0, 10, since=0))
+        self.assertTrue(coverage.contains(17.0, 77.0, 10, since=0))
+
+    def test_compaction_expires_the_circles_of_dropped_places(self):
+        index = PlaceIndex(cell_degrees=0.05, max_age=600, max_places=4)
+        with mock.patch('api.places_index.time.time', side_effect=[100, 200, 300]):
+            index.add_search([place('a', 12.0), place('b', 12.001)], 12.0, 77.59, 500, 'hospital', exhausted=True)
+            index.add_search([place('c', 13.0), place('d', 13.001)], 13.0, 77.59, 500, 'hospital', exhausted=True)
+            # Full: half of the places, those seen at 100, make room for this one
+            index.add_search([place('e', 14.0)], 14.0, 77.59, 500, 'hospital', exhausted=True)
+        self.assertEqual(index.stats()['places'], 3)
+        covered = [index.covered(latitude, 77.59, 100, 'hospital', max_age=math.inf) for latitude in (12.0, 13.0, 14.0)]
+        self.assertEqual(covered, [False, True, True])
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('condition not met in time')
+        time.sleep(0.001)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MedicineJobQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = MedicineJobQueue(workers=1, max_pending=2, result_ttl=60)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def blocked(self, value):
+        self.release.wait(5)
+        return value
+
+    def test_lifecycle(self):
+        running = self.queue.submit(self.blocked, 'first')
+        self.assertEqual(running['state'], 'queued')
+        wait_until(lambda: self.queue.get(running['job_id'])['state'] == 'running')
+        queued = self.queue.submit(self.blocked, 'second')
+        self.assertIsNotNone(self.queue.get(running['job_id'])['started_at'])
+        self.assertEqual(self.queue.get(queued['job_id'])['state'], 'queued')
+        self.assertEqual(self.queue.stats()['queue_depth'], 1)
+
+        self.release.set()
+        wait_until(lambda: self.queue.get(queued['job_id'])['state'] == 'done')
+        job = self.queue.get(running['job_id'])
+        self.assertEqual((job['state'], job['result']), ('done', 'first'))
+        self.assertLessEqual(job['submitted_at'], job['started_at'])
+        self.assertLessEqual(job['started_at'], job['finished_at'])
+        self.assertEqual(self.queue.get(queued['job_id'])['result'], 'second')
+        stats = self.queue.stats()
+        self.assertEqual((stats['queue_depth'], stats['running'], stats['completed']), (0, 0, 2))
+
+    def test_failed_job(self):
+        def fail():
+            raise ValueError('no catalog')
+
+        job = self.queue.submit(fail)
+        wait_until(lambda: self.queue.get(job['job_id'])['state'] == 'failed')
+        self.assertEqual(self.queue.get(job['job_id'])['result'], {'status': 'error', 'message': 'no catalog'})
+        self.assertEqual(self.queue.stats()['failed'], 1)
+
+    def test_full_queue_rejects(self):
+        self.queue.submit(self.blocked, 1)
+        wait_until(lambda: self.queue.stats()['running'] == 1)
+        self.queue.submit(self.blocked, 2)
+        self.queue.submit(self.blocked, 3)
+        with self.assertRaises(QueueFullError):
+            self.queue.submit(self.blocked, 4)
+        self.assertEqual(self.queue.stats()['rejected'], 1)
+        # Room again once the queued jobs start
+        self.release.set()
+        wait_until(lambda: self.queue.stats()['queue_depth'] == 0)
+        self.queue.submit(self.blocked, 5)
+
+
+def fixture_engine():
+    """An engine on the test catalog, answering from the stand-in vision fixture."""
+    engine = MedicineEngine()
+    engine.analyzer = MedicineAnalyzer(extractor=StandInExtractor(), db_path=TEST_CATALOG_PATH)
+    return engine
+
+
+@override_settings(MEDICINE_CATALOG_RELOAD_INTERVAL=0)
+class CatalogHotReloadTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.csv_path = os.path.join(tmp_dir, 'catalog.csv')
+        shutil.copy(TEST_CATALOG_PATH, self.csv_path)
+        self.engine = MedicineEngine()
+        self.engine.analyzer = MedicineAnalyzer(extractor=StandInExtractor(), db_path=self.csv_path)
+
+    def write_csv(self, text):
+        with open(self.csv_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        # Settled: older than the window in which a CSV may still be being written
+        settled_at = time.time() - 60
+        os.utime(self.csv_path, (settled_at, settled_at))
+
+    def test_changed_csv_is_swapped_in(self):
+        old_catalog = self.engine.catalog
+        self.assertFalse(self.engine.reload_catalog_if_changed())
+        with open(self.csv_path, encoding='utf-8') as f:
+            text = f.read()
+        self.write_csv(text.replace('Dolo Syrup', 'Dolo Kid Syrup'))
+
+        self.assertTrue(self.engine.reload_catalog_if_changed())
+        catalog = self.engine.catalog
+        self.assertNotEqual(catalog.version, old_catalog.version)
+        self.assertEqual(catalog.medicine(29)['brand_name'], 'Dolo Kid Syrup')
+        # Requests still holding the old catalog keep reading it unchanged
+        self.assertEqual(old_catalog.medicine(29)['brand_name'], 'Dolo Syrup')
+        self.assertEqual(self.engine.catalog_reloads['reloads'], 1)
+
+        # The same content again (a touch or copy) is not a new version
+        self.write_csv(text.replace('Dolo Syrup', 'Dolo Kid Syrup'))
+        self.assertFalse(self.engine.reload_catalog_if_changed())
+        self.assertEqual(self.engine.catalog.version, catalog.version)
+
+    def test_failed_reload_keeps_the_loaded_catalog(self):
+        version = self.engine.catalog.version
+        self.write_csv('')
+        with self.assertLogs('api.medicine_engine', 'ERROR'):
+            self.assertFalse(self.engine.reload_catalog_if_changed())
+        self.assertEqual(self.engine.catalog.version, version)
+        self.assertEqual(self.engine.catalog_reloads['failures'], 1)
+
+
+@override_settings(MEDICINE_CATALOG_RELOAD_INTERVAL=0)
+class MedicineCatalogTestCase(SimpleTestCase):
+    """Catalog endpoints against fixture_engine()."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.engine = fixture_engine()
+
+    def setUp(self):
+        patcher = mock.patch.object(views, 'get_engine', return_value=self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class MedicineSearchTests(MedicineCatalogTestCase):
+    def search(self, **params):
+        return self.client.get(reverse('search_medicines'), params)
+
+    def ids(self, response):
+        return [medicine['id'] for medicine in response.json()['results']]
+
+    def test_every_ingredient_must_match(self):
+        self.assertEqual(self.ids(self.search(q='Amoxycillin (500mg)')), [15, 82, 108, 172])
+        both = self.search(q='Amoxycillin (500mg), Clavulanic Acid (62.5mg)').json()
+        self.assertEqual(both['query'], [
+            {'salt': 'amoxycillin', 'strength': '500mg'}, {'salt': 'clavulanic acid', 'strength': '62.5mg'},
+        ])
+        self.assertEqual([medicine['id'] for medicine in both['results']], [82, 108, 172])
+        # The same query as salt and strength parameters, and with an encoded "+"
+        self.assertEqual(self.ids(self.search(q='Amoxycillin (500mg)', salt='Clavulanic Acid', strength='62.5 mg')), [82, 108, 172])
+        self.assertEqual(self.ids(self.search(q='Amoxycillin (500mg) + Clavulanic Acid (62.5mg)')), [82, 108, 172])
+
+    def test_strength_is_optional(self):
+        self.assertEqual(self.search(salt='Amoxycillin').json()['total'], 9)
+        self.assertEqual(self.search(salt='Amoxycillin', strength='250mg').json()['total'], 5)
+
+    def test_pages(self):
+        first = self.search(q='Paracetamol (325mg)', page_size=5).json()
+        self.assertEqual((first['total'], first['num_pages'], len(first['results'])), (13, 3, 5))
+        last = self.search(q='Paracetamol (325mg)', page_size=5, page=3).json()
+        self.assertEqual(len(last['results']), 3)
+        self.assertLess(first['results'][-1]['id'], last['results'][0]['id'])
+        self.assertEqual(self.search(q='Paracetamol (325mg)', page_size=5, page=4).json()['results'], [])
+
+    def test_unknown_salt_gets_suggestions(self):
+        response = self.search(q='Paracetmol, Ibuprofen').json()
+        self.assertEqual(response['total'], 0)
+        self.assertEqual(list(response['suggestions']), ['paracetmol'])
+        self.assertEqual(response['suggestions']['paracetmol'][0], 'paracetamol')
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.search().status_code, 400)
+        self.assertEqual(self.search(q='Paracetamol', page='two').status_code, 400)
+
+
+class MedicineAutocompleteTests(MedicineCatalogTestCase):
+    def autocomplete(self, **params):
+        return self.client.get(reverse('autocomplete_medicines'), params)
+
+    def test_prefix_completions(self):
+        response = self.autocomplete(q='dolo', limit=3).json()
+        self.assertEqual(response['source'], 'prefix')
+        self.assertEqual(response['results'], [
+            {'id': 29, 'name': 'Dolo Syrup', 'match': 'prefix'},
+            {'id': 179, 'name': 'Dolo Tablet', 'match': 'prefix'},
+            {'id': 5, 'name': 'Dolo Tablet ER', 'match': 'prefix'},
+        ])
+        self.assertEqual(response['catalog_version'], self.engine.catalog.version)
+
+    def test_fuzzy_fallback(self):
+        response = self.autocomplete(q='Dolo Tabelt').json()
+        self.assertEqual(response['source'], 'fuzzy')
+        self.assertEqual(response['results'][0], {'id': 179, 'name': 'Dolo Tablet', 'match': 'fuzzy'})
+        self.assertEqual(self.autocomplete(q='Dolo Tabelt', fuzzy='false').json()['results'], [])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.autocomplete().status_code, 400)
+        self.assertEqual(self.autocomplete(q='dolo', limit='ten').status_code, 400)
+
+
+@override_settings(MEDICINE_CACHE_ENABLED=False, MEDICINE_NEAR_DUPLICATE_ENABLED=False, CACHES=TEST_CACHES)
+class IdentifyMedicineTestCase(MedicineCatalogTestCase):
+    """Identify endpoints against fixture_engine(), with a job queue of its own."""
+
+    def setUp(self):
+        super().setUp()
+        self.job_queue = MedicineJobQueue(workers=1, max_pending=2, result_ttl=60)
+        patcher = mock.patch.object(views, 'get_job_queue', return_value=self.job_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def identify(self, image_path, **data):
+        with open(image_path, 'rb') as image:
+            return self.client.post(reverse('identify_medicine'), {'image': image, **data})
+
+    def wait_for_job(self, status_url):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            job = self.client.get(status_url).json()
+            if job['state'] in ('done', 'failed'):
+                return job
+            time.sleep(0.01)
+        self.fail('job did not finish')
+
+
+class IdentifySubstitutesTests(IdentifyMedicineTestCase):
+    def test_every_path_returns_substitutes(self):
+        sync = self.identify(TELMA_IMAGE, substitutes='3').json()
+        self.assertEqual(sync['status'], 'success')
+        self.assertEqual(len(sync['substitutes']), 3)
+
+        queued = self.identify(TELMA_IMAGE, substitutes='3', **{'async': '1'})
+        self.assertEqual(queued.status_code, 202)
+        self.assertEqual(self.wait_for_job(queued.json()['status_url'])['result'], sync)
+
+        with open(TELMA_IMAGE, 'rb') as image:
+            batch = self.client.post(reverse('identify_medicine_batch'), {'images': [image], 'substitutes': '3'}).json()
+        self.assertEqual(batch['results'][0]['result'], sync)
+
+    def test_no_substitutes_unless_asked(self):
+        self.assertNotIn('substitutes', self.identify(TELMA_IMAGE).json())
+        queued = self.identify(TELMA_IMAGE, **{'async': '1'})
+        self.assertNotIn('substitutes', self.wait_for_job(queued.json()['status_url'])['result'])
+
+
+class IdentifyBatchTests(IdentifyMedicineTestCase):
+    def batch(self, *image_paths, extra=(), **data):
+        images = [open(image_path, 'rb') for image_path in image_paths]
+        try:
+            return self.client.post(reverse('identify_medicine_batch'), {'images': images + list(extra), **data})
+        finally:
+            for image in images:
+                image.close()
+
+    def test_one_bad_upload_does_not_fail_the_batch(self):
+        not_an_image = SimpleUploadedFile('notes.txt', b'not an image', content_type='text/plain')
+        response = self.batch(TELMA_IMAGE, OMEZ_IMAGE, extra=[not_an_image])
+        self.assertEqual(response.status_code, 200)
+        batch = response.json()
+        self.assertEqual((batch['status'], batch['count'], batch['succeeded']), ('success', 3, 2))
+        self.assertEqual([item['index'] for item in batch['results']], [0, 1, 2])
+        self.assertEqual([item['filename'] for item in batch['results']], ['images03.jpg', 'images04.jpg', 'notes.txt'])
+        telma, omez, notes = (item['result'] for item in batch['results'])
+        self.assertEqual(telma, self.identify(TELMA_IMAGE).json())
+        self.assertEqual(omez, self.identify(OMEZ_IMAGE).json())
+        self.assertEqual(notes['status'], 'error')
+
+    def test_one_failed_vision_call_does_not_fail_the_batch(self):
+        # Loaded first, so the batch request doesn't load the extractor over the patched one
+        self.engine.warm_up()
+        extractor = self.engine.analyzer.extractor
+        failing = dhash_image(preprocess_image(OMEZ_IMAGE).image)
+        request = extractor.request
+
+        def flaky_request(prepared, timeout=None):
+            if dhash_image(prepared.image) == failing:
+                raise ConnectionError('vision API unavailable')
+            return request(prepared, timeout)
+
+        with mock.patch.object(extractor, 'request', side_effect=flaky_request):
+            batch = self.batch(OMEZ_IMAGE, TELMA_IMAGE).json()
+        self.assertEqual((batch['count'], batch['succeeded']), (2, 1))
+        omez, telma = (item['result'] for item in batch['results'])
+        self.assertEqual(omez['status'], 'error')
+        self.assertIn('vision API unavailable', omez['message'])
+        self.assertEqual(telma['status'], 'success')
+
+    @override_settings(MEDICINE_BATCH_MAX_IMAGES=1)
+    def test_invalid_batches(self):
+        self.assertEqual(self.client.post(reverse('identify_medicine_batch')).status_code, 400)
+        self.assertEqual(self.batch(TELMA_IMAGE, OMEZ_IMAGE).status_code, 400)
+
+
+class IdentifyJobTests(IdentifyMedicineTestCase):
+    def test_job_lifecycle(self):
+        queued = self.identify(TELMA_IMAGE, **{'async': 'true'})
+        self.assertEqual(queued.status_code, 202)
+        body = queued.json()
+        self.assertEqual(body['status'], 'queued')
+        self.assertTrue(body['status_url'].endswith(reverse('identify_medicine_job', args=[body['job_id']])))
+        job = self.wait_for_job(body['status_url'])
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['result'], self.identify(TELMA_IMAGE).json())
+        self.assertGreaterEqual(job['wait_seconds'], 0)
+
+    def test_full_queue_returns_503(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        # One job running and two queued fill a queue of one worker and max_pending=2
+        self.job_queue.submit(release.wait, 5)
+        wait_until(lambda: self.job_queue.stats()['running'] == 1)
+        self.job_queue.submit(release.wait, 5)
+        self.job_queue.submit(release.wait, 5)
+        response = self.identify(TELMA_IMAGE, **{'async': '1'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['status'], 'error')
+        # The synchronous path doesn't use the queue
+        self.assertEqual(self.identify(TELMA_IMAGE).json()['status'], 'success')
+
+    def test_unknown_job(self):
+        response = self.client.get(reverse('identify_medicine_job', args=['missing']))
+        self.assertEqual(response.status_code, 404)
+
+
+class IdentifyResultCacheTests(IdentifyMedicineTestCase):
+    def setUp(self):
+        super().setUp()
+        self.result_cache = MedicineResultCache(['medicine_results'], timeout=60)
+        self.addCleanup(caches['medicine_results'].clear)
+        patcher = mock.patch.object(views, 'get_result_cache', return_value=self.result_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data, name='scan.jpg'):
+        return self.client.post(reverse('identify_medicine'), {'image': SimpleUploadedFile(name, data, content_type='image/jpeg')})
+
+    def test_replay_is_a_hit(self):
+        first = self.identify(TELMA_IMAGE)
+        self.assertEqual((first.status_code, first['X-Cache']), (200, 'MISS'))
+        replay = self.identify(TELMA_IMAGE)
+        self.assertEqual((replay.status_code, replay['X-Cache']), (200, 'HIT'))
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(self.identify(OMEZ_IMAGE)['X-Cache'], 'MISS')
+
+    def test_rewritten_metadata_is_a_hit(self):
+        jpeg = TELMA_IMAGE.read_bytes()
+        self.assertEqual(self.upload(jpeg)['X-Cache'], 'MISS')
+        resaved = with_segments(jpeg, jpeg_segment(0xE1, b'Exif\x00\x00re-saved'))
+        self.assertEqual(self.upload(resaved)['X-Cache'], 'HIT')
+
+    def test_errors_are_not_cached(self):
+        for _ in range(2):
+            response = self.upload(b'not an image')
+            self.assertEqual((response['X-Cache'], response.json()['status']), ('MISS', 'error'))
+        self.assertEqual(self.result_cache.stats()['misses'], 2)
@@ -0,0 +1,43 @@
+"""
+Zero-copy access to uploaded files.
+
+Django keeps uploads up to FILE_UPLOAD_MAX_MEMORY_SIZE in a BytesIO and spools
+larger ones to a temporary file. Both can be read in place: the BytesIO through
+its buffer and the temporary file through mmap, so hashing an upload never
+copies it, and PIL can decode straight from the upload object.
+"""
+
+import io
+import mmap
+from contextlib import contextmanager
+
+
+@contextmanager
+def upload_buffer(upload):
+    """Yield a read-only bytes-like view of `upload` without copying it."""
+    if hasattr(upload, 'temporary_file_path'):
+        with open(upload.temporary_file_path(), 'rb') as f:
+            if upload.size == 0:
+                yield b''
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+    elif isinstance(upload.file, io.BytesIO):
+        view = upload.file.getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+    else:
+        upload.seek(0)
+        yield upload.read()
+
+
+def rewind(upload):
+    """Seek the upload back to the start so it can be decoded (again) in place."""
+    upload.seek(0)
+    return upload
@@ -0,0 +1,146 @@
+"""
+Shared outbound HTTP client for calls to Google APIs.
+
+Every upstream gets one long-lived requests.Session per process, so connections
+(and their TLS sessions) are kept alive in a per-host pool instead of being opened
+for every request. Requests get connect/read timeouts, idempotent requests are
+retried a bounded number of times with jittered exponential backoff, and each
+upstream keeps latency and error counters for /api/health/.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from django.conf import settings
+from google.auth.transport import requests as google_requests
+from requests.adapters import HTTPAdapter
+
+from .single_flight import get_single_flight
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+MAX_BACKOFF_SECONDS = 2.0
+
+
+class UpstreamSession(requests.Session):
+    """
+    A requests.Session with pooled keep-alive connections, timeouts, retries and metrics.
+    The configured timeouts are upper bounds: a caller may pass shorter ones, not longer.
+    """
+
+    def __init__(self, name, connect_timeout, read_timeout, max_retries, backoff_seconds, pool_size):
+        super().__init__()
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.latencies = deque(maxlen=1000)
+        self.counts = {'requests': 0, 'attempts': 0, 'retries': 0, 'timeouts': 0, 'connection_errors': 0, 'http_errors': 0}
+        self._lock = threading.Lock()
+
+    def _timeout(self, requested):
+        if requested is None:
+            return (self.connect_timeout, self.read_timeout)
+        connect, read = requested if isinstance(requested, tuple) else (requested, requested)
+        return (min(connect or self.connect_timeout, self.connect_timeout), min(read or self.read_timeout, self.read_timeout))
+
+    def _count(self, *keys):
+        with self._lock:
+            for key in keys:
+                self.counts[key] += 1
+
+    def backoff(self, attempt):
+        """Full jitter: a random delay up to the exponential backoff for this attempt."""
+        return random.uniform(0, min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        kwargs['timeout'] = self._timeout(kwargs.get('timeout'))
+        retryable = method.upper() in IDEMPOTENT_METHODS
+        self._count('requests')
+        attempt = 0
+        while True:
+            self._count('attempts')
+            start_time = time.perf_counter()
+            try:
+                response = super().request(method, url, **kwargs)
+            except requests.Timeout:
+                self._count('timeouts')
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            except requests.ConnectionError:
+                self._count('connection_errors')
+                if not retryable or attempt >= self.max_retries:
+                    raise
+            else:
+                self.latencies.append((time.perf_counter() - start_time) * 1000)
+                if response.status_code < 400:
+                    return response
+                self._count('http_errors')
+                if response.status_code not in RETRY_STATUSES or not retryable or attempt >= self.max_retries:
+                    return response
+                response.close()
+            self._count('retries')
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def stats(self):
+        ordered = sorted(self.latencies)
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            **counts,
+            'p50_ms': round(ordered[len(ordered) // 2], 2) if ordered else None,
+            'p95_ms': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 2) if ordered else None,
+            'timeouts_seconds': [self.connect_timeout, self.read_timeout],
+        }
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_upstream_session(name):
+    """Return the per-process session for the upstream `name` (e.g. 'places'), creating it on first use."""
+    session = _sessions.get(name)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = UpstreamSession(
+                    name,
+                    connect_timeout=settings.UPSTREAM_CONNECT_TIMEOUT,
+                    read_timeout=settings.UPSTREAM_READ_TIMEOUT,
+                    max_retries=settings.UPSTREAM_MAX_RETRIES,
+                    backoff_seconds=settings.UPSTREAM_BACKOFF_SECONDS,
+                    pool_size=settings.UPSTREAM_POOL_SIZE,
+                )
+                _sessions[name] = session
+    return session
+
+
+class CoalescingGoogleRequest(google_requests.Request):
+    """
+    google-auth transport on an upstream session. Concurrent identical GETs, such as
+    every login in a burst fetching Google's token certificates, share one fetch.
+    """
+
+    def __call__(self, url, method='GET', body=None, headers=None, timeout=None, **kwargs):
+        call = super().__call__
+        if method != 'GET' or body is not None:
+            return call(url, method, body, headers, timeout, **kwargs)
+        return get_single_flight('google_auth').do(url, call, url, method, body, headers, timeout, **kwargs)
+
+
+def google_auth_request():
+    return CoalescingGoogleRequest(session=get_upstream_session('google_auth'))
+
+
+def upstream_stats():
+    return {name: session.stats() for name, session in list(_sessions.items())}
@@ -6,11 +6,18 @@ urlpatterns = [
     path('api/health/', views.health_check, name='health_check'),
     path('api/find_hospitals/', views.find_hospitals, name='find_hospitals'),
     path('api/find_doctors/', views.find_doctors, name='find_doctors'),
+    path('api/find_healthcare/', views.find_healthcare, name='find_healthcare'),
     path('api/auth/google/', views.google_auth, name='google_auth'),
     path('api/auth/verify/', views.verify_token, name='verify_token'),
     path('api/auth/success/', views.auth_success, name='auth_success'),
     path('api/auth/logout/', views.auth_logout, name='auth_logout'),
     path('api/identify-medicine/', views.identify_medicine_view, name='identify_medicine'),
+    path('api/identify-medicine/batch/', views.identify_medicine_batch_view, name='identify_medicine_batch'),
+    path('api/identify-medicine/jobs/<str:job_id>/', views.identify_medicine_job_view, name='identify_medicine_job'),
+    path('api/identify-medicine/ready/', views.medicine_engine_ready, name='medicine_engine_ready'),
+    path('api/medicines/search/', views.search_medicines_view, name='search_medicines'),
+    path('api/medicines/substitutes/', views.medicine_substitutes_view, name='medicine_substitutes'),
+    path('api/medicines/autocomplete/', views.autocomplete_medicines_view, name='autocomplete_medicines'),
     
     # Vault System URLs
     path('api/vault/create-session/', views.create_doctor_session, name='create_doctor_session'),
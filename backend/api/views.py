@@ -1,27 +1,32 @@
-import requests
 import jwt
 from datetime import datetime, timedelta
 from django.http import HttpResponse, JsonResponse
 from django.conf import settings
-from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
-from django.shortcuts import redirect
+from django.urls import reverse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 import logging
 from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-import subprocess
+import io
 import json
-import os
-import uuid
+import time
 from .models import DoctorSession, PatientVaultData
+from .medicine_engine import get_engine
+# ml/ is on sys.path once medicine_engine is imported
+from image_preprocessing import dhash
+from medicine_ingredients import parse_ingredients
+from .medicine_cache import get_result_cache, image_digest
+from .medicine_near_duplicates import get_near_duplicate_index
+from .medicine_jobs import QueueFullError, get_job_queue, job_queue_stats
+from .places import PlacesAPIError, get_places_cache, nearby_places, search_healthcare
+from .places_index import get_place_index
+from .single_flight import get_single_flight, single_flight_stats
+from .upstream import google_auth_request, upstream_stats
+from .uploads import rewind, upload_buffer
 from django.views.decorators.http import require_http_methods
-import sys
 
 logger = logging.getLogger(__name__)
 
@@ -34,15 +39,37 @@ def health_check(request):
     return JsonResponse({
         "status": "healthy",
         "message": "Healthcare API is running",
-        "django_version": "5.1.7"
+        "django_version": "5.1.7",
+        "medicine_engine": get_engine().health(),
+        "medicine_result_cache": get_result_cache().stats() if get_result_cache() else None,
+        "medicine_near_duplicates": get_near_duplicate_index().stats() if get_near_duplicate_index() else None,
+        "medicine_jobs": job_queue_stats(),
+        "places_cache": get_places_cache().stats() if get_places_cache() else None,
+        "places_index": get_place_index().stats() if get_place_index() else None,
+        "upstreams": upstream_stats(),
+        "single_flight": single_flight_stats()
     })
 
-@api_view(['POST'])
-def find_hospitals(request):
-    """
-    Find nearby hospitals using Google Places API
-    Expected payload: {"latitude": float, "longitude": float, "radius": int (optional)}
-    """
+@api_view(['GET'])
+def medicine_engine_ready(request):
+    """Readiness probe: 200 once the medicine engine is warmed up, 503 before"""
+    engine = get_engine()
+    if engine.state in (engine.COLD, engine.FAILED):
+        # A cold instance gets no traffic until it is ready, so the probe itself starts the warm-up
+        engine.warm_up_in_background()
+    return JsonResponse(engine.health(), status=200 if engine.is_ready else 503)
+
+def _place_limit(request):
+    """The optional "limit" (k nearest places) of a finder request; raises ValueError when invalid"""
+    limit = request.data.get('limit')
+    if limit is None:
+        return None
+    limit = int(limit)
+    if limit <= 0:
+        raise ValueError(limit)
+    return limit
+
+def _find_places(request, place_type, result_key):
     try:
         latitude = request.data.get('latitude')
         longitude = request.data.get('longitude')
@@ -53,135 +80,117 @@ def find_hospitals(request):
                 {"error": "Latitude and longitude are required"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        # Google Places API Nearby Search
-        url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        params = {
-            'location': f"{latitude},{longitude}",
-            'radius': radius,
-            'type': 'hospital',
-            'key': settings.GOOGLE_PLACES_API_KEY
-        }
-        
-        response = requests.get(url, params=params)
-        
-        if response.status_code != 200:
-            logger.error(f"Google Places API error: {response.status_code}")
+        try:
+            limit = _place_limit(request)
+        except (TypeError, ValueError):
             return Response(
-                {"error": "Failed to fetch hospital data"}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": "limit must be a positive integer"}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
         
-        data = response.json()
-        
-        if data.get('status') != 'OK':
-            logger.error(f"Google Places API status: {data.get('status')}")
+        # The local place index, or a Google Places API Nearby Search shared by nearby callers through the places cache
+        try:
+            places, next_page_token, source = nearby_places(float(latitude), float(longitude), int(radius), place_type, limit=limit)
+        except PlacesAPIError as e:
+            logger.error(f"Google Places API error: {str(e)}")
+            message = f"Google Places API error: {e.places_status}" if e.places_status else f"Failed to fetch {place_type} data"
             return Response(
-                {"error": f"Google Places API error: {data.get('status')}"}, 
+                {"error": message}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
-        # Format the response
-        hospitals = []
-        for place in data.get('results', []):
-            hospital = {
-                'place_id': place.get('place_id'),
-                'name': place.get('name'),
-                'address': place.get('vicinity'),
-                'rating': place.get('rating'),
-                'user_ratings_total': place.get('user_ratings_total'),
-                'latitude': place.get('geometry', {}).get('location', {}).get('lat'),
-                'longitude': place.get('geometry', {}).get('location', {}).get('lng'),
-                'opening_hours': place.get('opening_hours', {}).get('open_now'),
-                'price_level': place.get('price_level'),
-                'types': place.get('types', []),
-                'photos': [photo.get('photo_reference') for photo in place.get('photos', [])][:3]  # First 3 photos
-            }
-            hospitals.append(hospital)
-        
         return Response({
-            'hospitals': hospitals,
-            'count': len(hospitals),
-            'next_page_token': data.get('next_page_token')
+            result_key: places,
+            'count': len(places),
+            'next_page_token': next_page_token,
+            'source': source
         })
         
     except Exception as e:
-        logger.error(f"Error in find_hospitals: {str(e)}")
+        logger.error(f"Error in find_{result_key}: {str(e)}")
         return Response(
             {"error": "Internal server error"}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
+@api_view(['POST'])
+def find_hospitals(request):
+    """
+    Find nearby hospitals using Google Places API, nearest first
+    Expected payload: {"latitude": float, "longitude": float, "radius": int (optional), "limit": int (optional)}
+    """
+    return _find_places(request, 'hospital', 'hospitals')
+
 @api_view(['POST'])
 def find_doctors(request):
     """
-    Find nearby doctors using Google Places API
-    Expected payload: {"latitude": float, "longitude": float, "radius": int (optional)}
+    Find nearby doctors using Google Places API, nearest first
+    Expected payload: {"latitude": float, "longitude": float, "radius": int (optional), "limit": int (optional)}
+    """
+    return _find_places(request, 'doctor', 'doctors')
+
+@api_view(['POST'])
+def find_healthcare(request):
+    """
+    Find nearby places of several types in one request, searched concurrently, nearest first
+    Expected payload: {"latitude": float, "longitude": float, "radius": int (optional),
+                       "types": ["hospital", "doctor", ...] (optional), "pages": int (optional, 1-3),
+                       "limit": int (optional)}
     """
     try:
         latitude = request.data.get('latitude')
         longitude = request.data.get('longitude')
         radius = request.data.get('radius', 5000)  # Default 5km radius
+        place_types = request.data.get('types') or settings.HEALTHCARE_DEFAULT_PLACE_TYPES
         
         if not latitude or not longitude:
             return Response(
                 {"error": "Latitude and longitude are required"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        # Google Places API Nearby Search
-        url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-        params = {
-            'location': f"{latitude},{longitude}",
-            'radius': radius,
-            'type': 'doctor',
-            'key': settings.GOOGLE_PLACES_API_KEY
-        }
-        
-        response = requests.get(url, params=params)
-        
-        if response.status_code != 200:
-            logger.error(f"Google Places API error: {response.status_code}")
+        if not isinstance(place_types, list) or any(place_type not in settings.HEALTHCARE_PLACE_TYPES for place_type in place_types):
             return Response(
-                {"error": "Failed to fetch doctor data"}, 
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                {"error": f"types must be a list of: {', '.join(settings.HEALTHCARE_PLACE_TYPES)}"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            pages = int(request.data.get('pages', 1))
+        except (TypeError, ValueError):
+            pages = 0
+        if not 1 <= pages <= settings.PLACES_MAX_PAGES:
+            return Response(
+                {"error": f"pages must be between 1 and {settings.PLACES_MAX_PAGES}"}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            limit = _place_limit(request)
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "limit must be a positive integer"}, 
+                status=status.HTTP_400_BAD_REQUEST
             )
         
-        data = response.json()
-        
-        if data.get('status') != 'OK':
-            logger.error(f"Google Places API status: {data.get('status')}")
+        place_types = list(dict.fromkeys(place_types))
+        places, errors, sources = search_healthcare(float(latitude), float(longitude), int(radius), place_types, pages, limit)
+        for place_type, error in errors.items():
+            logger.error(f"Google Places API error for {place_type}: {str(error)}")
+        if len(errors) == len(place_types):
             return Response(
-                {"error": f"Google Places API error: {data.get('status')}"}, 
+                {"error": "Failed to fetch healthcare data"}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
         
-        # Format the response
-        doctors = []
-        for place in data.get('results', []):
-            doctor = {
-                'place_id': place.get('place_id'),
-                'name': place.get('name'),
-                'address': place.get('vicinity'),
-                'rating': place.get('rating'),
-                'user_ratings_total': place.get('user_ratings_total'),
-                'latitude': place.get('geometry', {}).get('location', {}).get('lat'),
-                'longitude': place.get('geometry', {}).get('location', {}).get('lng'),
-                'opening_hours': place.get('opening_hours', {}).get('open_now'),
-                'price_level': place.get('price_level'),
-                'types': place.get('types', []),
-                'photos': [photo.get('photo_reference') for photo in place.get('photos', [])][:3]  # First 3 photos
-            }
-            doctors.append(doctor)
-        
         return Response({
-            'doctors': doctors,
-            'count': len(doctors),
-            'next_page_token': data.get('next_page_token')
+            'places': places,
+            'count': len(places),
+            'types': place_types,
+            'sources': sources,
+            # Types whose search failed; the others are still returned
+            'errors': {place_type: f"Google Places API error: {error.places_status or 'request failed'}" for place_type, error in errors.items()}
         })
         
     except Exception as e:
-        logger.error(f"Error in find_doctors: {str(e)}")
+        logger.error(f"Error in find_healthcare: {str(e)}")
         return Response(
             {"error": "Internal server error"}, 
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -207,7 +216,7 @@ def google_auth(request):
         try:
             idinfo = id_token.verify_oauth2_token(
                 token, 
-                google_requests.Request(), 
+                google_auth_request(), 
                 settings.GOOGLE_OAUTH2_CLIENT_ID
             )
             
@@ -333,49 +342,327 @@ def auth_logout(request):
         'message': 'Logged out successfully'
     })
 
+def _lookup_identification(engine, image_file):
+    """
+    Look an upload up in the result cache, then in the near-duplicate index.
+    Returns a dict with the cached 'result' (or None), the 'cache' outcome and
+    the keys needed to store a fresh result with _store_identification.
+    """
+    lookup = {'result': None, 'cache': None, 'distance': None, 'cache_key': None, 'image_hash': None, 'image_digest': None}
+    if not engine.warm_up():
+        return lookup
+    with upload_buffer(image_file) as image_data:
+        lookup['image_digest'] = image_digest(image_data)
+
+    # Replays of the same image are answered from the result cache
+    result_cache = get_result_cache()
+    if result_cache is not None:
+        lookup['cache_key'] = result_cache.key(lookup['image_digest'], engine.catalog_version)
+        lookup['result'] = result_cache.get(lookup['cache_key'])
+        lookup['cache'] = 'MISS'
+        if lookup['result'] is not None:
+            lookup['cache'] = 'HIT'
+            return lookup
+
+    # Rescans of the same box (new angle, crop or re-encode) are answered by a near-duplicate
+    near_duplicates = get_near_duplicate_index()
+    if near_duplicates is not None:
+        try:
+            lookup['image_hash'] = dhash(rewind(image_file))
+        except Exception:
+            return lookup  # Not a readable image; the analysis reports the error
+        match = near_duplicates.lookup(lookup['image_hash'], engine.catalog_version)
+        if match is not None:
+            lookup['distance'], lookup['result'] = match
+            lookup['cache'] = 'NEAR-HIT'
+            if result_cache is not None:
+                result_cache.set(lookup['cache_key'], lookup['result'])
+    return lookup
+
+
+def _store_identification(engine, lookup, result):
+    if lookup['cache_key'] is not None:
+        get_result_cache().set(lookup['cache_key'], result)
+    if lookup['image_hash'] is not None:
+        get_near_duplicate_index().add(lookup['image_hash'], engine.catalog_version, result)
+
+
+def _analyze_and_store(engine, lookup, image_file):
+    if lookup['image_digest'] is None:
+        return engine.analyze(rewind(image_file))
+    # The same image uploaded again while its analysis is running waits for that analysis
+    return get_single_flight('identify_medicine').do(
+        f"{engine.catalog_version}:{lookup['image_digest']}", _analyze_and_store_once, engine, lookup, image_file
+    )
+
+
+def _analyze_and_store_once(engine, lookup, image_file):
+    result = engine.analyze(rewind(image_file))
+    _store_identification(engine, lookup, result)
+    return result
+
+
+def _substitutes(catalog, row_id, limit, cheaper_only=True):
+    """Price-sorted substitutes of a catalog row, each with its saving over that row"""
+    groups = catalog.substitutes
+    rows = groups.cheaper(row_id, limit) if cheaper_only else groups.alternatives(row_id, limit)
+    base_price = catalog.medicine(row_id)['price_inr']
+    substitutes = []
+    for row in rows:
+        medicine = catalog.medicine(int(row))
+        if isinstance(base_price, float) and isinstance(medicine['price_inr'], float):
+            medicine['savings_inr'] = round(base_price - medicine['price_inr'], 2)
+        substitutes.append(medicine)
+    return substitutes
+
+
+def _substitutes_limit(request):
+    """K when the request sends substitutes=K (capped), otherwise None"""
+    limit = request.POST.get('substitutes', request.GET.get('substitutes'))
+    if not limit:
+        return None
+    try:
+        return min(int(limit), settings.MEDICINE_SUBSTITUTES_MAX_LIMIT)
+    except ValueError:
+        return None
+
+
+def _with_substitutes(engine, result, limit):
+    """Add the cheapest `limit` substitutes (see _substitutes_limit) to a successful identification"""
+    if not limit or result.get('status') != 'success' or 'id' not in result.get('data', {}):
+        return result
+    catalog = engine.catalog
+    # Row ids are only meaningful in the catalog version that produced them
+    if catalog is None or limit <= 0 or result.get('catalog_version') != catalog.version:
+        return result
+    # A copy: cached results are shared and stay without substitutes
+    return {**result, 'substitutes': _substitutes(catalog, result['data']['id'], limit)}
+
+
 @csrf_exempt # For development only. Use token authentication for production.
 def identify_medicine_view(request):
     if request.method != 'POST' or not request.FILES.get('image'):
         return JsonResponse({'status': 'error', 'message': 'Invalid request'}, status=400)
 
+    # The upload is hashed and decoded in place: no temp file, no extra copies
     image_file = request.FILES['image']
-    
-    # Save the uploaded file to a temporary location
-    temp_path = default_storage.save(f'tmp/{image_file.name}', ContentFile(image_file.read()))
-    uploaded_file_path = os.path.join(settings.MEDIA_ROOT, temp_path)
+    engine = get_engine()
+
+    lookup = _lookup_identification(engine, image_file)
+    if lookup['result'] is not None:
+        response = JsonResponse(_with_substitutes(engine, lookup['result'], _substitutes_limit(request)))
+        response['X-Cache'] = lookup['cache']
+        if lookup['distance'] is not None:
+            response['X-Near-Duplicate-Distance'] = str(lookup['distance'])
+        return response
+
+    # Async mode: queue the analysis and return a job id instead of waiting on the vision API
+    if request.POST.get('async', request.GET.get('async', '')).lower() in ('1', 'true'):
+        job_queue = get_job_queue()
+        try:
+            # The upload is gone once this request returns, so the job keeps its own copy
+            job_image = io.BytesIO(rewind(image_file).read())
+            job = job_queue.submit(_identify_job, engine, lookup, job_image, _substitutes_limit(request))
+        except QueueFullError as e:
+            return JsonResponse({'status': 'error', 'message': f'Identification queue is full ({e})'}, status=503)
+        return JsonResponse({
+            'status': 'queued',
+            'job_id': job['job_id'],
+            'status_url': request.build_absolute_uri(reverse('identify_medicine_job', args=[job['job_id']])),
+            'queue_depth': job_queue.stats()['queue_depth'],
+        }, status=202)
 
     try:
-        # Define paths for the subprocess
-        # Assumes the 'ml' folder is at the same level as the 'backend' folder
-        project_root = settings.BASE_DIR.parent
-        script_path = os.path.join(project_root, 'ml', 'analyze_medicine.py')
-        
-        # Use sys.executable to ensure we use the same Python interpreter
-        # that is running Django
-        python_executable = sys.executable
-
-        # Execute the script
-        result = subprocess.run(
-            [python_executable, script_path, uploaded_file_path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        response_data = json.loads(result.stdout)
-        
-    except subprocess.CalledProcessError as e:
-        # Error from within the Python script
-        error_details = e.stderr or result.stdout
-        response_data = {'status': 'error', 'message': 'Analysis script failed', 'details': error_details}
+        # Analyze in-process with the resident engine (loaded once per worker)
+        response_data = _with_substitutes(engine, _analyze_and_store(engine, lookup, image_file), _substitutes_limit(request))
     except Exception as e:
         response_data = {'status': 'error', 'message': str(e)}
-    finally:
-        # Clean up the temporary file
-        default_storage.delete(temp_path)
 
+    response = JsonResponse(response_data)
+    if lookup['cache'] is not None:
+        response['X-Cache'] = lookup['cache']
+    return response
+
+
+def _identify_job(engine, lookup, image_file, substitutes_limit):
+    """An async identification: the result the synchronous path would have returned"""
+    return _with_substitutes(engine, _analyze_and_store(engine, lookup, image_file), substitutes_limit)
+
+
+@api_view(['GET'])
+def identify_medicine_job_view(request, job_id):
+    """Status of an async identify-medicine job; 'result' is set once the job is done"""
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return JsonResponse({'status': 'error', 'message': 'Unknown or expired job'}, status=404)
+    started_at = job['started_at'] or time.time()
+    job['wait_seconds'] = round(started_at - job['submitted_at'], 3)
+    return JsonResponse(job)
+
+
+@csrf_exempt # For development only. Use token authentication for production.
+def identify_medicine_batch_view(request):
+    """
+    Identify several medicine images in one request.
+    Expected multipart payload: one or more files under "images".
+    Results come back in upload order; each item has its own status.
+    """
+    image_files = request.FILES.getlist('images')
+    if request.method != 'POST' or not image_files:
+        return JsonResponse({'status': 'error', 'message': 'Invalid request'}, status=400)
+    if len(image_files) > settings.MEDICINE_BATCH_MAX_IMAGES:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'At most {settings.MEDICINE_BATCH_MAX_IMAGES} images per batch'
+        }, status=400)
+
+    engine = get_engine()
+    items = []
+    pending = []
+    for index, image_file in enumerate(image_files):
+        lookup = _lookup_identification(engine, image_file)
+        items.append({'index': index, 'filename': image_file.name, 'cache': lookup['cache'], 'result': lookup['result']})
+        if lookup['result'] is None:
+            pending.append((index, image_file, lookup))
+
+    if pending:
+        try:
+            results = engine.analyze_many(
+                [rewind(image_file) for _, image_file, _ in pending],
+                max_workers=settings.MEDICINE_BATCH_CONCURRENCY,
+            )
+        except Exception as e:
+            results = [{'status': 'error', 'message': str(e)} for _ in pending]
+        for (index, _, lookup), result in zip(pending, results):
+            _store_identification(engine, lookup, result)
+            items[index]['result'] = result
+    substitutes_limit = _substitutes_limit(request)
+    for item in items:
+        item['result'] = _with_substitutes(engine, item['result'], substitutes_limit)
+
+    return JsonResponse({
+        'status': 'success',
+        'count': len(items),
+        'succeeded': sum(1 for item in items if item['result'].get('status') == 'success'),
+        'results': items,
+    })
+
+
+@api_view(['GET'])
+def search_medicines_view(request):
+    """
+    Medicines containing every requested ingredient, paginated.
+    Query string: q="Amoxycillin (500mg), Clavulanic Acid" (ingredients separated by ","
+    or an encoded "+") and/or salt=...&strength=..., plus page and page_size.
+    Strength is optional per ingredient.
+    """
+    ingredients = parse_ingredients(request.GET.get('q', ''))
+    if request.GET.get('salt'):
+        ingredients += parse_ingredients(f"{request.GET['salt']} ({request.GET.get('strength', '')})")
+    if not ingredients:
+        return JsonResponse({'status': 'error', 'message': 'Provide q or salt'}, status=400)
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = int(request.GET.get('page_size', settings.MEDICINE_SEARCH_PAGE_SIZE))
+        page_size = min(settings.MEDICINE_SEARCH_MAX_PAGE_SIZE, max(1, page_size))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'page and page_size must be integers'}, status=400)
+
+    engine = get_engine()
+    catalog = engine.catalog
+    if catalog is None:
+        return JsonResponse({'status': 'error', 'message': engine.error}, status=503)
+
+    start_time = time.time()
+    index = catalog.ingredient_index
+    rows = index.search(ingredients)
+    total = len(rows)
+    response_data = {
+        'status': 'success',
+        'query': [{'salt': salt, 'strength': strength} for salt, strength in ingredients],
+        'total': total,
+        'page': page,
+        'page_size': page_size,
+        'num_pages': (total + page_size - 1) // page_size,
+        'results': [catalog.medicine(int(row)) for row in rows[(page - 1) * page_size:page * page_size]],
+        'catalog_version': catalog.version,
+    }
+    if not total:
+        # Point at the likely spelling for salts the catalog doesn't know
+        response_data['suggestions'] = {
+            salt: index.suggest(salt) for salt, _ in ingredients if not len(index.postings(salt))
+        }
+    response_data['took_ms'] = round((time.time() - start_time) * 1000, 2)
     return JsonResponse(response_data)
 
 
+@api_view(['GET'])
+def medicine_substitutes_view(request):
+    """
+    Generic substitutes of a medicine: catalog rows with the same salts at the same strengths,
+    cheapest first. Query string: id (catalog row id) or name (exact brand name), limit,
+    and cheaper_only (default true; false lists same-composition medicines at any price).
+    """
+    engine = get_engine()
+    catalog = engine.catalog
+    if catalog is None:
+        return JsonResponse({'status': 'error', 'message': engine.error}, status=503)
+
+    try:
+        limit = int(request.GET.get('limit', settings.MEDICINE_SUBSTITUTES_LIMIT))
+        limit = min(settings.MEDICINE_SUBSTITUTES_MAX_LIMIT, max(1, limit))
+        row_id = int(request.GET['id']) if request.GET.get('id') else catalog.find_row('name', request.GET.get('name', ''))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'id and limit must be integers'}, status=400)
+    if row_id is None or not 0 <= row_id < len(catalog):
+        return JsonResponse({'status': 'error', 'message': 'Medicine not found'}, status=404)
+    cheaper_only = request.GET.get('cheaper_only', 'true').lower() not in ('0', 'false')
+
+    groups = catalog.substitutes
+    return JsonResponse({
+        'status': 'success',
+        'medicine': catalog.medicine(row_id),
+        'group_size': len(groups.group(row_id)),
+        'cheaper_count': int(groups.cheaper_count[row_id]),
+        'substitutes': _substitutes(catalog, row_id, limit, cheaper_only),
+        'catalog_version': catalog.version,
+    })
+
+
+@api_view(['GET'])
+def autocomplete_medicines_view(request):
+    """
+    Typeahead completions for a partly typed medicine name.
+    Query string: q, limit, and fuzzy (default true: fall back to fuzzy matching
+    when no name starts with q, e.g. on a typo).
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'status': 'error', 'message': 'Provide q'}, status=400)
+    try:
+        limit = int(request.GET.get('limit', settings.MEDICINE_AUTOCOMPLETE_LIMIT))
+        limit = min(settings.MEDICINE_AUTOCOMPLETE_MAX_LIMIT, max(1, limit))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'limit must be an integer'}, status=400)
+    fuzzy = request.GET.get('fuzzy', 'true').lower() not in ('0', 'false')
+
+    engine = get_engine()
+    catalog = engine.catalog
+    if catalog is None:
+        return JsonResponse({'status': 'error', 'message': engine.error}, status=503)
+
+    start_time = time.time()
+    source, completions, catalog_version = engine.analyzer.autocomplete(query, limit=limit, fuzzy=fuzzy)
+    return JsonResponse({
+        'status': 'success',
+        'query': query,
+        'source': source,
+        'results': completions,
+        'catalog_version': catalog_version,
+        'took_ms': round((time.time() - start_time) * 1000, 2),
+    })
+
+
 # Vault System Views
 
 @csrf_exempt
@@ -140,6 +140,110 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Google Places API Key (Get from: https://console.cloud.google.com/apis/credentials)
 GOOGLE_PLACES_API_KEY = os.getenv('GOOGLE_PLACES_API_KEY')
 
+# Outbound HTTP calls to Google APIs (see api/upstream.py)
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', '3.05'))  # seconds
+UPSTREAM_READ_TIMEOUT = float(os.getenv('UPSTREAM_READ_TIMEOUT', '10'))  # seconds
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', '2'))  # idempotent requests only
+UPSTREAM_BACKOFF_SECONDS = float(os.getenv('UPSTREAM_BACKOFF_SECONDS', '0.2'))
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', '10'))  # keep-alive connections per host
+
+# Nearby Search cache for find_hospitals / find_doctors, bucketed by geohash cell, place type and radius
+PLACES_CACHE_ENABLED = os.getenv('PLACES_CACHE_ENABLED', 'True') == 'True'
+PLACES_CACHE_TTL = int(os.getenv('PLACES_CACHE_TTL', '900'))  # seconds
+PLACES_CACHE_GEOHASH_PRECISION = int(os.getenv('PLACES_CACHE_GEOHASH_PRECISION', '6'))  # 6 = cells of about 1.2 x 0.6 km
+PLACES_CACHE_SIZE = int(os.getenv('PLACES_CACHE_SIZE', '10000'))
+
+# Local index of places seen in Nearby Search results (see api/places_index.py). A query inside an
+# area searched less than PLACES_INDEX_MAX_AGE seconds ago is answered from it; older data only
+# stands in when the Places API fails.
+PLACES_INDEX_ENABLED = os.getenv('PLACES_INDEX_ENABLED', 'True') == 'True'
+PLACES_INDEX_MAX_AGE = int(os.getenv('PLACES_INDEX_MAX_AGE', '900'))  # seconds
+PLACES_INDEX_CELL_DEGREES = float(os.getenv('PLACES_INDEX_CELL_DEGREES', '0.05'))  # grid cells of about 5.5 km
+PLACES_INDEX_MAX_PLACES = int(os.getenv('PLACES_INDEX_MAX_PLACES', '200000'))
+
+# Combined finder (POST /api/find_healthcare/): place types a client may ask for, and pages of 20 per type
+HEALTHCARE_PLACE_TYPES = os.getenv('HEALTHCARE_PLACE_TYPES', 'hospital,doctor,pharmacy,dentist,physiotherapist').split(',')
+HEALTHCARE_DEFAULT_PLACE_TYPES = ['hospital', 'doctor']
+PLACES_MAX_PAGES = int(os.getenv('PLACES_MAX_PAGES', '3'))  # Nearby Search returns at most 3 pages
+
+# Medicine analysis engine
+# Warm up the resident engine (Gemini model + medicine catalog) when the app loads,
+# in a background thread, instead of on the first identify-medicine request.
+# When off, the first call to the readiness probe (/api/identify-medicine/ready/) starts it.
+MEDICINE_ENGINE_WARMUP = os.getenv('MEDICINE_ENGINE_WARMUP', 'False') == 'True'
+# Seconds between checks of the catalog CSV for changes; a changed catalog is hot-swapped in. 0 disables.
+MEDICINE_CATALOG_RELOAD_INTERVAL = int(os.getenv('MEDICINE_CATALOG_RELOAD_INTERVAL', '60'))
+
+# Uploads up to this size stay in memory and are decoded in place; larger ones spool to a temp file.
+# Global: applies to every upload (vault files included), not only medicine images. Django's default is 2.5 MB.
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', str(10 * 1024 * 1024)))
+
+# Batch identify-medicine endpoint
+MEDICINE_BATCH_MAX_IMAGES = int(os.getenv('MEDICINE_BATCH_MAX_IMAGES', '20'))
+MEDICINE_BATCH_CONCURRENCY = int(os.getenv('MEDICINE_BATCH_CONCURRENCY', '4'))  # concurrent vision calls
+
+# Async identify-medicine jobs (POST /api/identify-medicine/ with async=1)
+MEDICINE_JOB_WORKERS = int(os.getenv('MEDICINE_JOB_WORKERS', '4'))
+MEDICINE_JOB_MAX_PENDING = int(os.getenv('MEDICINE_JOB_MAX_PENDING', '100'))
+MEDICINE_JOB_RESULT_TTL = int(os.getenv('MEDICINE_JOB_RESULT_TTL', '3600'))  # seconds
+MEDICINE_JOBS_DIR = os.getenv('MEDICINE_JOBS_DIR', str(BASE_DIR / 'media' / 'medicine_jobs'))
+
+# Identify-medicine result cache, keyed by image hash + catalog version
+MEDICINE_CACHE_ENABLED = os.getenv('MEDICINE_CACHE_ENABLED', 'True') == 'True'
+MEDICINE_CACHE_SIZE = int(os.getenv('MEDICINE_CACHE_SIZE', '1024'))  # LRU entries in memory
+MEDICINE_CACHE_TTL = int(os.getenv('MEDICINE_CACHE_TTL', '86400'))  # seconds
+MEDICINE_CACHE_DIR = os.getenv('MEDICINE_CACHE_DIR')  # set to enable the on-disk tier
+MEDICINE_CACHE_DISK_SIZE = int(os.getenv('MEDICINE_CACHE_DISK_SIZE', '100000'))
+
+# Near-duplicate (perceptual hash) lookup of previously identified images
+MEDICINE_NEAR_DUPLICATE_ENABLED = os.getenv('MEDICINE_NEAR_DUPLICATE_ENABLED', 'True') == 'True'
+MEDICINE_NEAR_DUPLICATE_DISTANCE = int(os.getenv('MEDICINE_NEAR_DUPLICATE_DISTANCE', '4'))  # max differing bits of 64
+MEDICINE_NEAR_DUPLICATE_SIZE = int(os.getenv('MEDICINE_NEAR_DUPLICATE_SIZE', '10000'))
+MEDICINE_NEAR_DUPLICATE_MIN_CONFIDENCE = int(os.getenv('MEDICINE_NEAR_DUPLICATE_MIN_CONFIDENCE', '95'))
+
+# Medicine search by ingredient (GET /api/medicines/search)
+MEDICINE_SEARCH_PAGE_SIZE = int(os.getenv('MEDICINE_SEARCH_PAGE_SIZE', '20'))
+MEDICINE_SEARCH_MAX_PAGE_SIZE = int(os.getenv('MEDICINE_SEARCH_MAX_PAGE_SIZE', '100'))
+
+# Generic substitutes (GET /api/medicines/substitutes, or substitutes=K on identify-medicine)
+MEDICINE_SUBSTITUTES_LIMIT = int(os.getenv('MEDICINE_SUBSTITUTES_LIMIT', '5'))
+MEDICINE_SUBSTITUTES_MAX_LIMIT = int(os.getenv('MEDICINE_SUBSTITUTES_MAX_LIMIT', '50'))
+
+# Medicine name typeahead (GET /api/medicines/autocomplete)
+MEDICINE_AUTOCOMPLETE_LIMIT = int(os.getenv('MEDICINE_AUTOCOMPLETE_LIMIT', '10'))
+MEDICINE_AUTOCOMPLETE_MAX_LIMIT = int(os.getenv('MEDICINE_AUTOCOMPLETE_MAX_LIMIT', '50'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'medicine_results': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'medicine-results',
+        'TIMEOUT': MEDICINE_CACHE_TTL,
+        'OPTIONS': {'MAX_ENTRIES': MEDICINE_CACHE_SIZE},
+    },
+    'places': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'places',
+        'TIMEOUT': PLACES_CACHE_TTL,
+        'OPTIONS': {'MAX_ENTRIES': PLACES_CACHE_SIZE},
+    },
+    # File based so every worker process on the host can answer job status polls
+    'medicine_jobs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': MEDICINE_JOBS_DIR,
+        'TIMEOUT': MEDICINE_JOB_RESULT_TTL,
+    },
+}
+if MEDICINE_CACHE_DIR:
+    CACHES['medicine_results_disk'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': MEDICINE_CACHE_DIR,
+        'TIMEOUT': MEDICINE_CACHE_TTL,
+        'OPTIONS': {'MAX_ENTRIES': MEDICINE_CACHE_DISK_SIZE},
+    }
+
 # CORS settings
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",  # Vite React dev server
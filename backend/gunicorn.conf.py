@@ -0,0 +1,56 @@
+# backend/gunicorn.conf.py
+#
+# Production server settings, picked up automatically when gunicorn is started from /backend/:
+#     gunicorn backend.wsgi
+#
+# The app and the medicine catalog are loaded once in the master, then the workers are
+# forked. The catalog snapshot is memory-mapped and the Python objects built from it
+# (name lists, match indexes) are frozen out of the garbage collector before the fork,
+# so workers keep sharing those pages copy-on-write instead of each holding a copy.
+
+import gc
+import os
+import threading
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+# GUNICORN_PRELOAD=False loads everything in each worker instead (e.g. to compare memory use)
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True') == 'True'
+
+# With preload, the app (and so MEDICINE_ENGINE_WARMUP) is loaded in the master. A warm-up
+# thread started there would not survive the fork, and the fork could catch it holding the
+# engine's locks, so the master never warms up: each worker does (post_worker_init). Without
+# preload the app is loaded in the workers and the operator's setting stands.
+if preload_app:
+    os.environ['MEDICINE_ENGINE_WARMUP'] = 'False'
+
+
+def when_ready(server):
+    if not server.cfg.preload_app:
+        return
+    from api.medicine_engine import get_engine
+
+    get_engine().preload_catalog()
+    # Objects allocated so far are never collected; a collection would otherwise write
+    # to every object's header and un-share the pages in every worker
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is loaded (inherited from the master, or loaded here without preload)
+    from api.medicine_engine import get_engine
+
+    engine = get_engine()
+    engine.after_fork()
+
+    def warm_up():
+        # The catalog came from the master, which never reloads it: a worker forked after a
+        # hot reload (max_requests, a crashed worker) would start on the old version. It
+        # catches up here, so only requests served before this check see the old version
+        engine.reload_catalog_if_changed()
+        # Only the vision extractor is left to load
+        engine.warm_up()
+
+    threading.Thread(target=warm_up, name='medicine-engine-warmup', daemon=True).start()
@@ -2,107 +2,437 @@
 
 import sys
 import os
+import gc
 import json
-import pandas as pd
-import regex as re
-from PIL import Image
-import google.generativeai as genai
-from thefuzz import process, fuzz
-from dotenv import load_dotenv
-import signal
+import argparse
+from medicine_catalog import catalog_changed, load_catalog
+from medicine_matching import CandidateIndex, make_matcher
+from medicine_autocomplete import autocomplete
+from image_preprocessing import preprocess_image
+from vision_guard import CircuitBreaker, CircuitOpenError, DeadlineExceededError, VisionGuard
+from vision_extractors import make_extractor_from_env
 import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 
 # IMPORTANT: The Django backend will execute this script from the `/backend/` directory.
 # Therefore, we need to construct the paths relative to that location.
 # ../ml/ will point from /backend/ to /ml/
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # This gets the root project directory
 DB_PATH = os.path.join(BASE_DIR, 'ml', 'Extensive_A_Z_medicines_dataset_of_India.csv')
-ENV_PATH = os.path.join(BASE_DIR, 'backend', '.env') # Assuming .env is in the backend folder
 
-def run_analysis(image_path):
-    try:
-        load_dotenv(dotenv_path=ENV_PATH)
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("GEMINI_API_KEY not found in .env file.")
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash-lite-preview-06-17')
-    except Exception as e:
-        return json.dumps({"status": "error", "message": f"API Configuration failed: {e}"})
+# Fuzzy matching settings (see medicine_matching.py)
+# 'thefuzz' scores index candidates one pair at a time; 'rapidfuzz' scores the whole catalog in one cdist call
+MATCH_BACKEND = os.getenv('MEDICINE_MATCH_BACKEND', 'thefuzz')
+USE_CANDIDATE_INDEX = os.getenv('MEDICINE_CANDIDATE_INDEX', 'True') == 'True'
+MATCH_WORKERS = int(os.getenv('MEDICINE_MATCH_WORKERS', '-1'))  # -1 uses every core
+MATCH_SCORE_CUTOFF = int(os.getenv('MEDICINE_MATCH_SCORE_CUTOFF', '0'))
 
-    try:
-        medicine_db = pd.read_csv(DB_PATH)
-        medicine_db['short_composition1'] = medicine_db['short_composition1'].fillna('')
-        medicine_db['short_composition2'] = medicine_db['short_composition2'].fillna('')
-        medicine_db['composition'] = medicine_db['short_composition1'] + ' ' + medicine_db['short_composition2']
-        medicine_db['composition'] = medicine_db['composition'].str.strip()
-        medicine_names = medicine_db['name'].dropna().tolist()
-        medicine_compositions = medicine_db['composition'].dropna().unique().tolist()
-    except Exception as e:
-        return json.dumps({"status": "error", "message": f"Database loading failed: {e}"})
-
-    def find_best_match_robustly(extracted_term, choices):
-        if not extracted_term or len(extracted_term) < 3: return None, 0
-        best_match, score = process.extractOne(extracted_term, choices, scorer=fuzz.token_set_ratio)
-        return best_match, score
-
-    def intelligent_search(gemini_output):
-        brand_name = gemini_output.get("brand_name")
-        composition = gemini_output.get("composition")
-        best_brand_match, score_brand = find_best_match_robustly(brand_name, medicine_names)
-        best_comp_match, score_comp = find_best_match_robustly(composition, medicine_compositions)
-        if score_brand >= score_comp:
-            return best_brand_match, score_brand, 'name'
-        else:
-            return best_comp_match, score_comp, 'composition'
+# Vision call guard (see vision_guard.py)
+VISION_DEADLINE_SECONDS = float(os.getenv('MEDICINE_VISION_DEADLINE_SECONDS', '30'))
+VISION_HEDGE_PERCENTILE = float(os.getenv('MEDICINE_VISION_HEDGE_PERCENTILE', '0'))  # e.g. 0.95; 0 disables hedging
+VISION_BREAKER_FAILURES = int(os.getenv('MEDICINE_VISION_BREAKER_FAILURES', '5'))
+VISION_BREAKER_RESET_SECONDS = float(os.getenv('MEDICINE_VISION_BREAKER_RESET_SECONDS', '30'))
 
-    try:
-        original_image = Image.open(image_path).convert("RGB")
-        
-        # Resize image to reduce processing time while maintaining quality
-        max_size = (1024, 1024)
-        original_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        
-        prompt = """You are an expert pharmacy assistant. Analyze the image of the medicine packaging. Extract the following information and return it as a clean JSON object: "brand_name", "composition", "manufacturer". If a field is not visible, return "N/A". Do not include any text outside the JSON."""
-        
-        # Add timeout for Gemini API call
+# Bulk mode (python ml/analyze_medicine.py bulk ...)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Images handed to a worker process at once: their vision calls overlap, then they are matched as one batch
+BULK_CHUNK_SIZE = 16
+
+
+class CatalogState:
+    """A catalog and the matchers built over it, swapped in as one unit when the catalog is reloaded."""
+
+    def __init__(self, catalog, name_matcher, composition_matcher, autocomplete_index):
+        self.catalog = catalog
+        self.name_matcher = name_matcher
+        self.composition_matcher = composition_matcher
+        # Trigram candidates for the autocomplete fuzzy fallback, whatever the match backend
+        self.autocomplete_index = autocomplete_index
+
+
+class MedicineAnalyzer:
+    """
+    Holds the vision extractor and the medicine catalog so they are loaded once
+    and reused for every image, instead of once per script invocation.
+    The extractor backend (Gemini or the local stand-in) is picked by
+    MEDICINE_VISION_BACKEND unless one is passed in.
+
+    The catalog and its matchers live in one CatalogState. A reload builds a new
+    state off to the side and swaps it in with a single assignment; a request reads
+    self.state once, so it finishes on the version it started with.
+    """
+
+    def __init__(self, extractor=None, db_path=DB_PATH):
+        self.db_path = db_path
+        self.extractor = extractor or make_extractor_from_env()
+        self.extractor_loaded = False
+        self.state = None
+        self.vision_guard = VisionGuard(
+            deadline=VISION_DEADLINE_SECONDS,
+            hedge_percentile=VISION_HEDGE_PERCENTILE or None,
+            breaker=CircuitBreaker(VISION_BREAKER_FAILURES, VISION_BREAKER_RESET_SECONDS),
+        )
+
+    @property
+    def catalog(self):
+        return self.state.catalog if self.state else None
+
+    @property
+    def name_matcher(self):
+        return self.state.name_matcher if self.state else None
+
+    @property
+    def composition_matcher(self):
+        return self.state.composition_matcher if self.state else None
+
+    @property
+    def is_loaded(self):
+        return self.extractor_loaded and self.state is not None
+
+    def load(self):
+        # The catalog first: catalog-only callers (search, substitutes) must not depend on the vision backend
+        self.load_catalog_state()
+        self.load_extractor()
+
+    def load_extractor(self):
+        if self.extractor_loaded:
+            return
+        try:
+            self.extractor.load()
+            self.extractor_loaded = True
+        except Exception as e:
+            raise RuntimeError(f"API Configuration failed: {e}")
+
+    def load_catalog_state(self):
+        """Load the catalog and matchers unless already loaded (e.g. before the server forked its workers)."""
+        if self.state is not None:
+            return
+        try:
+            self.state = self.load_state()
+        except Exception as e:
+            raise RuntimeError(f"Database loading failed: {e}")
+
+    def load_state(self):
+        # The shared snapshot folder belongs to the default catalog: rebuild it when stale, so that
+        # every worker maps the new one rather than each compiling the CSV (see medicine_catalog.py)
+        catalog = load_catalog(self.db_path, rebuild=self.db_path == DB_PATH)
+        # Build the lookup and match indexes now rather than on the first image
+        catalog.warm_up()
+        name_matcher = self.make_matcher(catalog.medicine_names, self.candidate_index(catalog, 'name'))
+        return CatalogState(
+            catalog,
+            name_matcher,
+            self.make_matcher(catalog.medicine_compositions, self.candidate_index(catalog, 'composition')),
+            # Shared with the thefuzz matcher when it has one; otherwise the snapshot's, or built here
+            getattr(name_matcher, 'index', None) or catalog.candidate_index('name') or CandidateIndex(catalog.medicine_names),
+        )
+
+    def candidate_index(self, catalog, column):
+        # The snapshot's precompiled index saves the matcher from building one (the slowest part of a load)
+        if USE_CANDIDATE_INDEX and MATCH_BACKEND == 'thefuzz':
+            return catalog.candidate_index(column)
+        return None
+
+    def catalog_changed(self):
+        """(changed, reason): whether the catalog on disk differs from the loaded one."""
+        return catalog_changed(self.catalog, self.db_path)
+
+    def reload_catalog(self):
+        """Load the catalog on disk and its matchers, then swap them in. Returns the new version."""
+        state = self.load_state()
+        self.state = state
+        return state.catalog.version
+
+    def make_matcher(self, choices, index=None):
+        return make_matcher(choices, backend=MATCH_BACKEND, use_index=USE_CANDIDATE_INDEX,
+                            workers=MATCH_WORKERS, score_cutoff=MATCH_SCORE_CUTOFF, index=index)
+
+    def find_best_match_robustly(self, extracted_term, matcher):
+        return self.find_best_matches(matcher, [extracted_term])[0]
+
+    def find_best_matches(self, matcher, extracted_terms):
+        # One matcher call for the whole batch; terms too short to match score 0
+        results = [(None, 0)] * len(extracted_terms)
+        valid = [i for i, term in enumerate(extracted_terms) if term and len(term) >= 3]
+        for i, match in zip(valid, matcher.best_matches([extracted_terms[i] for i in valid])):
+            results[i] = match
+        return results
+
+    def intelligent_search(self, gemini_output):
+        return self.intelligent_search_many([gemini_output])[0]
+
+    def intelligent_search_many(self, gemini_outputs, timings=None, state=None):
+        # Terms are matched as one batch, so each output's timings get the batch duration
+        timings = timings if timings is not None else [{} for _ in gemini_outputs]
+        state = state or self.state
         start_time = time.time()
-        response = model.generate_content([prompt, original_image])
-        elapsed_time = time.time() - start_time
-        
-        if elapsed_time > 120:  # If taking more than 2 minutes
-            return json.dumps({"status": "error", "message": "Gemini API response took too long"})
-        
-        clean_json_str = response.text.strip().replace('```json', '').replace('```', '')
-        gemini_data = json.loads(clean_json_str)
-
-        if not gemini_data.get("brand_name") and not gemini_data.get("composition"):
-            return json.dumps({"status": "error", "message": "Gemini could not identify key information."})
-
-        best_match, score, match_col = intelligent_search(gemini_data)
-        
+        brand_matches = self.find_best_matches(state.name_matcher, [output.get("brand_name") for output in gemini_outputs])
+        name_match_ms = round((time.time() - start_time) * 1000, 2)
+        start_time = time.time()
+        comp_matches = self.find_best_matches(state.composition_matcher, [output.get("composition") for output in gemini_outputs])
+        composition_match_ms = round((time.time() - start_time) * 1000, 2)
+        for stage_timings in timings:
+            stage_timings['name_match'] = name_match_ms
+            stage_timings['composition_match'] = composition_match_ms
+        results = []
+        for (best_brand_match, score_brand), (best_comp_match, score_comp) in zip(brand_matches, comp_matches):
+            if score_brand >= score_comp:
+                results.append((best_brand_match, score_brand, 'name'))
+            else:
+                results.append((best_comp_match, score_comp, 'composition'))
+        return results
+
+    def autocomplete(self, query, limit=10, fuzzy=True):
+        """
+        Typeahead completions for a partly typed medicine name:
+        (source, [{"id", "name", "match"}], catalog_version).
+        """
+        state = self.state
+        catalog = state.catalog
+        # The candidate index narrows the fuzzy fallback from the whole catalog to a few hundred names
+        source, matches = autocomplete(catalog.prefix_index, query, limit, fuzzy, state.autocomplete_index)
+        completions = []
+        for name_id, match in matches:
+            name = catalog.medicine_names[name_id]
+            completions.append({"id": catalog.find_row('name', name), "name": name, "match": match})
+        return source, completions, catalog.version
+
+    def extract(self, image_path, timings=None):
+        """
+        Ask the vision model about one image. Returns (gemini_data, None) or (None, error_result).
+        Stage durations in milliseconds are written into `timings` when a dict is given.
+        """
+        timings = timings if timings is not None else {}
+        try:
+            # Draft-decode, orient, resize and re-encode to the upload byte budget
+            prepared = preprocess_image(image_path, timings=timings)
+
+            # Hard deadline, optional hedging and circuit breaking around the vision call
+            start_time = time.time()
+            try:
+                response_text = self.vision_guard.call(self.extractor.request, prepared, timeout=VISION_DEADLINE_SECONDS)
+            except DeadlineExceededError:
+                return None, {"status": "error", "message": "Gemini API response took too long"}
+            except CircuitOpenError:
+                return None, {"status": "error", "message": "Gemini API is temporarily unavailable, please retry shortly"}
+            finally:
+                timings['extraction'] = round((time.time() - start_time) * 1000, 2)
+
+            gemini_data = self.extractor.parse(response_text)
+
+            if not gemini_data.get("brand_name") and not gemini_data.get("composition"):
+                return None, {"status": "error", "message": "Gemini could not identify key information."}
+
+            return gemini_data, None
+
+        except Exception as e:
+            return None, {"status": "error", "message": f"An error occurred during analysis: {str(e)}"}
+
+    def build_result(self, best_match, score, match_col, state=None):
+        catalog = (state or self.state).catalog
         if score >= 85:
-            matched_row = medicine_db[medicine_db[match_col] == best_match].iloc[0]
-            result = {
+            return {
                 "status": "success",
                 "match_confidence": score,
-                "data": {
-                    "brand_name": matched_row.get('name', 'N/A'),
-                    "composition": matched_row.get('composition', 'N/A'),
-                    "manufacturer": matched_row.get('manufacturer_name', 'N/A'),
-                    "price_inr": matched_row.get('price(₹)', 'N/A'),
-                    "pack_size": matched_row.get('pack_size_label', 'N/A'),
-                }
+                "data": catalog.medicine(catalog.find_row(match_col, best_match)),
+                "catalog_version": catalog.version,
             }
-            return json.dumps(result)
         else:
-            return json.dumps({"status": "low_confidence", "message": "Could not reliably verify.", "match_confidence": score, "closest_match": best_match})
+            return {"status": "low_confidence", "message": "Could not reliably verify.", "match_confidence": score, "closest_match": best_match, "catalog_version": catalog.version}
+
+    def analyze(self, image_path, timings=None):
+        """Analyze one image (a path or file-like object) and return the result dict."""
+        return self.analyze_many([image_path], max_workers=1, timings=[timings] if timings is not None else None)[0]
+
+    def analyze_many(self, image_paths, max_workers=4, timings=None):
+        """
+        Analyze several images: vision calls run concurrently (at most `max_workers`
+        at a time), then all extracted terms are matched against the catalog as one batch.
+        Returns one result dict per image, in order; failures are reported per image.
+        `timings`, if given, is a list with one dict per image to receive stage durations.
+        """
+        timings = timings if timings is not None else [{} for _ in image_paths]
+        if len(image_paths) == 1 or max_workers <= 1:
+            extractions = [self.extract(image_path, stage_timings) for image_path, stage_timings in zip(image_paths, timings)]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                extractions = list(pool.map(self.extract, image_paths, timings))
+
+        results = [error for _, error in extractions]
+        extracted = [(i, gemini_data) for i, (gemini_data, error) in enumerate(extractions) if error is None]
+        if not extracted:
+            return results
+        # Matching and row lookup run against one catalog version, even if a reload lands meanwhile
+        state = self.state
+        try:
+            matches = self.intelligent_search_many([gemini_data for _, gemini_data in extracted], [timings[i] for i, _ in extracted], state)
+            for (i, _), match in zip(extracted, matches):
+                start_time = time.time()
+                results[i] = self.build_result(*match, state=state)
+                timings[i]['row_lookup'] = round((time.time() - start_time) * 1000, 2)
+        except Exception as e:
+            for i, _ in extracted:
+                results[i] = {"status": "error", "message": f"An error occurred during analysis: {str(e)}"}
+        return results
+
+
+def run_analysis(image_path, analyzer=None):
+    # A resident analyzer (see backend/api/medicine_engine.py) is passed in by
+    # long-lived callers; one-shot callers get a fresh one loaded here.
+    if analyzer is None:
+        analyzer = MedicineAnalyzer()
+        try:
+            analyzer.load()
+        except RuntimeError as e:
+            return json.dumps({"status": "error", "message": str(e)})
+    return json.dumps(analyzer.analyze(image_path))
+
+# The analyzer of a bulk worker process, set up once by _init_bulk_worker
+_bulk_analyzer = None
+
+
+def list_bulk_images(source):
+    """Image paths under a directory (recursively, sorted), or listed one per line in a manifest file."""
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+        return sorted(paths)
+    # Relative manifest entries are relative to the manifest itself
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base_dir, line) for line in lines if line and not line.startswith('#')]
+
+
+def read_checkpoint(output_path, catalog_version, retry_errors=False):
+    """
+    Images an earlier run already wrote to the NDJSON output, which doubles as the checkpoint.
+    Results against another catalog version don't count, nor errors when `retry_errors` is set.
+    A torn last line (the run was killed mid-write) is cut off so appending continues cleanly.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get("status") == "error":
+            if not retry_errors:
+                done.add(record["image"])
+        elif record.get("catalog_version") == catalog_version:
+            done.add(record["image"])
+    return done
+
+
+def _init_bulk_worker(db_path):
+    global _bulk_analyzer
+    # Forked workers inherit the catalog the parent loaded; spawned ones load their own
+    if _bulk_analyzer is None:
+        _bulk_analyzer = MedicineAnalyzer(db_path=db_path)
+    _bulk_analyzer.load()
+
+
+def _identify_chunk(image_paths, concurrency):
+    results = _bulk_analyzer.analyze_many(image_paths, max_workers=concurrency)
+    return [{"image": image_path, **result} for image_path, result in zip(image_paths, results)]
+
+
+def run_bulk(argv=None):
+    """
+    Identify every image in a directory or manifest with a pool of worker processes,
+    appending one JSON line per image to the output. Rerunning the same command resumes
+    where an interrupted run stopped.
+    """
+    parser = argparse.ArgumentParser(prog='analyze_medicine.py bulk', description='Identify many medicine images into an NDJSON file.')
+    parser.add_argument('source', help='directory of images, or a manifest file with one image path per line')
+    parser.add_argument('--output', default='medicine_results.ndjson', help='NDJSON results file; an existing one is resumed')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes, each loading the analyzer once')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent vision calls per worker process')
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE, help='images per worker task')
+    parser.add_argument('--catalog', default=DB_PATH, help='medicine catalog CSV')
+    parser.add_argument('--retry-errors', action='store_true', help='identify again images whose earlier result was an error')
+    parser.add_argument('--sync-every', type=int, default=100, help='fsync the output after this many images')
+    args = parser.parse_args(argv)
+
+    global _bulk_analyzer
+    # Load the catalog before the workers fork so they share its pages instead of each loading it
+    _bulk_analyzer = MedicineAnalyzer(db_path=args.catalog)
+    try:
+        _bulk_analyzer.load_catalog_state()
+    except RuntimeError as e:
+        print(json.dumps({"status": "error", "message": str(e)}))
+        return 1
+    catalog_version = _bulk_analyzer.catalog.version
+    gc.freeze()
+
+    images = list_bulk_images(args.source)
+    done = read_checkpoint(args.output, catalog_version, args.retry_errors)
+    pending = [image_path for image_path in images if image_path not in done]
+    print(f"{len(images)} images, {len(images) - len(pending)} already done, {len(pending)} to identify "
+          f"(catalog {catalog_version})", file=sys.stderr)
+
+    statuses = Counter()
+    identified = 0
+    unsynced = 0
+    start_time = time.time()
+    chunks = [pending[i:i + args.chunk_size] for i in range(0, len(pending), args.chunk_size)]
+    pool = ProcessPoolExecutor(max_workers=args.processes, initializer=_init_bulk_worker, initargs=(args.catalog,))
+    try:
+        with open(args.output, 'a') as output:
+            futures = [pool.submit(_identify_chunk, chunk, args.concurrency) for chunk in chunks]
+            for future in as_completed(futures):
+                records = future.result()
+                for record in records:
+                    output.write(json.dumps(record) + '\n')
+                    statuses[record["status"]] += 1
+                output.flush()
+                identified += len(records)
+                unsynced += len(records)
+                if unsynced >= args.sync_every:
+                    os.fsync(output.fileno())
+                    unsynced = 0
+                print(f"{identified}/{len(pending)} images, "
+                      f"{identified / (time.time() - start_time):.1f}/s", file=sys.stderr)
+            os.fsync(output.fileno())
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        print("Interrupted; run the same command again to resume.", file=sys.stderr)
+        return 130
+    except BrokenProcessPool as e:
+        pool.shutdown(wait=False, cancel_futures=True)
+        print(json.dumps({"status": "error", "message": f"A worker process failed to start or died: {e}"}))
+        return 1
+    pool.shutdown()
+
+    seconds = time.time() - start_time
+    print(json.dumps({
+        "status": "success",
+        "images": len(images),
+        "skipped": len(images) - len(pending),
+        "identified": len(pending),
+        "statuses": dict(statuses),
+        "catalog_version": catalog_version,
+        "seconds": round(seconds, 2),
+        "images_per_second": round(len(pending) / seconds, 2) if seconds else None,
+        "output": args.output,
+    }))
+    return 0
 
-    except Exception as e:
-        return json.dumps({"status": "error", "message": f"An error occurred during analysis: {str(e)}"})
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == 'bulk':
+        sys.exit(run_bulk(sys.argv[2:]))
+    elif len(sys.argv) > 1:
         image_file_path = sys.argv[1]
         analysis_result = run_analysis(image_file_path)
         print(analysis_result)
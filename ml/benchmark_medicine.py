@@ -0,0 +1,178 @@
+# ml/benchmark_medicine.py
+#
+# End-to-end benchmark of the identify-medicine pipeline.
+#
+# Replays the images in ml/Medicine_data/Medicine_data through MedicineAnalyzer with
+# the local stand-in vision backend (see vision_extractors.py), so runs are repeatable
+# and free. Reports p50/p95/p99 request latency, per-stage breakdowns and throughput
+# at each concurrency level, and writes everything to a JSON file for comparison.
+#
+# The bundled fixture is synthetic: its responses are common medicines drawn at random,
+# not transcriptions of the photos. With it, the per-level statuses (match and success
+# rates) measure nothing about accuracy, and the report is labelled stand_in: synthetic.
+# Record real responses with `python ml/vision_extractors.py fixture record` for that.
+#
+#     python ml/benchmark_medicine.py --concurrency 1,4,16 --latency-ms 800 --jitter-ms 400
+#     python ml/benchmark_medicine.py --output after.json --baseline before.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import analyze_medicine
+from analyze_medicine import MedicineAnalyzer
+from vision_extractors import FIXTURE_PATH, IMAGES_DIR, StandInExtractor
+from vision_guard import percentile
+
+STAGES = ('decode', 'resize', 'encode', 'extraction', 'name_match', 'composition_match', 'row_lookup')
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 0.5), 2),
+        'p95': round(percentile(values, 0.95), 2),
+        'p99': round(percentile(values, 0.99), 2),
+        'mean': round(sum(values) / len(values), 2),
+        'max': round(max(values), 2),
+    }
+
+
+def list_images(images_dir, limit=None):
+    images = sorted(
+        os.path.join(images_dir, name) for name in os.listdir(images_dir)
+        if name.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )
+    return images[:limit] if limit else images
+
+
+def timed_analysis(analyzer, image_path):
+    timings = {}
+    start_time = time.perf_counter()
+    result = analyzer.analyze(image_path, timings=timings)
+    latency_ms = (time.perf_counter() - start_time) * 1000
+    return latency_ms, timings, result.get('status')
+
+
+def run_level(analyzer, images, concurrency):
+    """Analyze every image once with `concurrency` requests in flight."""
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        samples = list(pool.map(lambda image_path: timed_analysis(analyzer, image_path), images))
+    wall_seconds = time.perf_counter() - start_time
+
+    stage_values = defaultdict(list)
+    for _, timings, _ in samples:
+        for stage, milliseconds in timings.items():
+            stage_values[stage].append(milliseconds)
+    return {
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(samples) / wall_seconds, 2),
+        'latency_ms': summarize([latency_ms for latency_ms, _, _ in samples]),
+        'stages_ms': {stage: summarize(stage_values[stage]) for stage in STAGES if stage_values[stage]},
+        'statuses': dict(Counter(status for _, _, status in samples)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline):
+    """Print p50/p95/p99 and throughput changes against a previous report, per concurrency."""
+    baseline_runs = {run['concurrency']: run for run in baseline['runs']}
+    for run in report['runs']:
+        before = baseline_runs.get(run['concurrency'])
+        if before is None:
+            continue
+        changes = [
+            f"{key} {before['latency_ms'][key]} -> {run['latency_ms'][key]} ms"
+            for key in ('p50', 'p95', 'p99')
+        ]
+        changes.append(f"throughput {before['throughput_rps']} -> {run['throughput_rps']} req/s")
+        print(f"concurrency {run['concurrency']}: " + ', '.join(changes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the identify-medicine pipeline with the stand-in vision backend. '
+                    'Latency and throughput only: with a synthetic fixture (the default) the responses '
+                    'are not what the photos show, so match and success rates say nothing about accuracy.')
+    parser.add_argument('--images', default=IMAGES_DIR, help='directory of medicine photos to replay')
+    parser.add_argument('--limit', type=int, default=None, help='replay only the first N images')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the image set this many times per level')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated concurrency levels')
+    parser.add_argument('--latency-ms', type=float, default=0, help='injected stand-in vision latency')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='extra per-image stand-in latency, up to this much')
+    parser.add_argument('--fixture', default=FIXTURE_PATH, help='stand-in response fixture (synthetic or recorded, see vision_extractors.py)')
+    parser.add_argument('--catalog', default=analyze_medicine.DB_PATH, help='medicine catalog CSV')
+    parser.add_argument('--output', default='medicine_benchmark.json', help='where to write the JSON report')
+    parser.add_argument('--baseline', default=None, help='previous JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    extractor = StandInExtractor(fixture_path=args.fixture, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+    analyzer = MedicineAnalyzer(extractor=extractor, db_path=args.catalog)
+    start_time = time.perf_counter()
+    analyzer.load()
+    load_seconds = time.perf_counter() - start_time
+    stand_in = 'synthetic' if extractor.synthetic else 'recorded'
+    if extractor.synthetic:
+        print("stand_in: synthetic - vision responses are not read from the photos; "
+              "statuses below measure latency paths, not accuracy", file=sys.stderr)
+
+    images = list_images(args.images, args.limit) * args.repeat
+    levels = [int(level) for level in args.concurrency.split(',')]
+    # One untimed pass so the first level doesn't pay for cold file and page caches
+    run_level(analyzer, images[:min(len(images), 20)], max(levels))
+
+    runs = []
+    for concurrency in levels:
+        run = run_level(analyzer, images, concurrency)
+        print(f"concurrency {concurrency}: {run['throughput_rps']} req/s, "
+              f"p50 {run['latency_ms']['p50']} ms, p95 {run['latency_ms']['p95']} ms, p99 {run['latency_ms']['p99']} ms "
+              f"(stand_in: {stand_in})")
+        runs.append(run)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+            'images': len(images) // args.repeat,
+            'repeat': args.repeat,
+            'load_seconds': round(load_seconds, 3),
+            'vision': extractor.describe(),
+            'stand_in': stand_in,
+            'vision_deadline_seconds': analyze_medicine.VISION_DEADLINE_SECONDS,
+            'match_backend': analyze_medicine.MATCH_BACKEND,
+            'candidate_index': analyze_medicine.USE_CANDIDATE_INDEX,
+            'catalog': analyzer.catalog.describe(),
+        },
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
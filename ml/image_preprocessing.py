@@ -0,0 +1,107 @@
+# ml/image_preprocessing.py
+#
+# Prepares an uploaded medicine photo for the vision model.
+#
+# A 12 MP phone photo does not need to be fully decoded just to be shrunk to 1024 px:
+# for JPEGs, Image.draft asks the decoder to scale by 1/2, 1/4 or 1/8 while decoding.
+# EXIF orientation is applied so the model sees the box upright, and the result is
+# re-encoded as a JPEG that fits a byte budget, which keeps the upstream payload small.
+
+import io
+import os
+import time
+
+from PIL import Image, ImageOps
+
+MAX_SIZE = (1024, 1024)
+BYTE_BUDGET = int(os.getenv('MEDICINE_IMAGE_BYTE_BUDGET', '300000'))
+JPEG_QUALITIES = (90, 85, 75, 65, 55)
+# When even the lowest quality is over budget, shrink by this factor and try again
+DOWNSCALE_FACTOR = 0.8
+MAX_DOWNSCALES = 3
+# Perceptual fingerprints (dHash) of hash_size x hash_size gradients; 8 gives 64 bits
+HASH_SIZE = 8
+
+
+class PreparedImage:
+    """A preprocessed image: the resized PIL image plus the JPEG bytes sent upstream."""
+
+    def __init__(self, image, data, quality, original_size):
+        self.image = image
+        self.data = data
+        self.quality = quality
+        self.original_size = original_size
+
+    @property
+    def mime_type(self):
+        return 'image/jpeg'
+
+    def as_part(self):
+        """Inline blob for model.generate_content."""
+        return {'mime_type': self.mime_type, 'data': self.data}
+
+
+def encode_jpeg(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def encode_within_budget(image, byte_budget):
+    """Highest-quality JPEG encoding of `image` that fits `byte_budget`, shrinking it if it must."""
+    for attempt in range(MAX_DOWNSCALES + 1):
+        if attempt:
+            width, height = image.size
+            image = image.resize((max(1, int(width * DOWNSCALE_FACTOR)), max(1, int(height * DOWNSCALE_FACTOR))), Image.Resampling.LANCZOS)
+        for quality in JPEG_QUALITIES:
+            data = encode_jpeg(image, quality)
+            if len(data) <= byte_budget:
+                return image, data, quality
+    # Still over budget after every downscale: send the smallest encoding we have
+    return image, data, quality
+
+
+def dhash(source, hash_size=HASH_SIZE):
+    """dhash_image of the image at `source` (a path or file-like object), decoded only as large as the hash needs."""
+    image = Image.open(source)
+    # Let the JPEG decoder downscale while decoding; the hash only needs a tiny image
+    image.draft('L', (hash_size * 8, hash_size * 8))
+    return dhash_image(image, hash_size)
+
+
+def dhash_image(image, hash_size=HASH_SIZE):
+    """64-bit difference hash of a PIL image: brightness gradients of a 9x8 grayscale thumbnail."""
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def preprocess_image(source, max_size=MAX_SIZE, byte_budget=BYTE_BUDGET, timings=None):
+    """
+    Open, orient, resize and re-encode the image at `source` (a path or file-like object).
+    Stage durations in milliseconds are written into `timings` when a dict is given.
+    """
+    timings = timings if timings is not None else {}
+
+    start_time = time.perf_counter()
+    image = Image.open(source)
+    original_size = image.size
+    # JPEG only: decode at the smallest 1/2^n scale that still covers max_size
+    image.draft('RGB', max_size)
+    image = ImageOps.exif_transpose(image)
+    image = image.convert('RGB')
+    timings['decode'] = round((time.perf_counter() - start_time) * 1000, 2)
+
+    start_time = time.perf_counter()
+    image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    timings['resize'] = round((time.perf_counter() - start_time) * 1000, 2)
+
+    start_time = time.perf_counter()
+    image, data, quality = encode_within_budget(image, byte_budget)
+    timings['encode'] = round((time.perf_counter() - start_time) * 1000, 2)
+
+    return PreparedImage(image, data, quality, original_size)
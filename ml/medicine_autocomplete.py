@@ -0,0 +1,117 @@
+# ml/medicine_autocomplete.py
+#
+# Typeahead over medicine names.
+#
+# Every distinct name is normalized ("Dolo-650 Tablet" -> "dolo 650 tablet") and entered
+# into a sorted key array once per word it could be typed from: the whole name, and
+# the name from each later word on ("650 tablet", "tablet"). A keystroke is then a
+# bisect to the first key with the typed prefix and a short forward scan, instead of a
+# fuzzy pass over every name. Each entry also carries a precomputed rank, so picking
+# the best completions among the matching range is one argpartition rather than a
+# Python sort. The arrays are compiled into the catalog snapshot.
+# Only when the prefix finds nothing (a typo) do we fall back to fuzzy matching.
+
+from bisect import bisect_left
+
+import numpy as np
+from rapidfuzz import fuzz
+from rapidfuzz import process
+from rapidfuzz.utils import default_process
+
+# Names are also entered from up to this many later words (brand tokens, strengths, form)
+MAX_WORD_ENTRIES = 6
+# Prefix matches ranked per lookup; one-letter prefixes can match most of the catalog
+SCAN_LIMIT = 100000
+FUZZY_SCORE_CUTOFF = 60
+
+WHOLE_NAME = 0
+LATER_WORD = 1
+MATCH_KINDS = {WHOLE_NAME: 'prefix', LATER_WORD: 'word'}
+
+
+def normalize_name(text):
+    return ' '.join(default_process(text or '').split())
+
+
+def entry_rank(kind, name, name_id):
+    """Lower ranks first: whole-name matches, then shorter names, then catalog order."""
+    return (kind << 40) | (min(len(name), 0xFFFF) << 24) | name_id
+
+
+def compile_prefix_index(names):
+    """(keys, ranks) sorted by key, for a list of distinct names. Ranks also encode the name id."""
+    entries = []
+    for name_id, name in enumerate(names):
+        words = normalize_name(name).split()
+        for position in range(min(len(words), MAX_WORD_ENTRIES + 1)):
+            kind = WHOLE_NAME if position == 0 else LATER_WORD
+            entries.append((' '.join(words[position:]), entry_rank(kind, name, name_id)))
+    entries.sort()
+    keys = [key for key, _ in entries]
+    ranks = np.array([rank for _, rank in entries], dtype=np.int64)
+    return keys, ranks
+
+
+class PrefixIndex:
+    """Sorted (normalized key -> name) entries; a lookup is two bisects and a partial sort."""
+
+    def __init__(self, keys, ranks, names):
+        self.keys = keys
+        self.ranks = ranks
+        self.names = names
+
+    def lookup(self, query, limit=10, scan_limit=SCAN_LIMIT):
+        """
+        [(name_id, kind)] of names with a word sequence starting with `query`: whole-name
+        matches first, then shorter names, then catalog order.
+        """
+        prefix = normalize_name(query)
+        if not prefix:
+            return []
+        # default_process keeps only (Unicode) letters and digits, never the noncharacter U+10FFFF,
+        # so this sorts after every key with the prefix
+        start = bisect_left(self.keys, prefix)
+        end = min(bisect_left(self.keys, prefix + '\U0010ffff', lo=start), start + scan_limit)
+        if start == end:
+            return []
+
+        ranks = np.asarray(self.ranks[start:end])
+        # A name can match through several of its entries, so over-fetch before de-duplicating
+        wanted = min(len(ranks), limit * 4)
+        top = np.argpartition(ranks, wanted - 1)[:wanted] if wanted < len(ranks) else np.arange(len(ranks))
+        matches = []
+        seen = set()
+        for rank in np.sort(ranks[top]):
+            name_id = int(rank & 0xFFFFFF)
+            if name_id not in seen:
+                seen.add(name_id)
+                matches.append((name_id, int(rank >> 40)))
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def __len__(self):
+        return len(self.ranks)
+
+
+def autocomplete(prefix_index, query, limit=10, fuzzy=True, candidate_index=None):
+    """
+    Returns (source, [(name_id, match)]) where source is 'prefix' or 'fuzzy'. The fuzzy
+    fallback scores only `candidate_index` candidates when an index is given.
+    """
+    matches = prefix_index.lookup(query, limit)
+    if matches or not fuzzy:
+        return 'prefix', [(name_id, MATCH_KINDS[kind]) for name_id, kind in matches]
+
+    names = prefix_index.names
+    if candidate_index is not None:
+        # No trigram in common with any name means nothing would pass the score cutoff either
+        candidate_ids = candidate_index.candidates(query)
+        if candidate_ids is None or not len(candidate_ids):
+            return 'fuzzy', []
+    else:
+        candidate_ids = range(len(names))
+    choices = {int(name_id): names[name_id] for name_id in candidate_ids}
+    found = process.extract(query, choices, scorer=fuzz.WRatio, processor=default_process,
+                            limit=limit, score_cutoff=FUZZY_SCORE_CUTOFF)
+    return 'fuzzy', [(name_id, 'fuzzy') for _, _, name_id in found]
@@ -0,0 +1,454 @@
+# ml/medicine_catalog.py
+#
+# Loads the medicine catalog used by analyze_medicine.py.
+#
+# Parsing Extensive_A_Z_medicines_dataset_of_India.csv with pandas is the slowest
+# part of a cold start, so the CSV can be compiled ahead of time into a snapshot:
+# a folder of .npy arrays plus a meta.json. The arrays are memory-mapped on load,
+# so opening a snapshot takes milliseconds. If the snapshot is missing or was built
+# from a different CSV, the loader falls back to parsing the CSV, or, when asked to
+# (load_catalog(rebuild=True)), rebuilds the snapshot first: one process builds it
+# under a file lock while the others wait, then they all map the same new files.
+#
+# Each CSV has its own snapshot folder (snapshot_dir_for): ml/catalog_snapshot for the
+# default catalog, '<name>.snapshot' next to any other CSV.
+#
+# Build a snapshot with:
+#     python ml/medicine_catalog.py build [csv_path]
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from bisect import bisect_left
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): a stale snapshot is not rebuilt, the CSV is compiled in memory instead
+    fcntl = None
+
+from medicine_autocomplete import PrefixIndex, compile_prefix_index
+from medicine_matching import CandidateIndex
+from medicine_ingredients import IngredientIndex, SubstituteGroups, compile_ingredient_index, compile_substitute_groups
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.path.join(BASE_DIR, 'ml', 'Extensive_A_Z_medicines_dataset_of_India.csv')
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'ml', 'catalog_snapshot')
+
+logger = logging.getLogger(__name__)
+
+# A CSV modified this recently may still be being written; catalog_changed waits for it to settle
+SETTLE_SECONDS = 5
+
+# Bump whenever the layout of the snapshot arrays changes
+SNAPSHOT_FORMAT_VERSION = 6
+
+SEPARATOR = '\x00'
+
+# Categorical columns: each is stored as a table of distinct values plus one code per row
+CODED_COLUMNS = {
+    'name': 'name',
+    'composition': 'composition',
+    'manufacturer': 'manufacturer_name',
+    'pack_size': 'pack_size_label',
+}
+PRICE_COLUMN = 'price(₹)'
+# Columns the extracted brand name / composition are matched against
+MATCH_COLUMNS = ('name', 'composition')
+# Parsed into the ingredient index and substitute groups (see medicine_ingredients.py)
+INGREDIENT_COLUMNS = ('short_composition1', 'short_composition2')
+SUBSTITUTE_ARRAYS = ('substitute_group', 'substitute_indptr', 'substitute_members', 'substitute_cheaper')
+
+
+class StringTable:
+    """
+    A list of strings stored as one UTF-8 blob plus byte offsets.
+    Both arrays can be memory-mapped, and the whole table decodes with a single split.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        strings = [s.replace(SEPARATOR, '') for s in strings]
+        blob = SEPARATOR.join(strings).encode('utf-8')
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        # Each string is followed by one separator byte (the last one implicitly)
+        np.cumsum([len(s.encode('utf-8')) + 1 for s in strings], out=offsets[1:])
+        return cls(np.frombuffer(blob, dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1] - 1
+        return bytes(self.blob[start:end]).decode('utf-8')
+
+    def tolist(self):
+        if len(self) == 0:
+            return []
+        return bytes(self.blob).decode('utf-8').split(SEPARATOR)
+
+    def save(self, directory, name):
+        np.save(os.path.join(directory, f'{name}.blob.npy'), self.blob)
+        np.save(os.path.join(directory, f'{name}.offsets.npy'), self.offsets)
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode='r'):
+        blob = np.load(os.path.join(directory, f'{name}.blob.npy'), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(directory, f'{name}.offsets.npy'), mmap_mode=mmap_mode)
+        return cls(blob, offsets)
+
+
+def file_fingerprint(path, with_hash=True):
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+def read_medicine_csv(csv_path=DB_PATH):
+    medicine_db = pd.read_csv(csv_path)
+    medicine_db['short_composition1'] = medicine_db['short_composition1'].fillna('')
+    medicine_db['short_composition2'] = medicine_db['short_composition2'].fillna('')
+    medicine_db['composition'] = medicine_db['short_composition1'] + ' ' + medicine_db['short_composition2']
+    medicine_db['composition'] = medicine_db['composition'].str.strip()
+    return medicine_db
+
+
+def compile_catalog(medicine_db, with_match_indexes=True):
+    """
+    Turn the parsed catalog DataFrame into the flat arrays stored in a snapshot.
+    The fuzzy-match candidate indexes are the slowest part; without them the
+    matchers build their own on first use.
+    """
+    arrays = {}
+    for key, column in CODED_COLUMNS.items():
+        # factorize keeps first-appearance order, matching Series.unique(); missing values get code -1
+        codes, uniques = pd.factorize(medicine_db[column], sort=False)
+        codes = codes.astype(np.int32)
+        arrays[f'{key}_choices'] = StringTable.from_strings([str(value) for value in uniques])
+        arrays[f'{key}_codes'] = codes
+        # Lookup key: first row holding each distinct value (what `.iloc[0]` would pick)
+        present, first_rows = np.unique(codes, return_index=True)
+        first_row = np.full(len(uniques), -1, dtype=np.int32)
+        first_row[present[present >= 0]] = first_rows[present >= 0]
+        arrays[f'{key}_first_row'] = first_row
+    for key in MATCH_COLUMNS:
+        # Distinct values in sorted order, so find_row can bisect instead of keeping a dict per worker
+        choices = arrays[f'{key}_choices'].tolist()
+        arrays[f'{key}_sorted'] = np.array(sorted(range(len(choices)), key=choices.__getitem__), dtype=np.int32)
+        if with_match_indexes:
+            for name, value in CandidateIndex(choices).to_arrays().items():
+                arrays[f'{key}_index_{name}'] = StringTable.from_strings(value) if isinstance(value, list) else value
+    arrays['prices'] = pd.to_numeric(medicine_db[PRICE_COLUMN], errors='coerce').to_numpy(dtype=np.float64)
+    compositions = [medicine_db[column].tolist() for column in INGREDIENT_COLUMNS]
+    keys, arrays['ingredient_indptr'], arrays['ingredient_rows'] = compile_ingredient_index(compositions)
+    arrays['ingredient_keys'] = StringTable.from_strings(keys)
+    prefix_keys, arrays['prefix_ranks'] = compile_prefix_index(arrays['name_choices'].tolist())
+    arrays['prefix_keys'] = StringTable.from_strings(prefix_keys)
+    (arrays['substitute_group'], arrays['substitute_indptr'], arrays['substitute_members'],
+     arrays['substitute_cheaper']) = compile_substitute_groups(compositions, arrays['prices'])
+    return arrays
+
+
+def snapshot_dir_for(csv_path):
+    """The snapshot folder of a CSV."""
+    if os.path.abspath(csv_path) == os.path.abspath(DB_PATH):
+        return SNAPSHOT_DIR
+    return f'{os.path.splitext(csv_path)[0]}.snapshot'
+
+
+def build_snapshot(csv_path=DB_PATH, snapshot_dir=None):
+    """Compile the CSV into a snapshot folder (by default its own). The folder is replaced atomically."""
+    snapshot_dir = snapshot_dir or snapshot_dir_for(csv_path)
+    start_time = time.time()
+    fingerprint = file_fingerprint(csv_path)
+    arrays = compile_catalog(read_medicine_csv(csv_path))
+
+    tmp_dir = f'{snapshot_dir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, value in arrays.items():
+        if isinstance(value, StringTable):
+            value.save(tmp_dir, name)
+        else:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), value)
+
+    meta = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'catalog_version': fingerprint['sha256'][:16],
+        'source': {'file': os.path.basename(csv_path), **fingerprint},
+        'rows': int(len(arrays['prices'])),
+        'built_at': time.time(),
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    old_dir = f'{snapshot_dir}.old-{os.getpid()}'
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old_dir)
+    os.rename(tmp_dir, snapshot_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    meta['build_seconds'] = round(time.time() - start_time, 3)
+    return meta
+
+
+def rebuild_snapshot(csv_path=DB_PATH, snapshot_dir=None):
+    """
+    Rebuild a stale snapshot once for every process sharing it: the first one to take
+    the lock builds it, the others block on the lock and then find it fresh. Returns
+    False when the snapshot can't be rebuilt here (no file locks, or a read-only folder).
+    """
+    snapshot_dir = snapshot_dir or snapshot_dir_for(csv_path)
+    if fcntl is None or not os.path.exists(csv_path):
+        return False
+    try:
+        with open(f'{snapshot_dir}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another process may have rebuilt it while this one waited for the lock
+            if not snapshot_is_fresh(read_snapshot_meta(snapshot_dir), csv_path)[0]:
+                logger.info(f"Rebuilding the medicine catalog snapshot from {csv_path}")
+                build_snapshot(csv_path, snapshot_dir)
+    except OSError as e:
+        logger.warning(f"Could not rebuild the medicine catalog snapshot: {e}")
+        return False
+    return True
+
+
+def read_snapshot_meta(snapshot_dir=SNAPSHOT_DIR):
+    try:
+        with open(os.path.join(snapshot_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def snapshot_is_fresh(meta, csv_path=DB_PATH):
+    """Return (fresh, reason) for a snapshot's meta against the current CSV."""
+    if meta is None:
+        return False, 'no snapshot'
+    if meta.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+        return False, 'snapshot format changed'
+    source = meta.get('source', {})
+    if source.get('file') != os.path.basename(csv_path):
+        return False, f"snapshot of another csv ({source.get('file')})"
+    if not os.path.exists(csv_path):
+        # Deployments may ship only the snapshot of the default catalog; any other CSV must exist
+        if os.path.abspath(csv_path) == os.path.abspath(DB_PATH):
+            return True, 'csv missing, using snapshot as is'
+        return False, 'csv missing'
+    current = file_fingerprint(csv_path, with_hash=False)
+    if current['size'] != source.get('size'):
+        return False, 'csv size changed'
+    if current['mtime_ns'] != source.get('mtime_ns'):
+        # A checkout or copy touches mtime without changing content, so confirm with the hash
+        if file_fingerprint(csv_path)['sha256'] != source.get('sha256'):
+            return False, 'csv content changed'
+    return True, 'fresh'
+
+
+def load_snapshot_arrays(snapshot_dir=SNAPSHOT_DIR):
+    arrays = {}
+    for key in CODED_COLUMNS:
+        arrays[f'{key}_choices'] = StringTable.load(snapshot_dir, f'{key}_choices')
+        arrays[f'{key}_codes'] = np.load(os.path.join(snapshot_dir, f'{key}_codes.npy'), mmap_mode='r')
+        arrays[f'{key}_first_row'] = np.load(os.path.join(snapshot_dir, f'{key}_first_row.npy'), mmap_mode='r')
+    arrays['prices'] = np.load(os.path.join(snapshot_dir, 'prices.npy'), mmap_mode='r')
+    arrays['ingredient_keys'] = StringTable.load(snapshot_dir, 'ingredient_keys')
+    arrays['prefix_keys'] = StringTable.load(snapshot_dir, 'prefix_keys')
+    for name in SUBSTITUTE_ARRAYS + ('ingredient_indptr', 'ingredient_rows', 'prefix_ranks'):
+        arrays[name] = np.load(os.path.join(snapshot_dir, f'{name}.npy'), mmap_mode='r')
+    for key in MATCH_COLUMNS:
+        arrays[f'{key}_sorted'] = np.load(os.path.join(snapshot_dir, f'{key}_sorted.npy'), mmap_mode='r')
+        for name in CandidateIndex.ARRAYS:
+            if name.endswith('_vocab'):
+                arrays[f'{key}_index_{name}'] = StringTable.load(snapshot_dir, f'{key}_index_{name}')
+            else:
+                arrays[f'{key}_index_{name}'] = np.load(os.path.join(snapshot_dir, f'{key}_index_{name}.npy'), mmap_mode='r')
+    return arrays
+
+
+class MedicineCatalog:
+    """
+    The medicine catalog as flat column arrays, loaded from a snapshot or the CSV.
+
+    Only the columns the API returns are kept, as categorical codes into string tables.
+    From a snapshot every array is memory-mapped, so worker processes share one copy in
+    the page cache; the only per-process Python objects are the name and composition
+    lists the fuzzy matchers score against.
+    """
+
+    def __init__(self, arrays, version, source):
+        self.arrays = arrays
+        self.version = version
+        self.source = source
+        self.load_seconds = None
+        # size and mtime of the CSV this catalog was built from, for cheap change checks
+        self.fingerprint = None
+
+    def __len__(self):
+        return len(self.arrays['prices'])
+
+    @cached_property
+    def medicine_names(self):
+        # Distinct, non-empty names. Duplicates never change extractOne's best match or score.
+        return self.arrays['name_choices'].tolist()
+
+    @cached_property
+    def medicine_compositions(self):
+        return self.arrays['composition_choices'].tolist()
+
+    def match_choices(self, column):
+        return self.medicine_names if column == 'name' else self.medicine_compositions
+
+    def candidate_index(self, column):
+        """The precompiled CandidateIndex over a match column's choices, or None if the snapshot has none."""
+        if f'{column}_index_token_docs' not in self.arrays:
+            return None
+        arrays = {name: self.arrays[f'{column}_index_{name}'] for name in CandidateIndex.ARRAYS}
+        return CandidateIndex.from_arrays(len(self.match_choices(column)), arrays)
+
+    @cached_property
+    def ingredient_index(self):
+        return IngredientIndex(self.arrays['ingredient_keys'], self.arrays['ingredient_indptr'], self.arrays['ingredient_rows'])
+
+    @cached_property
+    def prefix_index(self):
+        return PrefixIndex(self.arrays['prefix_keys'], self.arrays['prefix_ranks'], self.medicine_names)
+
+    @cached_property
+    def substitutes(self):
+        return SubstituteGroups(*(self.arrays[name] for name in SUBSTITUTE_ARRAYS))
+
+    def find_row(self, column, value):
+        """Row of the first medicine whose `column` ('name' or 'composition') equals `value`, or None."""
+        choices = self.match_choices(column)
+        order = self.arrays[f'{column}_sorted']
+        position = bisect_left(order, value, key=choices.__getitem__)
+        if position < len(order) and choices[order[position]] == value:
+            return int(self.arrays[f'{column}_first_row'][order[position]])
+        return None
+
+    def row(self, row_id):
+        """The fields the identify response returns, read from the coded column arrays."""
+        def decode(key):
+            code = self.arrays[f'{key}_codes'][row_id]
+            return self.arrays[f'{key}_choices'][code] if code >= 0 else 'N/A'
+
+        price = float(self.arrays['prices'][row_id])
+        return {
+            'name': decode('name'),
+            'composition': decode('composition'),
+            'manufacturer_name': decode('manufacturer'),
+            PRICE_COLUMN: price if price == price else 'N/A',
+            'pack_size_label': decode('pack_size'),
+        }
+
+    def medicine(self, row_id):
+        """A row in the shape the API returns it."""
+        row = self.row(row_id)
+        return {
+            "id": int(row_id),
+            "brand_name": row.get('name', 'N/A'),
+            "composition": row.get('composition', 'N/A'),
+            "manufacturer": row.get('manufacturer_name', 'N/A'),
+            "price_inr": row.get(PRICE_COLUMN, 'N/A'),
+            "pack_size": row.get('pack_size_label', 'N/A'),
+        }
+
+    def warm_up(self):
+        """Decode the choice lists and build the lookup structures now rather than on the first request."""
+        self.medicine_names, self.medicine_compositions
+        self.ingredient_index.warm_up()
+        self.substitutes, self.prefix_index
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'source': self.source,
+            'rows': len(self),
+            'load_seconds': self.load_seconds,
+            'ingredients': self.ingredient_index.describe() if 'ingredient_index' in self.__dict__ else None,
+            'substitutes': self.substitutes.describe() if 'substitutes' in self.__dict__ else None,
+        }
+
+
+def load_catalog(csv_path=DB_PATH, snapshot_dir=None, rebuild=False):
+    """
+    Load the catalog from a fresh snapshot (by default the CSV's own) if there is one,
+    otherwise from the CSV. With `rebuild`, a stale snapshot is rebuilt first (see
+    rebuild_snapshot) and mapped.
+    """
+    snapshot_dir = snapshot_dir or snapshot_dir_for(csv_path)
+    start_time = time.time()
+    meta = read_snapshot_meta(snapshot_dir)
+    fresh, reason = snapshot_is_fresh(meta, csv_path)
+    if not fresh and rebuild and rebuild_snapshot(csv_path, snapshot_dir):
+        meta = read_snapshot_meta(snapshot_dir)
+        fresh, reason = snapshot_is_fresh(meta, csv_path)
+    if fresh:
+        catalog = MedicineCatalog(load_snapshot_arrays(snapshot_dir), meta['catalog_version'], 'snapshot')
+        catalog.fingerprint = {key: meta['source'].get(key) for key in ('size', 'mtime_ns')}
+    else:
+        if meta is not None:
+            logger.warning(f"Medicine catalog snapshot is stale ({reason}); reading {csv_path}")
+        fingerprint = file_fingerprint(csv_path)
+        arrays = compile_catalog(read_medicine_csv(csv_path), with_match_indexes=False)
+        catalog = MedicineCatalog(arrays, fingerprint['sha256'][:16], 'csv')
+        catalog.fingerprint = {key: fingerprint[key] for key in ('size', 'mtime_ns')}
+    catalog.load_seconds = round(time.time() - start_time, 4)
+    return catalog
+
+
+def catalog_changed(catalog, csv_path=DB_PATH, snapshot_dir=None):
+    """
+    (changed, reason) for the catalog on disk against a loaded catalog. An unchanged
+    CSV costs one stat; the file is only hashed when its size or mtime moved.
+    Without a CSV (snapshot-only deployments), a new snapshot version counts as a change.
+    """
+    if not os.path.exists(csv_path):
+        meta = read_snapshot_meta(snapshot_dir or snapshot_dir_for(csv_path))
+        if meta is not None and meta.get('catalog_version') != catalog.version:
+            return True, 'snapshot version changed'
+        return False, 'unchanged'
+
+    current = file_fingerprint(csv_path, with_hash=False)
+    if current == catalog.fingerprint:
+        return False, 'unchanged'
+    if time.time() - current['mtime_ns'] / 1e9 < SETTLE_SECONDS:
+        return False, 'csv is being written'
+    if file_fingerprint(csv_path)['sha256'][:16] == catalog.version:
+        # Touched or copied without a content change: remember it so the next check is a stat again
+        catalog.fingerprint = current
+        return False, 'csv touched, content unchanged'
+    return True, 'csv content changed'
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'build':
+        csv_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+        print(json.dumps(build_snapshot(csv_path), indent=2))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'status':
+        csv_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+        meta = read_snapshot_meta(snapshot_dir_for(csv_path))
+        fresh, reason = snapshot_is_fresh(meta, csv_path)
+        print(json.dumps({'fresh': fresh, 'reason': reason, 'meta': meta}, indent=2))
+    else:
+        print("Usage: python ml/medicine_catalog.py build [csv_path] | status [csv_path]")
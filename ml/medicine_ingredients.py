@@ -0,0 +1,220 @@
+# ml/medicine_ingredients.py
+#
+# Ingredient-level index over the catalog's compositions.
+#
+# short_composition1/short_composition2 hold one salt each, e.g. "Paracetamol (500mg)".
+# They are parsed into normalized (salt, strength) pairs when the catalog is compiled,
+# and every row is posted under two kinds of key: the salt alone ("paracetamol") and
+# the salt at its strength ("paracetamol|500mg"). The postings are CSR arrays stored in
+# the catalog snapshot, so "all medicines containing X [at strength Y] and Z" is an
+# intersection of a few sorted row lists instead of a scan over every composition.
+#
+# The same parse also yields generic-substitute groups: rows with exactly the same set
+# of (salt, strength) pairs, each group's members stored sorted by price, so the K
+# cheapest substitutes of a medicine are a K-element slice.
+
+import re
+from array import array
+from functools import cached_property
+
+import numpy as np
+from rapidfuzz import fuzz
+from rapidfuzz import process
+
+from medicine_matching import build_postings
+
+KEY_SEPARATOR = '|'
+
+INGREDIENT_PATTERN = re.compile(r'^(?P<salt>.+?)\s*\((?P<strength>[^()]*)\)\s*$')
+# Free-text queries may write the strength without brackets: "paracetamol 500 mg"
+QUERY_STRENGTH_PATTERN = re.compile(
+    r'^(?P<salt>.+?)\s+(?P<strength>\d[\d.]*\s*(?:mg|mcg|µg|g|gm|ml|iu|%)\S*(?:\s*w/[wv])?)$',
+    re.IGNORECASE,
+)
+UNIT_ALIASES = (('µg', 'mcg'), ('microgram', 'mcg'), ('gm', 'g'))
+MISSING_STRENGTHS = ('', 'na', 'n/a', 'nil')
+
+
+def normalize_salt(text):
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text.lower()).split())
+
+
+def normalize_strength(text):
+    strength = re.sub(r'\s+', '', text.lower())
+    if strength in MISSING_STRENGTHS:
+        return None
+    for alias, unit in UNIT_ALIASES:
+        strength = strength.replace(alias, unit)
+    # "500.0mg" and "500mg" are the same strength
+    return re.sub(r'(\d+)\.0+(?!\d)', r'\1', strength)
+
+
+def parse_ingredients(composition):
+    """
+    Normalized (salt, strength) pairs of a composition string such as
+    "Amoxycillin (500mg) + Clavulanic Acid (125mg)". strength is None when not given.
+    """
+    ingredients = []
+    for part in re.split(r'\s*[+,]\s*', composition or ''):
+        part = part.strip()
+        if not part:
+            continue
+        match = INGREDIENT_PATTERN.match(part) or QUERY_STRENGTH_PATTERN.match(part)
+        salt, strength = (match.group('salt'), match.group('strength')) if match else (part, '')
+        salt = normalize_salt(salt)
+        if salt:
+            ingredients.append((salt, normalize_strength(strength)))
+    return ingredients
+
+
+def ingredient_key(salt, strength=None):
+    return f'{salt}{KEY_SEPARATOR}{strength}' if strength else salt
+
+
+def compile_ingredient_index(composition_columns):
+    """
+    Build (keys, indptr, rows) from per-row composition columns (a list of
+    equal-length string sequences). Each distinct string is parsed only once.
+    """
+    key_ids = {}
+    parsed = {}
+    key_column = array('i')
+    row_column = array('i')
+    for row, parts in enumerate(zip(*composition_columns)):
+        row_keys = set()
+        for part in parts:
+            if part not in parsed:
+                parsed[part] = [
+                    key for salt, strength in parse_ingredients(part)
+                    for key in ((salt, ingredient_key(salt, strength)) if strength else (salt,))
+                ]
+            row_keys.update(parsed[part])
+        for key in row_keys:
+            key_column.append(key_ids.setdefault(key, len(key_ids)))
+            row_column.append(row)
+    indptr, rows = build_postings(key_column, row_column, len(key_ids))
+    return list(key_ids), indptr, rows
+
+
+class IngredientIndex:
+    """Rows of the catalog by salt and by (salt, strength), as CSR postings in ascending row order."""
+
+    def __init__(self, keys, indptr, rows):
+        self.keys = keys
+        self.indptr = indptr
+        self.rows = rows
+
+    @cached_property
+    def key_ids(self):
+        return {key: i for i, key in enumerate(self.keys.tolist())}
+
+    @cached_property
+    def salts(self):
+        return [key for key in self.key_ids if KEY_SEPARATOR not in key]
+
+    def postings(self, salt, strength=None):
+        key_id = self.key_ids.get(ingredient_key(salt, strength))
+        if key_id is None:
+            return self.rows[:0]
+        return self.rows[self.indptr[key_id]:self.indptr[key_id + 1]]
+
+    def search(self, ingredients):
+        """Rows containing every (salt, strength) in `ingredients`, ascending."""
+        postings = sorted((self.postings(salt, strength) for salt, strength in ingredients), key=len)
+        if not postings:
+            return self.rows[:0]
+        # Intersect starting from the shortest list, so each step is as small as possible
+        result = np.asarray(postings[0])
+        for other in postings[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, other, assume_unique=True)
+        return result
+
+    def suggest(self, salt, limit=5):
+        """Known salts closest to a salt that has no postings."""
+        return [choice for choice, _, _ in process.extract(salt, self.salts, scorer=fuzz.WRatio, limit=limit)]
+
+    def warm_up(self):
+        self.key_ids, self.salts
+
+    def describe(self):
+        return {'keys': len(self.keys), 'salts': len(self.salts), 'postings': int(len(self.rows))}
+
+
+def compile_substitute_groups(composition_columns, prices):
+    """
+    Group rows with the same set of (salt, strength) pairs. Returns (group_of, indptr,
+    members, cheaper_count): the group of each row (-1 when a row has no ingredients or
+    an ingredient without a strength), the members of each group sorted by price with
+    unknown prices last, and for each row how many members of its group are strictly cheaper.
+    """
+    signatures = {}
+    parsed = {}
+    group_of = np.full(len(prices), -1, dtype=np.int32)
+    for row, parts in enumerate(zip(*composition_columns)):
+        ingredients = set()
+        for part in parts:
+            if part not in parsed:
+                parsed[part] = parse_ingredients(part)
+            ingredients.update(parsed[part])
+        if not ingredients or any(strength is None for _, strength in ingredients):
+            continue
+        group_of[row] = signatures.setdefault(tuple(sorted(ingredients)), len(signatures))
+
+    grouped = np.flatnonzero(group_of >= 0)
+    sort_prices = np.where(np.isnan(prices), np.inf, prices)
+    # By group, then price, then row
+    order = np.lexsort((grouped, sort_prices[grouped], group_of[grouped]))
+    members = grouped[order].astype(np.int32)
+    indptr = np.zeros(len(signatures) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group_of[members], minlength=len(signatures)), out=indptr[1:])
+
+    # Members strictly cheaper than a row = its offset in the group up to the first member at its price
+    member_groups = group_of[members]
+    member_prices = sort_prices[members]
+    positions = np.arange(len(members))
+    run_starts = np.ones(len(members), dtype=bool)
+    run_starts[1:] = (member_groups[1:] != member_groups[:-1]) | (member_prices[1:] != member_prices[:-1])
+    first_at_price = np.maximum.accumulate(np.where(run_starts, positions, 0))
+    cheaper_count = np.zeros(len(prices), dtype=np.int32)
+    cheaper_count[members] = np.where(np.isinf(member_prices), 0, first_at_price - indptr[member_groups])
+    return group_of, indptr, members, cheaper_count
+
+
+class SubstituteGroups:
+    """Composition-equivalence groups with members pre-sorted by price."""
+
+    def __init__(self, group_of, indptr, members, cheaper_count):
+        self.group_of = group_of
+        self.indptr = indptr
+        self.members = members
+        self.cheaper_count = cheaper_count
+
+    def group(self, row):
+        """Every row with the same ingredients as `row` (itself included), cheapest first."""
+        group = self.group_of[row]
+        if group < 0:
+            return self.members[:0]
+        return self.members[self.indptr[group]:self.indptr[group + 1]]
+
+    def cheaper(self, row, limit):
+        """Up to `limit` strictly cheaper substitutes of `row`, cheapest first. O(limit)."""
+        group = self.group_of[row]
+        if group < 0:
+            return self.members[:0]
+        start = self.indptr[group]
+        return self.members[start:start + min(limit, self.cheaper_count[row])]
+
+    def alternatives(self, row, limit):
+        """Up to `limit` substitutes of `row` at any price, cheapest first."""
+        members = self.group(row)[:limit + 1]
+        return members[members != row][:limit]
+
+    def describe(self):
+        sizes = np.diff(self.indptr)
+        return {
+            'groups': int(len(sizes)),
+            'groups_with_substitutes': int(np.count_nonzero(sizes > 1)),
+            'grouped_rows': int(len(self.members)),
+        }
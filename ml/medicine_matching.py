@@ -0,0 +1,394 @@
+# ml/medicine_matching.py
+#
+# Fuzzy matching of the brand name / composition that Gemini extracts against the
+# catalog choice lists.
+#
+# A full `process.extractOne` scan scores every choice in the catalog. CandidateIndex
+# is an inverted index over whole tokens and character trigrams that narrows the
+# choices to a small candidate set first; only the candidates go through the scorer.
+# When the best candidate scores below the trusted threshold the matcher falls back
+# to the full scan, so low-confidence answers (closest_match) stay exact as well.
+#
+# The candidate set is a heuristic, so a trusted answer is then checked: from the
+# character counts of every choice, CandidateIndex bounds the score each one could
+# reach, and every choice whose bound reaches the best candidate's score is scored as
+# well. The result is the full scan's, ties included, not an approximation of it.
+#
+# RapidFuzzMatcher is a second backend: it scores a batch of queries against every
+# choice in one multi-threaded rapidfuzz `cdist` call, with a score cutoff that lets
+# rapidfuzz skip hopeless choices early. It reproduces thefuzz's preprocessing and
+# rounding, so both backends return the same match and score.
+#
+# test_medicine_matching.py checks both backends against the thefuzz full scan on a
+# fixed catalog and query corpus (ml/fixtures). On the full catalog, check them with:
+#     python ml/medicine_matching.py verify [number_of_queries | queries_file]
+
+import json
+import os
+import random
+import sys
+import time
+from array import array
+
+import numpy as np
+from rapidfuzz import fuzz as rf_fuzz
+from rapidfuzz import process as rf_process
+from rapidfuzz.utils import default_process
+from thefuzz import process, fuzz, utils
+
+NGRAM_SIZE = 3
+CANDIDATE_LIMIT = 500
+# Characters left by thefuzz preprocessing (full_process with force_ascii); anything else
+# shares the last count, which can only raise the score bounds
+BOUND_ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789 '
+
+# Same threshold analyze_medicine.py uses to accept a match
+MIN_TRUSTED_SCORE = 85
+
+MATCH_BACKENDS = ('thefuzz', 'rapidfuzz')
+
+
+def tokens_of(text):
+    return set(text.split())
+
+
+def ngrams_of(text, size=NGRAM_SIZE):
+    padded = f' {text} '
+    return {padded[i:i + size] for i in range(len(padded) - size + 1)}
+
+
+def token_set_text(text):
+    """The distinct tokens of a processed string; token_set_ratio only compares these."""
+    return ' '.join(sorted(tokens_of(text)))
+
+
+def scorer_text(text):
+    """A string as thefuzz preprocesses it before token_set_ratio."""
+    return utils.full_process(utils.full_process(text), force_ascii=True)
+
+
+def char_counts(texts):
+    """Per-character counts of `texts`: array of shape (len(BOUND_ALPHABET) + 1, len(texts))."""
+    lookup = np.full(256, len(BOUND_ALPHABET), dtype=np.int64)
+    lookup[np.frombuffer(BOUND_ALPHABET.encode(), dtype=np.uint8)] = np.arange(len(BOUND_ALPHABET))
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    chars = lookup[np.frombuffer(''.join(texts).encode('ascii', 'replace'), dtype=np.uint8)]
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    counts = np.zeros((len(BOUND_ALPHABET) + 1, len(texts)), dtype=np.uint16)
+    for char in np.unique(chars):
+        counts[char] = np.bincount(rows[chars == char], minlength=len(texts))
+    return counts
+
+
+def build_postings(gram_ids, doc_ids, vocab_size):
+    """CSR postings: documents of gram g are indices[indptr[g]:indptr[g + 1]], in ascending order."""
+    gram_ids = np.frombuffer(gram_ids, dtype=np.int32)
+    doc_ids = np.frombuffer(doc_ids, dtype=np.int32)
+    order = np.argsort(gram_ids, kind='stable')
+    indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(gram_ids, minlength=vocab_size), out=indptr[1:])
+    return indptr, doc_ids[order]
+
+
+class CandidateIndex:
+    """Token and character-trigram inverted index over a list of choices."""
+
+    # Stored in the catalog snapshot (see to_arrays / from_arrays)
+    ARRAYS = ('token_vocab', 'token_indptr', 'token_docs', 'gram_vocab', 'gram_indptr', 'gram_docs', 'char_counts', 'set_lengths')
+
+    def __init__(self, choices, candidate_limit=CANDIDATE_LIMIT, max_token_df=None):
+        self._configure(len(choices), candidate_limit, max_token_df)
+
+        self.token_ids = {}
+        self.gram_ids = {}
+        token_pairs = (array('i'), array('i'))
+        gram_pairs = (array('i'), array('i'))
+        for doc_id, choice in enumerate(choices):
+            text = default_process(choice)
+            for token in tokens_of(text):
+                token_pairs[0].append(self.token_ids.setdefault(token, len(self.token_ids)))
+                token_pairs[1].append(doc_id)
+            for gram in ngrams_of(text):
+                gram_pairs[0].append(self.gram_ids.setdefault(gram, len(self.gram_ids)))
+                gram_pairs[1].append(doc_id)
+
+        self.token_indptr, self.token_docs = build_postings(*token_pairs, len(self.token_ids))
+        self.gram_indptr, self.gram_docs = build_postings(*gram_pairs, len(self.gram_ids))
+        self._count_grams()
+
+        # What token_set_ratio sees of each choice, for score_bounds()
+        set_texts = [token_set_text(utils.full_process(choice, force_ascii=True)) for choice in choices]
+        self.char_counts = char_counts(set_texts)
+        self.set_lengths = np.array([len(text) for text in set_texts], dtype=np.int32)
+
+    def _configure(self, size, candidate_limit, max_token_df):
+        self.size = size
+        self.candidate_limit = candidate_limit
+        # Tokens such as "tablet" occur in most names and would select the whole catalog
+        self.max_token_df = max_token_df or max(1000, self.size // 50)
+
+    def _count_grams(self):
+        # Distinct trigrams per choice, for the Dice ranking in candidates()
+        self.gram_counts = np.bincount(self.gram_docs, minlength=self.size).astype(np.int32)
+
+    def to_arrays(self):
+        """Vocabularies (lists of strings) and CSR postings, in the order of ARRAYS."""
+        return {
+            'token_vocab': list(self.token_ids),
+            'token_indptr': self.token_indptr,
+            'token_docs': self.token_docs,
+            'gram_vocab': list(self.gram_ids),
+            'gram_indptr': self.gram_indptr,
+            'gram_docs': self.gram_docs,
+            'char_counts': self.char_counts,
+            'set_lengths': self.set_lengths,
+        }
+
+    @classmethod
+    def from_arrays(cls, size, arrays, candidate_limit=CANDIDATE_LIMIT, max_token_df=None):
+        """Rebuild an index from to_arrays() output; postings may be memory-mapped and vocabularies any sequence with tolist()."""
+        index = cls.__new__(cls)
+        index._configure(size, candidate_limit, max_token_df)
+        index.token_ids = {token: i for i, token in enumerate(arrays['token_vocab'].tolist())}
+        index.gram_ids = {gram: i for i, gram in enumerate(arrays['gram_vocab'].tolist())}
+        index.token_indptr, index.token_docs = arrays['token_indptr'], arrays['token_docs']
+        index.gram_indptr, index.gram_docs = arrays['gram_indptr'], arrays['gram_docs']
+        index.char_counts, index.set_lengths = arrays['char_counts'], arrays['set_lengths']
+        index._count_grams()
+        return index
+
+    def _postings(self, indptr, docs, gram_id):
+        return docs[indptr[gram_id]:indptr[gram_id + 1]]
+
+    def candidates(self, query):
+        """Sorted choice indices worth scoring for `query`, or None if the query has no usable text."""
+        text = default_process(query)
+        if not text:
+            return None
+
+        selected = []
+        token_postings = []
+        for token in tokens_of(text):
+            token_id = self.token_ids.get(token)
+            if token_id is None:
+                continue
+            docs = self._postings(self.token_indptr, self.token_docs, token_id)
+            token_postings.append(docs)
+            if len(docs) <= self.max_token_df:
+                selected.append(docs)
+
+        if token_postings:
+            # Choices holding every known query token share the largest token intersection,
+            # and with it the same lower bound on their score (all of them score 100 when
+            # every query token is known). The earliest of them win the full scan's ties,
+            # so keep the first ones even for very common tokens
+            token_postings.sort(key=len)
+            containing = token_postings[0]
+            for docs in token_postings[1:]:
+                containing = np.intersect1d(containing, docs, assume_unique=True)
+            selected.append(containing[:self.candidate_limit])
+
+        grams = ngrams_of(text)
+        gram_ids = [self.gram_ids[gram] for gram in grams if gram in self.gram_ids]
+        if gram_ids:
+            postings = np.concatenate([self._postings(self.gram_indptr, self.gram_docs, g) for g in gram_ids])
+            overlap = np.bincount(postings, minlength=self.size)
+            if self.candidate_limit < self.size:
+                # Dice coefficient of the trigram sets: a long choice that shares many grams
+                # with a short query is still far from it
+                similarity = overlap / (len(grams) + self.gram_counts)
+                cutoff = np.partition(similarity, self.size - self.candidate_limit)[self.size - self.candidate_limit]
+                # Every choice tied with the cutoff is kept, so ties never depend on partition order
+                top = np.flatnonzero(similarity >= cutoff)
+            else:
+                top = np.arange(self.size)
+            selected.append(top[overlap[top] > 0])
+
+        if not selected:
+            return np.empty(0, dtype=np.int32)
+        # Ascending order keeps catalog order, so ties resolve exactly like the full scan
+        return np.unique(np.concatenate(selected))
+
+    def score_bounds(self, query):
+        """
+        An upper bound on fuzz.token_set_ratio(query, choice) for every choice.
+
+        token_set_ratio is the best of three Indel ratios, 2 * LCS / (len(x) + len(y)),
+        between strings built from the distinct query tokens (length lq in all), the
+        distinct choice tokens (lc) and their intersection (ls). The intersection ratios
+        are 2 * ls / (ls + lq) and 2 * ls / (ls + lc), and the third ratio compares
+        rearrangements of the two token sets. No common subsequence or intersection is
+        longer than the characters the two token sets have in common.
+        """
+        text = token_set_text(scorer_text(query))
+        query_counts = char_counts([text])[:, 0]
+        # A common-character count never exceeds the query length, so uint16 is enough
+        common = np.zeros(self.size, dtype=np.uint16)
+        for char in np.flatnonzero(query_counts):
+            common += np.minimum(self.char_counts[char], np.uint16(query_counts[char]))
+        common = common.astype(np.float64)
+        query_length, lengths = len(text), self.set_lengths
+        intersection = np.minimum(common, lengths)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bounds = np.maximum(2 * intersection / (intersection + query_length), 2 * intersection / (intersection + lengths))
+            np.maximum(bounds, 2 * common / (query_length + lengths), out=bounds)
+        return 100 * np.nan_to_num(bounds)
+
+
+class FuzzyMatcher:
+    """Best-match search over one choice list, optionally through a CandidateIndex."""
+
+    def __init__(self, choices, use_index=True, min_trusted_score=MIN_TRUSTED_SCORE, candidate_limit=CANDIDATE_LIMIT, index=None):
+        self.choices = choices
+        self.min_trusted_score = min_trusted_score
+        if use_index and index is None:
+            index = CandidateIndex(choices, candidate_limit=candidate_limit)
+        self.index = index if use_index else None
+        self.stats = {'index_matches': 0, 'rivals_scored': 0, 'full_scans': 0}
+
+    def full_scan(self, term):
+        return process.extractOne(term, self.choices, scorer=fuzz.token_set_ratio)
+
+    def scan(self, term, choice_ids):
+        """extractOne over the choices `choice_ids` (ascending, so ties resolve like the full scan)."""
+        return process.extractOne(term, [self.choices[i] for i in choice_ids], scorer=fuzz.token_set_ratio)
+
+    def best_match(self, term):
+        if self.index is not None:
+            candidate_ids = self.index.candidates(term)
+            if candidate_ids is not None and len(candidate_ids):
+                best = self.scan(term, candidate_ids)
+                if best is not None and best[1] >= self.min_trusted_score:
+                    self.stats['index_matches'] += 1
+                    # extractOne compares unrounded scores, and the best one rounds to best[1]
+                    rivals = np.flatnonzero(self.index.score_bounds(term) >= best[1] - 0.5)
+                    rivals = np.setdiff1d(rivals, candidate_ids, assume_unique=True)
+                    if len(rivals):
+                        self.stats['rivals_scored'] += len(rivals)
+                        best = self.scan(term, np.union1d(candidate_ids, rivals))
+                    return best
+        self.stats['full_scans'] += 1
+        return self.full_scan(term)
+
+    def best_matches(self, terms):
+        return [self.best_match(term) for term in terms]
+
+
+class RapidFuzzMatcher:
+    """Scores a batch of queries against all choices with one multi-threaded rapidfuzz cdist call."""
+
+    def __init__(self, choices, workers=-1, score_cutoff=0):
+        self.choices = choices
+        self.workers = workers
+        self.score_cutoff = score_cutoff
+        # Choices are preprocessed once, the way thefuzz would process them on every call
+        self.processed_choices = [utils.full_process(choice, force_ascii=True) for choice in choices]
+        self.stats = {'batches': 0, 'queries': 0}
+
+    def best_matches(self, terms):
+        """(best_match, score) per term; score is 0 and best_match None when nothing reaches the cutoff."""
+        if not terms:
+            return []
+        queries = [utils.full_process(utils.full_process(term), force_ascii=True) for term in terms]
+        scores = rf_process.cdist(
+            queries, self.processed_choices,
+            scorer=rf_fuzz.token_set_ratio,
+            processor=None,
+            score_cutoff=self.score_cutoff,
+            dtype=np.float64,
+            workers=self.workers,
+        )
+        # argmax keeps the first best unrounded score, like extractOne; thefuzz then rounds it
+        best = scores.argmax(axis=1)
+        self.stats['batches'] += 1
+        self.stats['queries'] += len(terms)
+        results = []
+        for row, choice_id in enumerate(best):
+            score = scores[row, choice_id]
+            if self.score_cutoff and score < self.score_cutoff:
+                results.append((None, 0))
+            else:
+                results.append((self.choices[choice_id], int(round(score))))
+        return results
+
+    def best_match(self, term):
+        return self.best_matches([term])[0]
+
+
+def make_matcher(choices, backend='thefuzz', use_index=True, workers=-1, score_cutoff=0, index=None):
+    """`index` is a prebuilt CandidateIndex over `choices` (e.g. from the catalog snapshot)."""
+    if backend == 'rapidfuzz':
+        return RapidFuzzMatcher(choices, workers=workers, score_cutoff=score_cutoff)
+    if backend == 'thefuzz':
+        return FuzzyMatcher(choices, use_index=use_index, index=index)
+    raise ValueError(f"Unknown match backend '{backend}', expected one of {MATCH_BACKENDS}")
+
+
+def perturb(choice, rng):
+    """A query that looks like a noisy Gemini extraction of `choice`."""
+    words = choice.split()
+    edit = rng.choice(['same', 'drop_word', 'typo', 'case', 'extra_word', 'truncate'])
+    if edit == 'drop_word' and len(words) > 1:
+        words.pop(rng.randrange(len(words)))
+    elif edit == 'typo' and words:
+        i = rng.randrange(len(words))
+        word = words[i]
+        if len(word) > 2:
+            j = rng.randrange(len(word))
+            words[i] = word[:j] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[j + 1:]
+    elif edit == 'case':
+        words = [w.upper() for w in words]
+    elif edit == 'extra_word':
+        words.append(rng.choice(['Tablet', 'Syrup', 'IP', 'Strip', '10s']))
+    elif edit == 'truncate' and len(words) > 1:
+        words = words[:max(1, len(words) // 2)]
+    return ' '.join(words)
+
+
+def verify(choices, queries, matcher):
+    """Compare `matcher` against the thefuzz full scan; returns a summary with any mismatches."""
+    reference = FuzzyMatcher(choices, use_index=False)
+    start_time = time.perf_counter()
+    results = matcher.best_matches(queries)
+    matcher_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    expected = [reference.full_scan(query) for query in queries]
+    full_time = time.perf_counter() - start_time
+
+    mismatches = [
+        {'query': query, 'matcher': result, 'full_scan': full}
+        for query, result, full in zip(queries, results, expected)
+        if tuple(result) != tuple(full)
+    ]
+    return {
+        'queries': len(queries),
+        'mismatches': mismatches,
+        'matcher_ms_per_query': round(1000 * matcher_time / max(1, len(queries)), 3),
+        'full_scan_ms_per_query': round(1000 * full_time / max(1, len(queries)), 3),
+        'stats': matcher.stats,
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        from medicine_catalog import load_catalog
+
+        catalog = load_catalog()
+        argument = sys.argv[2] if len(sys.argv) > 2 else '200'
+        report = {}
+        for column, choices in [('name', catalog.medicine_names), ('composition', catalog.medicine_compositions)]:
+            if os.path.exists(argument):
+                with open(argument) as f:
+                    queries = [line.strip() for line in f if line.strip()]
+            else:
+                rng = random.Random(0)
+                queries = [perturb(rng.choice(choices), rng) for _ in range(int(argument))]
+            report[column] = {
+                'thefuzz_indexed': verify(choices, queries, FuzzyMatcher(choices)),
+                'rapidfuzz_cdist': verify(choices, queries, RapidFuzzMatcher(choices)),
+            }
+        print(json.dumps(report, indent=2, default=str))
+        failed = any(r['mismatches'] for column in report.values() for r in column.values())
+        sys.exit(1 if failed else 0)
+    else:
+        print("Usage: python ml/medicine_matching.py verify [number_of_queries | queries_file]")
@@ -0,0 +1,110 @@
+# ml/test_image_preprocessing.py
+#
+# Upload preprocessing: the JPEG sent upstream fits the byte budget at the highest
+# quality that does, large JPEGs are draft-decoded at a reduced scale, and EXIF
+# orientation is applied before resizing.
+#
+#     cd ml && python -m unittest test_image_preprocessing
+
+import io
+import unittest
+from unittest import mock
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from image_preprocessing import DOWNSCALE_FACTOR, JPEG_QUALITIES, MAX_DOWNSCALES, encode_jpeg, encode_within_budget, preprocess_image
+
+# EXIF Orientation tag: 6 means the stored pixels must be turned 90 degrees clockwise to display
+ORIENTATION = 0x0112
+
+
+def noise(width, height, seed=0):
+    """Random pixels, which JPEG compresses badly."""
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def jpeg_file(image, orientation=None):
+    buffer = io.BytesIO()
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[ORIENTATION] = orientation
+    image.save(buffer, format='JPEG', quality=90, exif=exif)
+    buffer.seek(0)
+    return buffer
+
+
+class EncodeWithinBudgetTest(unittest.TestCase):
+    def test_highest_quality_that_fits(self):
+        image = noise(256, 256)
+        sizes = {quality: len(encode_jpeg(image, quality)) for quality in JPEG_QUALITIES}
+        budget = (sizes[75] + sizes[85]) // 2
+        encoded, data, quality = encode_within_budget(image, budget)
+        self.assertEqual((quality, encoded.size), (75, (256, 256)))
+        self.assertLessEqual(len(data), budget)
+        self.assertEqual(Image.open(io.BytesIO(data)).format, 'JPEG')
+
+    def test_downscales_when_the_lowest_quality_is_over_budget(self):
+        image = noise(256, 256)
+        budget = len(encode_jpeg(image, JPEG_QUALITIES[-1])) // 2
+        encoded, data, _ = encode_within_budget(image, budget)
+        self.assertLessEqual(len(data), budget)
+        self.assertLess(encoded.size[0], 256)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, encoded.size)
+
+    def test_unreachable_budget_returns_the_smallest_attempt(self):
+        encoded, data, quality = encode_within_budget(noise(256, 256), 100)
+        side = 256
+        for _ in range(MAX_DOWNSCALES):
+            side = int(side * DOWNSCALE_FACTOR)
+        self.assertEqual(quality, JPEG_QUALITIES[-1])
+        self.assertEqual(encoded.size, (side, side))
+        self.assertGreater(len(data), 100)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, encoded.size)
+
+
+class PreprocessImageTest(unittest.TestCase):
+    def test_large_jpeg_is_draft_decoded_then_resized(self):
+        decoded_sizes = []
+        transpose = ImageOps.exif_transpose
+
+        def exif_transpose(image):
+            decoded_sizes.append(image.size)
+            return transpose(image)
+
+        timings = {}
+        with mock.patch('image_preprocessing.ImageOps.exif_transpose', side_effect=exif_transpose):
+            prepared = preprocess_image(jpeg_file(Image.new('RGB', (4000, 3000), 'white')), byte_budget=300000, timings=timings)
+        # Decoded at 1/2 scale: the smallest that still covers 1024 x 1024
+        self.assertEqual(decoded_sizes, [(2000, 1500)])
+        self.assertEqual((prepared.original_size, prepared.image.size), ((4000, 3000), (1024, 768)))
+        self.assertEqual(Image.open(io.BytesIO(prepared.data)).size, (1024, 768))
+        self.assertEqual(set(timings), {'decode', 'resize', 'encode'})
+
+    def test_exif_orientation_is_applied(self):
+        # Red on the left, blue on the right; turned clockwise, red is on top
+        image = Image.new('RGB', (400, 200), 'blue')
+        image.paste('red', (0, 0, 200, 200))
+        prepared = preprocess_image(jpeg_file(image, orientation=6))
+        self.assertEqual(prepared.image.size, (200, 400))
+        top = prepared.image.getpixel((100, 50))
+        bottom = prepared.image.getpixel((100, 350))
+        self.assertGreater(top[0], 200)
+        self.assertGreater(bottom[2], 200)
+
+    def test_other_formats_are_converted(self):
+        buffer = io.BytesIO()
+        Image.new('RGBA', (300, 100), (0, 128, 0, 128)).save(buffer, format='PNG')
+        buffer.seek(0)
+        prepared = preprocess_image(buffer)
+        self.assertEqual((prepared.image.mode, prepared.image.size, prepared.mime_type), ('RGB', (300, 100), 'image/jpeg'))
+
+    def test_output_fits_the_byte_budget(self):
+        prepared = preprocess_image(jpeg_file(noise(1600, 1200)), byte_budget=80000)
+        self.assertLessEqual(len(prepared.data), 80000)
+        self.assertLessEqual(max(prepared.image.size), 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
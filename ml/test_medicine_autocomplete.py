@@ -0,0 +1,121 @@
+# ml/test_medicine_autocomplete.py
+#
+# Typeahead: prefix lookups rank whole-name matches first, then shorter names, then
+# catalog order, and give the same completions as checking every name of the test
+# catalog (ml/fixtures/test_catalog.csv); the fuzzy fallback only runs on a miss.
+#
+#     cd ml && python -m unittest test_medicine_autocomplete
+
+import os
+import unittest
+
+from medicine_autocomplete import MAX_WORD_ENTRIES, PrefixIndex, autocomplete, compile_prefix_index, normalize_name
+from medicine_catalog import MedicineCatalog, compile_catalog, read_medicine_csv
+from medicine_matching import CandidateIndex
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'test_catalog.csv')
+
+
+def prefix_index(names):
+    return PrefixIndex(*compile_prefix_index(names), names)
+
+
+class PrefixIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = prefix_index([
+            'Dolo 650 Tablet',      # 0
+            'Dolo Tablet',          # 1
+            'Dolonex DT',           # 2
+            'Ultra Dolo',           # 3
+            'Crocin 650',           # 4
+            'Dolo-Dolo Syrup',      # 5: matches "dolo" through two entries
+            'Thyroxine 50µg Crème', # 6
+        ])
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name('  Dolo-650   Tablet '), 'dolo 650 tablet')
+        self.assertEqual(normalize_name(None), '')
+
+    def test_whole_names_first_then_shorter_names(self):
+        self.assertEqual(self.index.lookup('dolo'), [(2, 0), (1, 0), (0, 0), (5, 0), (3, 1)])
+        self.assertEqual(self.index.lookup('DOLO tab'), [(1, 0)])
+        self.assertEqual(self.index.lookup('650'), [(4, 1), (0, 1)])
+
+    def test_limit(self):
+        self.assertEqual(self.index.lookup('dolo', limit=2), [(2, 0), (1, 0)])
+        # Scanning only the first entries of the range still returns distinct names
+        matches = self.index.lookup('dolo', scan_limit=3)
+        self.assertEqual(len(matches), len({name_id for name_id, _ in matches}))
+
+    def test_non_ascii_names(self):
+        self.assertEqual(self.index.lookup('crè'), [(6, 1)])
+        self.assertEqual(self.index.lookup('50µ'), [(6, 1)])
+
+    def test_no_match(self):
+        self.assertEqual(self.index.lookup('dolp'), [])
+        self.assertEqual(self.index.lookup(' - '), [])
+
+
+class PrefixIndexCatalogTest(unittest.TestCase):
+    """The same completions as checking every word suffix of every name in the test catalog."""
+
+    @classmethod
+    def setUpClass(cls):
+        catalog = MedicineCatalog(compile_catalog(read_medicine_csv(CATALOG_PATH), with_match_indexes=False), 'test', 'csv')
+        cls.index = catalog.prefix_index
+        cls.names = catalog.medicine_names
+
+    def scan(self, query, limit):
+        prefix = normalize_name(query)
+        found = []
+        for name_id, name in enumerate(self.names):
+            words = normalize_name(name).split()
+            kinds = [
+                min(position, 1) for position in range(min(len(words), MAX_WORD_ENTRIES + 1))
+                if ' '.join(words[position:]).startswith(prefix)
+            ]
+            if kinds:
+                found.append((min(kinds), len(name), name_id))
+        return [(name_id, kind) for kind, _, name_id in sorted(found)[:limit]]
+
+    def test_against_brute_force(self):
+        queries = {'a', 'tab', '650 t', 'zz'}
+        for name in self.names:
+            words = normalize_name(name).split()
+            queries.update(word[:length] for word in words for length in (1, 3))
+            queries.add(' '.join(words[:2]))
+        for query in sorted(queries):
+            for limit in (1, 10):
+                with self.subTest(query=query, limit=limit):
+                    self.assertEqual(self.index.lookup(query, limit), self.scan(query, limit))
+
+
+class AutocompleteTest(unittest.TestCase):
+    def setUp(self):
+        self.names = ['Dolo 650 Tablet', 'Dolo Tablet', 'Crocin 650', 'Calpol 500 Syrup']
+        self.index = prefix_index(self.names)
+
+    def test_prefix_match_skips_fuzzy(self):
+        self.assertEqual(autocomplete(self.index, 'dolo 6'), ('prefix', [(0, 'prefix')]))
+        self.assertEqual(autocomplete(self.index, '650'), ('prefix', [(2, 'word'), (0, 'word')]))
+
+    def test_fuzzy_fallback_on_a_typo(self):
+        source, matches = autocomplete(self.index, 'Crosin 650')
+        self.assertEqual(source, 'fuzzy')
+        self.assertEqual(matches[0], (2, 'fuzzy'))
+        self.assertEqual(autocomplete(self.index, 'Crosin 650', fuzzy=False), ('prefix', []))
+
+    def test_fuzzy_fallback_through_the_candidate_index(self):
+        candidate_index = CandidateIndex(self.names)
+        for query in ('Crosin 650', 'Dolo Tabelt', 'Calpool'):
+            with self.subTest(query=query):
+                self.assertEqual(autocomplete(self.index, query, candidate_index=candidate_index), autocomplete(self.index, query))
+        # No trigram in common with any name
+        self.assertEqual(autocomplete(self.index, 'xqj', candidate_index=candidate_index), ('fuzzy', []))
+
+    def test_fuzzy_score_cutoff(self):
+        self.assertEqual(autocomplete(self.index, 'Warfarin'), ('fuzzy', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
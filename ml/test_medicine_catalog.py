@@ -0,0 +1,120 @@
+# ml/test_medicine_catalog.py
+#
+# Catalog snapshots: which folder belongs to which CSV, stale detection, and a stale
+# snapshot rebuilt once for all the processes loading it.
+#
+#     cd ml && python -m unittest test_medicine_catalog
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import medicine_catalog
+from medicine_catalog import (
+    SNAPSHOT_DIR, build_snapshot, catalog_changed, load_catalog, read_snapshot_meta,
+    snapshot_dir_for, snapshot_is_fresh,
+)
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'test_catalog.csv')
+
+
+def add_row(csv_path):
+    """Append a copy of the CSV's last row under a new name."""
+    with open(csv_path, encoding='utf-8') as f:
+        last = f.read().rstrip('\n').rsplit('\n', 1)[1]
+    with open(csv_path, 'a', encoding='utf-8') as f:
+        f.write('9999,Zz Test' + last[last.index(',', last.index(',') + 1):] + '\n')
+
+
+def load_with_rebuild(csv_path, results):
+    results.put((load_catalog(csv_path, rebuild=True).source))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.csv_path = os.path.join(self.tmp_dir, 'catalog.csv')
+        shutil.copy(CATALOG_PATH, self.csv_path)
+
+    def test_snapshot_dir_for(self):
+        self.assertEqual(snapshot_dir_for(medicine_catalog.DB_PATH), SNAPSHOT_DIR)
+        self.assertEqual(snapshot_dir_for(self.csv_path), os.path.join(self.tmp_dir, 'catalog.snapshot'))
+
+    def test_fresh_snapshot_is_mapped(self):
+        from_csv = load_catalog(self.csv_path)
+        self.assertEqual(from_csv.source, 'csv')
+        build_snapshot(self.csv_path)
+        catalog = load_catalog(self.csv_path)
+        self.assertEqual((catalog.source, catalog.version, len(catalog)), ('snapshot', from_csv.version, len(from_csv)))
+
+    def test_touched_csv_stays_fresh(self):
+        build_snapshot(self.csv_path)
+        os.utime(self.csv_path, ns=(0, 0))
+        self.assertEqual(snapshot_is_fresh(read_snapshot_meta(snapshot_dir_for(self.csv_path)), self.csv_path), (True, 'fresh'))
+
+    def test_changed_csv_is_stale(self):
+        build_snapshot(self.csv_path)
+        rows = len(load_catalog(self.csv_path))
+        add_row(self.csv_path)
+        meta = read_snapshot_meta(snapshot_dir_for(self.csv_path))
+        self.assertEqual(snapshot_is_fresh(meta, self.csv_path), (False, 'csv size changed'))
+        catalog = load_catalog(self.csv_path)
+        self.assertEqual((catalog.source, len(catalog)), ('csv', rows + 1))
+        # With rebuild, the snapshot is rebuilt and mapped
+        catalog = load_catalog(self.csv_path, rebuild=True)
+        self.assertEqual((catalog.source, len(catalog)), ('snapshot', rows + 1))
+
+    def test_snapshot_of_another_csv_is_stale(self):
+        build_snapshot(self.csv_path)
+        other_path = os.path.join(self.tmp_dir, 'other.csv')
+        shutil.copy(CATALOG_PATH, other_path)
+        fresh, reason = snapshot_is_fresh(read_snapshot_meta(snapshot_dir_for(self.csv_path)), other_path)
+        self.assertFalse(fresh, reason)
+        self.assertEqual(load_catalog(other_path, snapshot_dir=snapshot_dir_for(self.csv_path)).source, 'csv')
+
+    def test_missing_csv(self):
+        build_snapshot(self.csv_path)
+        os.remove(self.csv_path)
+        # Only the default catalog may ship as a snapshot alone
+        with self.assertRaises(FileNotFoundError):
+            load_catalog(self.csv_path)
+        with mock.patch.multiple(medicine_catalog, DB_PATH=self.csv_path, SNAPSHOT_DIR=snapshot_dir_for(self.csv_path)):
+            self.assertEqual(load_catalog(self.csv_path).source, 'snapshot')
+
+    def test_catalog_changed(self):
+        catalog = load_catalog(self.csv_path)
+        self.assertEqual(catalog_changed(catalog, self.csv_path), (False, 'unchanged'))
+        add_row(self.csv_path)
+        # Settled: modified long enough ago
+        os.utime(self.csv_path, ns=(0, 0))
+        self.assertEqual(catalog_changed(catalog, self.csv_path), (True, 'csv content changed'))
+
+    @unittest.skipIf(medicine_catalog.fcntl is None, 'needs file locks')
+    def test_stale_snapshot_is_rebuilt_once(self):
+        build_snapshot(self.csv_path)
+        add_row(self.csv_path)
+        context = multiprocessing.get_context('fork')
+        builds = context.Value('i', 0)
+
+        def counting_build(*args, **kwargs):
+            with builds.get_lock():
+                builds.value += 1
+            return build_snapshot(*args, **kwargs)
+
+        results = context.Queue()
+        with mock.patch.object(medicine_catalog, 'build_snapshot', counting_build):
+            processes = [context.Process(target=load_with_rebuild, args=(self.csv_path, results)) for _ in range(4)]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join(60)
+        self.assertEqual([results.get(timeout=5) for _ in processes], ['snapshot'] * 4)
+        self.assertEqual(builds.value, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# ml/test_medicine_ingredients.py
+#
+# Ingredient search and generic-substitute groups: posting intersection, grouping by
+# (salt, strength) set, price order within a group, and cheaper_count, checked by hand
+# and against a brute force over the test catalog (ml/fixtures/test_catalog.csv).
+#
+#     cd ml && python -m unittest test_medicine_ingredients
+
+import itertools
+import math
+import os
+import random
+import unittest
+
+import numpy as np
+
+from medicine_catalog import MedicineCatalog, compile_catalog, read_medicine_csv
+from medicine_ingredients import SubstituteGroups, compile_substitute_groups, parse_ingredients
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'test_catalog.csv')
+
+NAN = float('nan')
+
+
+def substitute_groups(rows):
+    """SubstituteGroups over (short_composition1, short_composition2, price) rows."""
+    compositions = [[row[0] for row in rows], [row[1] for row in rows]]
+    prices = np.array([row[2] for row in rows], dtype=np.float64)
+    return SubstituteGroups(*compile_substitute_groups(compositions, prices))
+
+
+class ParseIngredientsTest(unittest.TestCase):
+    def test_composition(self):
+        self.assertEqual(
+            parse_ingredients('Amoxycillin (500mg) + Clavulanic Acid (125 mg)'),
+            [('amoxycillin', '500mg'), ('clavulanic acid', '125mg')],
+        )
+
+    def test_strength_forms(self):
+        self.assertEqual(parse_ingredients('Paracetamol 500.0 mg'), [('paracetamol', '500mg')])
+        self.assertEqual(parse_ingredients('Thyroxine (50µg)'), [('thyroxine', '50mcg')])
+        self.assertEqual(parse_ingredients('Vitamin B Complex (NA)'), [('vitamin b complex', None)])
+
+
+class IngredientIndexCatalogTest(unittest.TestCase):
+    """search() gives the rows a scan of every row's ingredients would."""
+
+    @classmethod
+    def setUpClass(cls):
+        medicine_db = read_medicine_csv(CATALOG_PATH)
+        cls.index = MedicineCatalog(compile_catalog(medicine_db, with_match_indexes=False), 'test', 'csv').ingredient_index
+        cls.ingredients = [
+            set(parse_ingredients(c1)) | set(parse_ingredients(c2))
+            for c1, c2 in zip(medicine_db['short_composition1'], medicine_db['short_composition2'])
+        ]
+
+    def scan(self, query):
+        """Rows with every (salt, strength) of the query; a None strength matches any."""
+        return [
+            row for row, ingredients in enumerate(self.ingredients)
+            if all(any(salt == found_salt and strength in (None, found_strength) for found_salt, found_strength in ingredients)
+                   for salt, strength in query)
+        ]
+
+    def test_against_brute_force(self):
+        known = sorted(set().union(*self.ingredients), key=str)
+        salts = sorted({salt for salt, _ in known})
+        queries = [[ingredient] for ingredient in known] + [[(salt, None)] for salt in salts]
+        # Every row's own composition, with and without strengths
+        queries += [sorted(ingredients, key=str) for ingredients in self.ingredients if ingredients]
+        queries += [[(salt, None) for salt, _ in sorted(ingredients, key=str)] for ingredients in self.ingredients if ingredients]
+        # Pairs that mostly share no row, and a salt the catalog doesn't have
+        rng = random.Random(0)
+        queries += [rng.sample(known, 2) for _ in range(200)]
+        queries += [[known[0], ('unobtainium', None)], [('unobtainium', '5mg')]]
+        for query in queries:
+            with self.subTest(query=query):
+                rows = self.index.search(query)
+                self.assertEqual(rows.tolist(), self.scan(query))
+
+    def test_query_order_does_not_matter(self):
+        query = [('amoxycillin', '500mg'), ('clavulanic acid', '125mg')]
+        rows = self.index.search(query).tolist()
+        self.assertTrue(rows)
+        for permutation in itertools.permutations(query):
+            self.assertEqual(self.index.search(list(permutation)).tolist(), rows)
+
+    def test_strength_narrows_the_salt(self):
+        any_strength = set(self.index.search([('paracetamol', None)]).tolist())
+        strengths = [set(self.index.search([('paracetamol', strength)]).tolist()) for strength in ('325mg', '500mg', '650mg')]
+        self.assertTrue(all(rows and rows < any_strength for rows in strengths))
+
+    def test_empty_query(self):
+        self.assertEqual(len(self.index.search([])), 0)
+
+
+class SubstituteGroupsTest(unittest.TestCase):
+    def setUp(self):
+        self.groups = substitute_groups([
+            ('Paracetamol (500mg)', '', 30.0),                       # 0
+            ('Paracetamol (500mg)', '', 10.0),                       # 1
+            ('Paracetamol (650mg)', '', 5.0),                        # 2: another strength
+            ('Paracetamol (500mg)', '', 20.0),                       # 3
+            ('Paracetamol (500mg)', '', 20.0),                       # 4: same price as 3
+            ('Paracetamol (500mg)', '', NAN),                        # 5: unknown price
+            ('Ibuprofen (400mg)', 'Paracetamol (325mg)', 15.0),      # 6
+            ('Paracetamol (325mg)', 'Ibuprofen (400mg)', 12.0),      # 7: same salts, other column order
+            ('Vitamin B Complex (NA)', '', 8.0),                     # 8: no strength
+            ('', '', 1.0),                                           # 9: no ingredients
+        ])
+
+    def test_group_is_sorted_by_price_with_unknown_prices_last(self):
+        self.assertEqual(self.groups.group(0).tolist(), [1, 3, 4, 0, 5])
+        self.assertEqual(self.groups.group(6).tolist(), [7, 6])
+        self.assertEqual(self.groups.group(2).tolist(), [2])
+
+    def test_rows_without_strengths_are_not_grouped(self):
+        self.assertEqual(len(self.groups.group(8)), 0)
+        self.assertEqual(len(self.groups.group(9)), 0)
+        self.assertEqual(len(self.groups.cheaper(8, 5)), 0)
+
+    def test_cheaper_count_is_strictly_cheaper(self):
+        self.assertEqual(self.groups.cheaper_count[[0, 1, 3, 4, 5, 6, 7]].tolist(), [3, 0, 1, 1, 0, 1, 0])
+
+    def test_cheaper(self):
+        self.assertEqual(self.groups.cheaper(0, 10).tolist(), [1, 3, 4])
+        self.assertEqual(self.groups.cheaper(0, 2).tolist(), [1, 3])
+        # A same-price row is not cheaper
+        self.assertEqual(self.groups.cheaper(4, 10).tolist(), [1])
+        self.assertEqual(self.groups.cheaper(1, 10).tolist(), [])
+
+    def test_alternatives_exclude_the_row_itself(self):
+        self.assertEqual(self.groups.alternatives(3, 10).tolist(), [1, 4, 0, 5])
+        self.assertEqual(self.groups.alternatives(1, 2).tolist(), [3, 4])
+
+
+class SubstituteGroupsCatalogTest(unittest.TestCase):
+    """The same answers as grouping the test catalog row by row."""
+
+    @classmethod
+    def setUpClass(cls):
+        medicine_db = read_medicine_csv(CATALOG_PATH)
+        rows = list(zip(medicine_db['short_composition1'], medicine_db['short_composition2'],
+                        np.asarray(medicine_db['price(₹)'], dtype=np.float64)))
+        cls.rows = rows
+        cls.groups = substitute_groups(rows)
+        cls.ingredients = [set(parse_ingredients(c1)) | set(parse_ingredients(c2)) for c1, c2, _ in rows]
+
+    def substitutes_of(self, row):
+        ingredients = self.ingredients[row]
+        if not ingredients or any(strength is None for _, strength in ingredients):
+            return []
+        return [other for other, found in enumerate(self.ingredients) if found == ingredients]
+
+    def test_against_brute_force(self):
+        for row, (_, _, price) in enumerate(self.rows):
+            with self.subTest(row=row):
+                members = self.substitutes_of(row)
+                self.assertEqual(sorted(self.groups.group(row).tolist()), members)
+                cheaper = [other for other in members if self.rows[other][2] < price]
+                self.assertEqual(int(self.groups.cheaper_count[row]), 0 if math.isnan(price) else len(cheaper))
+                prices = [self.rows[other][2] for other in self.groups.cheaper(row, len(members))]
+                self.assertEqual(prices, sorted(self.rows[other][2] for other in cheaper))
+
+
+if __name__ == '__main__':
+    unittest.main()
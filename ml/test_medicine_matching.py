@@ -0,0 +1,133 @@
+# ml/test_medicine_matching.py
+#
+# The candidate index must never change a match: on a fixed catalog and query corpus
+# (ml/fixtures), and on seeded random perturbations of the catalog scored through an
+# index narrow enough to truncate its candidate sets, every matcher has to return the
+# same best match and score as a full thefuzz process.extractOne scan.
+#
+#     cd ml && python -m unittest test_medicine_matching
+
+import os
+import random
+import unittest
+
+from rapidfuzz import fuzz as rf_fuzz
+from thefuzz import fuzz, process, utils
+
+from medicine_catalog import load_catalog
+from medicine_matching import CandidateIndex, FuzzyMatcher, RapidFuzzMatcher, scorer_text
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CATALOG_PATH = os.path.join(FIXTURES_DIR, 'test_catalog.csv')
+QUERIES_PATH = os.path.join(FIXTURES_DIR, 'matching_queries.txt')
+
+
+def load_queries(path=QUERIES_PATH):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def misspell(choice, rng):
+    """`choice` after one to three random typos, deleted or inserted characters, dropped or swapped tokens."""
+    words = choice.split()
+    for _ in range(rng.randint(1, 3)):
+        i = rng.randrange(len(words))
+        word = words[i]
+        j = rng.randrange(len(word) + 1)
+        edit = rng.choice(['typo', 'delete', 'insert', 'drop', 'swap'])
+        if edit == 'typo' and j < len(word):
+            words[i] = word[:j] + rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') + word[j + 1:]
+        elif edit == 'delete' and len(word) > 1 and j < len(word):
+            words[i] = word[:j] + word[j + 1:]
+        elif edit == 'insert':
+            words[i] = word[:j] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[j:]
+        elif edit == 'drop' and len(words) > 1:
+            words.pop(i)
+        elif edit == 'swap':
+            k = rng.randrange(len(words))
+            words[i], words[k] = words[k], words[i]
+    return ' '.join(words)
+
+
+class CandidateIndexEquivalenceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # No snapshot folder: the catalog is compiled from the CSV
+        catalog = load_catalog(CATALOG_PATH, snapshot_dir=os.path.join(FIXTURES_DIR, 'no_snapshot'))
+        cls.columns = {'name': catalog.medicine_names, 'composition': catalog.medicine_compositions}
+        cls.queries = load_queries()
+
+    def assert_matches_full_scan(self, choices, matcher):
+        for query in self.queries:
+            with self.subTest(query=query):
+                expected = process.extractOne(query, choices, scorer=fuzz.token_set_ratio)
+                self.assertEqual(tuple(matcher.best_match(query)), tuple(expected))
+
+    def test_indexed_matcher(self):
+        # The test catalog is smaller than CANDIDATE_LIMIT: this covers the default
+        # configuration, the narrow index below covers truncated candidate sets
+        for column, choices in self.columns.items():
+            with self.subTest(column=column):
+                self.assert_matches_full_scan(choices, FuzzyMatcher(choices))
+
+    def test_narrow_index(self):
+        # Limits far below the catalog size, so candidates really are a small subset of it
+        for column, choices in self.columns.items():
+            with self.subTest(column=column):
+                index = CandidateIndex(choices, candidate_limit=10, max_token_df=5)
+                matcher = FuzzyMatcher(choices, index=index)
+                self.assert_matches_full_scan(choices, matcher)
+                self.assertGreater(matcher.stats['index_matches'], 0)
+
+    def test_narrow_index_on_random_perturbations(self):
+        rng = random.Random(0)
+        for column, choices in self.columns.items():
+            index = CandidateIndex(choices, candidate_limit=10, max_token_df=5)
+            matcher = FuzzyMatcher(choices, index=index)
+            mismatches = []
+            for _ in range(2000):
+                query = misspell(rng.choice(choices), rng)
+                expected = process.extractOne(query, choices, scorer=fuzz.token_set_ratio)
+                if tuple(matcher.best_match(query)) != tuple(expected):
+                    mismatches.append((query, matcher.best_match(query), expected))
+            with self.subTest(column=column):
+                self.assertEqual(mismatches, [])
+                self.assertGreater(matcher.stats['index_matches'], 1000)
+
+    def test_score_bounds(self):
+        # No choice may score above its bound, or the index could miss the best match
+        rng = random.Random(1)
+        choices = self.columns['name'] + ['', 'Thyroxine (50µg) Tablet', 'Vitamin_B12 Forte-SR', 'tablet tablet']
+        index = CandidateIndex(choices)
+        processed = [utils.full_process(choice, force_ascii=True) for choice in choices]
+        for _ in range(200):
+            query = misspell(rng.choice(choices[:-4]), rng)
+            scores = [rf_fuzz.token_set_ratio(scorer_text(query), choice, processor=None) for choice in processed]
+            for choice, score, bound in zip(choices, scores, index.score_bounds(query)):
+                if score > bound:
+                    self.fail(f'{query!r} scores {score} against {choice!r}, above its bound {bound}')
+
+    def test_index_from_arrays(self):
+        # The snapshot stores the index as arrays; a rebuilt one must match the same way
+        choices = self.columns['name']
+        index = CandidateIndex.from_arrays(len(choices), {
+            name: StringList(value) if isinstance(value, list) else value
+            for name, value in CandidateIndex(choices).to_arrays().items()
+        })
+        self.assert_matches_full_scan(choices, FuzzyMatcher(choices, index=index))
+
+    def test_rapidfuzz_backend(self):
+        for column, choices in self.columns.items():
+            with self.subTest(column=column):
+                self.assert_matches_full_scan(choices, RapidFuzzMatcher(choices))
+
+
+class StringList(list):
+    """A vocabulary as StringTable hands it over: anything with tolist()."""
+
+    def tolist(self):
+        return list(self)
+
+
+if __name__ == '__main__':
+    unittest.main()
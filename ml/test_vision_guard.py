@@ -0,0 +1,150 @@
+# ml/test_vision_guard.py
+#
+# Circuit-breaker transitions, and the deadline and hedging of VisionGuard around a
+# fake extractor whose calls take scripted times.
+#
+#     cd ml && python -m unittest test_vision_guard
+
+import itertools
+import threading
+import time
+import unittest
+
+from vision_guard import CircuitBreaker, CircuitOpenError, DeadlineExceededError, VisionGuard
+
+
+class FakeExtractor:
+    """request() sleeps for the next scripted delay, then answers or raises the scripted error."""
+
+    def __init__(self, *steps):
+        self.steps = itertools.chain(steps, itertools.repeat(steps[-1]))
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def request(self, prepared, timeout=None):
+        with self._lock:
+            self.calls += 1
+            call, (delay, error) = self.calls, next(self.steps)
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return f'response {call}'
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_the_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_one_trial_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one trial at a time
+        self.assertFalse(breaker.allow())
+
+    def test_successful_trial_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.05)
+        for _ in range(3):
+            breaker.record_failure()
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        # One failure in half-open is enough, whatever the threshold
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+
+class VisionGuardTest(unittest.TestCase):
+    def test_returns_the_response(self):
+        guard = VisionGuard(deadline=1)
+        self.assertEqual(guard.call(FakeExtractor((0, None)).request, None), 'response 1')
+        self.assertEqual(guard.stats()['outcomes']['success'], 1)
+
+    def test_deadline_releases_the_caller(self):
+        guard = VisionGuard(deadline=0.1)
+        start_time = time.monotonic()
+        with self.assertRaises(DeadlineExceededError):
+            guard.call(FakeExtractor((1, None)).request, None)
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        self.assertEqual(guard.stats()['outcomes']['timeout'], 1)
+        self.assertEqual(guard.breaker.consecutive_failures, 1)
+
+    def test_errors_are_raised(self):
+        guard = VisionGuard(deadline=1)
+        with self.assertRaises(ValueError):
+            guard.call(FakeExtractor((0, ValueError('bad response'))).request, None)
+        self.assertEqual(guard.stats()['outcomes']['error'], 1)
+
+    def test_open_circuit_fails_fast(self):
+        guard = VisionGuard(deadline=1, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        extractor = FakeExtractor((0, ValueError('down')))
+        with self.assertRaises(ValueError):
+            guard.call(extractor.request, None)
+        with self.assertRaises(CircuitOpenError):
+            guard.call(extractor.request, None)
+        self.assertEqual(extractor.calls, 1)
+        self.assertEqual(guard.stats()['outcomes']['circuit_open'], 1)
+
+    def test_no_hedge_without_enough_samples(self):
+        guard = VisionGuard(deadline=1, hedge_percentile=0.5, hedge_min_samples=5)
+        extractor = FakeExtractor((0.1, None))
+        guard.call(extractor.request, None)
+        self.assertEqual(extractor.calls, 1)
+
+    def test_slow_call_is_hedged(self):
+        guard = VisionGuard(deadline=2, hedge_percentile=0.5, hedge_min_samples=1)
+        guard.call(FakeExtractor((0.01, None)).request, None)
+        # The first attempt hangs; the hedge starts after about the p50 latency and answers first
+        extractor = FakeExtractor((1, None), (0.01, None))
+        start_time = time.monotonic()
+        self.assertEqual(guard.call(extractor.request, None), 'response 2')
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        outcomes = guard.stats()['outcomes']
+        self.assertEqual((outcomes['hedged'], outcomes['hedge_won']), (1, 1))
+
+    def test_failed_call_is_retried_by_the_hedge(self):
+        guard = VisionGuard(deadline=2, hedge_percentile=0.5, hedge_min_samples=1)
+        guard.call(FakeExtractor((0.5, None)).request, None)
+        # The first attempt fails long before the hedge delay: the hedge starts at once
+        extractor = FakeExtractor((0, ValueError('flaky')), (0, None))
+        start_time = time.monotonic()
+        self.assertEqual(guard.call(extractor.request, None), 'response 2')
+        self.assertLess(time.monotonic() - start_time, 0.3)
+
+    def test_hedge_shares_the_deadline(self):
+        guard = VisionGuard(deadline=0.2, hedge_percentile=0.5, hedge_min_samples=1)
+        guard.call(FakeExtractor((0.01, None)).request, None)
+        extractor = FakeExtractor((1, None))
+        with self.assertRaises(DeadlineExceededError):
+            guard.call(extractor.request, None)
+        self.assertEqual(extractor.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+# ml/vision_extractors.py
+#
+# Vision-extractor backends: turn a preprocessed medicine photo into the
+# {"brand_name", "composition", "manufacturer"} fields that catalog matching needs.
+#
+#   gemini    - the production backend (Gemini model + prompt)
+#   stand_in  - a local, deterministic backend that answers from a fixture file with
+#               canned responses for the images in ml/Medicine_data, after an optional
+#               injected latency. Lets the matching and web layers be exercised,
+#               benchmarked and load-tested without network access or API cost.
+#
+# The backend is picked with MEDICINE_VISION_BACKEND. Fixtures are (re)built with:
+#     python ml/vision_extractors.py fixture record      # real Gemini responses
+#     python ml/vision_extractors.py fixture synthetic   # canned responses, no API key needed
+
+import json
+import os
+import random
+import sys
+import time
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+from image_preprocessing import dhash_image, preprocess_image
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENV_PATH = os.path.join(BASE_DIR, 'backend', '.env') # Assuming .env is in the backend folder
+IMAGES_DIR = os.path.join(BASE_DIR, 'ml', 'Medicine_data', 'Medicine_data')
+FIXTURE_PATH = os.path.join(BASE_DIR, 'ml', 'fixtures', 'vision_stand_in.json')
+
+GEMINI_MODEL_NAME = os.getenv('MEDICINE_GEMINI_MODEL', 'gemini-2.5-flash-lite-preview-06-17')
+PROMPT = """You are an expert pharmacy assistant. Analyze the image of the medicine packaging. Extract the following information and return it as a clean JSON object: "brand_name", "composition", "manufacturer". If a field is not visible, return "N/A". Do not include any text outside the JSON."""
+
+# Stand-in images whose fingerprint is this close to a fixture entry get its response
+STAND_IN_MAX_DISTANCE = 6
+NOT_VISIBLE = {"brand_name": "N/A", "composition": "N/A", "manufacturer": "N/A"}
+
+
+class VisionExtractor:
+    """
+    Base class for extractor backends. `request` makes the (slow, fallible) model
+    call and returns its raw text; `parse` turns that text into the fields dict.
+    """
+
+    name = None
+
+    def load(self):
+        pass
+
+    def request(self, prepared, timeout=None):
+        raise NotImplementedError
+
+    def parse(self, text):
+        clean_json_str = text.strip().replace('```json', '').replace('```', '')
+        return json.loads(clean_json_str)
+
+    def describe(self):
+        return {'backend': self.name}
+
+
+def configure_model(model_name=GEMINI_MODEL_NAME):
+    load_dotenv(dotenv_path=ENV_PATH)
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY not found in .env file.")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+class GeminiExtractor(VisionExtractor):
+    name = 'gemini'
+
+    def __init__(self, model_name=GEMINI_MODEL_NAME, prompt=PROMPT):
+        self.model_name = model_name
+        self.prompt = prompt
+        self.model = None
+
+    def load(self):
+        self.model = configure_model(self.model_name)
+
+    def request(self, prepared, timeout=None):
+        request_options = {'timeout': timeout} if timeout else None
+        response = self.model.generate_content([self.prompt, prepared.as_part()], request_options=request_options)
+        return response.text
+
+    def describe(self):
+        return {'backend': self.name, 'model': self.model_name}
+
+
+class StandInExtractor(VisionExtractor):
+    """Answers from a fixture of canned responses keyed by image fingerprint (dHash)."""
+
+    name = 'stand_in'
+
+    def __init__(self, fixture_path=FIXTURE_PATH, latency_ms=0, jitter_ms=0):
+        self.fixture_path = fixture_path
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.responses = {}
+        self.synthetic = None
+
+    def load(self):
+        with open(self.fixture_path) as f:
+            fixture = json.load(f)
+        self.synthetic = fixture.get('synthetic', False)
+        self.responses = {int(key, 16): entry['response'] for key, entry in fixture['images'].items()}
+
+    def lookup(self, fingerprint):
+        response = self.responses.get(fingerprint)
+        if response is not None:
+            return response
+        distance, response = min(
+            (((fingerprint ^ key).bit_count(), value) for key, value in self.responses.items()),
+            default=(None, None),
+            key=lambda item: item[0],
+        )
+        if distance is not None and distance <= STAND_IN_MAX_DISTANCE:
+            return response
+        return NOT_VISIBLE
+
+    def request(self, prepared, timeout=None):
+        fingerprint = dhash_image(prepared.image)
+        latency_ms = self.latency_ms
+        if self.jitter_ms:
+            # Deterministic per image, so repeated runs see the same latency profile
+            latency_ms += random.Random(fingerprint).uniform(0, self.jitter_ms)
+        if latency_ms:
+            time.sleep(latency_ms / 1000)
+        return json.dumps(self.lookup(fingerprint))
+
+    def describe(self):
+        return {
+            'backend': self.name,
+            'fixture': os.path.basename(self.fixture_path),
+            'synthetic': self.synthetic,
+            'images': len(self.responses),
+            'latency_ms': self.latency_ms,
+            'jitter_ms': self.jitter_ms,
+        }
+
+
+EXTRACTORS = {
+    GeminiExtractor.name: GeminiExtractor,
+    StandInExtractor.name: StandInExtractor,
+}
+
+
+def make_extractor(backend='gemini', **options):
+    if backend not in EXTRACTORS:
+        raise ValueError(f"Unknown vision backend '{backend}', expected one of {sorted(EXTRACTORS)}")
+    return EXTRACTORS[backend](**options)
+
+
+def make_extractor_from_env():
+    backend = os.getenv('MEDICINE_VISION_BACKEND', 'gemini')
+    if backend == StandInExtractor.name:
+        return StandInExtractor(
+            fixture_path=os.getenv('MEDICINE_STAND_IN_FIXTURE', FIXTURE_PATH),
+            latency_ms=float(os.getenv('MEDICINE_STAND_IN_LATENCY_MS', '0')),
+            jitter_ms=float(os.getenv('MEDICINE_STAND_IN_JITTER_MS', '0')),
+        )
+    return make_extractor(backend)
+
+
+# Canned responses for synthetic fixtures. They are common Indian medicines, not what the
+# photos actually show; the variants mimic how a vision model phrases and misses fields.
+SYNTHETIC_RESPONSES = [
+    ("Dolo 650 Tablet", "Paracetamol (650mg)", "Micro Labs Ltd"),
+    ("Crocin Advance Tablet", "Paracetamol (500mg)", "GlaxoSmithKline Pharmaceuticals Ltd"),
+    ("Azithral 500 Tablet", "Azithromycin (500mg)", "Alembic Pharmaceuticals Ltd"),
+    ("Augmentin 625 Duo Tablet", "Amoxycillin (500mg) + Clavulanic Acid (125mg)", "GlaxoSmithKline Pharmaceuticals Ltd"),
+    ("Pan 40 Tablet", "Pantoprazole (40mg)", "Alkem Laboratories Ltd"),
+    ("Allegra 120mg Tablet", "Fexofenadine (120mg)", "Sanofi India Ltd"),
+    ("Combiflam Tablet", "Ibuprofen (400mg) + Paracetamol (325mg)", "Sanofi India Ltd"),
+    ("Glycomet 500 Tablet", "Metformin (500mg)", "USV Ltd"),
+    ("Telma 40 Tablet", "Telmisartan (40mg)", "Glenmark Pharmaceuticals Ltd"),
+    ("Montair LC Tablet", "Montelukast (10mg) + Levocetirizine (5mg)", "Cipla Ltd"),
+    ("Ecosprin 75 Tablet", "Aspirin (75mg)", "USV Ltd"),
+    ("Thyronorm 50mcg Tablet", "Thyroxine (50mcg)", "Abbott"),
+    ("Omez 20 Capsule", "Omeprazole (20mg)", "Dr Reddy's Laboratories Ltd"),
+    ("Zerodol-SP Tablet", "Aceclofenac (100mg) + Paracetamol (325mg) + Serratiopeptidase (15mg)", "Ipca Laboratories Ltd"),
+]
+
+
+def synthetic_response(rng):
+    brand_name, composition, manufacturer = rng.choice(SYNTHETIC_RESPONSES)
+    variant = rng.random()
+    if variant < 0.15:
+        brand_name = brand_name.upper()
+    elif variant < 0.25:
+        brand_name = "N/A"
+    elif variant < 0.35:
+        composition = "N/A"
+    elif variant < 0.45:
+        brand_name = brand_name.rsplit(' ', 1)[0]
+    return {"brand_name": brand_name, "composition": composition, "manufacturer": manufacturer}
+
+
+def build_fixture(mode, images_dir=IMAGES_DIR, fixture_path=FIXTURE_PATH):
+    extractor = None
+    if mode == 'record':
+        extractor = GeminiExtractor()
+        extractor.load()
+    rng = random.Random(0)
+
+    images = {}
+    for file_name in sorted(os.listdir(images_dir)):
+        if not file_name.lower().endswith(('.jpg', '.jpeg', '.png')):
+            continue
+        prepared = preprocess_image(os.path.join(images_dir, file_name))
+        key = f'{dhash_image(prepared.image):016x}'
+        if key in images:
+            # Duplicate photo (same fingerprint): it shares the first copy's response
+            images[key]['files'].append(file_name)
+            continue
+        if extractor is not None:
+            try:
+                response = extractor.parse(extractor.request(prepared, timeout=60))
+            except Exception as e:
+                print(f"{file_name}: {e}", file=sys.stderr)
+                response = NOT_VISIBLE
+        else:
+            response = synthetic_response(rng)
+        images[key] = {'files': [file_name], 'response': response}
+
+    fixture = {
+        'description': f"Stand-in vision responses for {os.path.relpath(images_dir, BASE_DIR)}, keyed by dHash of the preprocessed image",
+        'synthetic': mode != 'record',
+        'images': images,
+    }
+    os.makedirs(os.path.dirname(fixture_path), exist_ok=True)
+    with open(fixture_path, 'w') as f:
+        json.dump(fixture, f, indent=1, sort_keys=True)
+        f.write('\n')
+    return sum(len(entry['files']) for entry in images.values())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == 'fixture' and sys.argv[2] in ('record', 'synthetic'):
+        count = build_fixture(sys.argv[2])
+        print(json.dumps({"status": "success", "images": count, "fixture": FIXTURE_PATH}))
+    else:
+        print("Usage: python ml/vision_extractors.py fixture record|synthetic")
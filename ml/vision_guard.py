@@ -0,0 +1,169 @@
+# ml/vision_guard.py
+#
+# Deadline, hedging and circuit breaking around the vision-model call.
+#
+# The Gemini call can hang well past any useful response time, and Python cannot
+# interrupt a blocking call. VisionGuard runs each call on a small thread pool and
+# waits on it with a hard deadline, so the caller is released on time even when the
+# upstream is stuck. Optionally, when the first attempt is slower than a recent
+# latency percentile, a second (hedged) attempt is started and whichever finishes
+# first wins. A circuit breaker fails fast while the upstream keeps failing.
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. After `reset_timeout`
+    seconds one trial call is let through (half-open); its outcome closes or
+    re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class VisionGuard:
+    """Runs upstream calls with a hard deadline, optional hedging and a circuit breaker."""
+
+    def __init__(self, deadline=30.0, hedge_percentile=None, hedge_min_samples=20,
+                 max_workers=16, breaker=None):
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='vision-call')
+        self.latencies = deque(maxlen=1000)
+        self.outcomes = {'success': 0, 'error': 0, 'timeout': 0, 'circuit_open': 0, 'hedged': 0, 'hedge_won': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, outcome):
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def hedge_delay(self):
+        """Seconds to wait before starting a hedged attempt, or None when hedging is off."""
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            return percentile(self.latencies, self.hedge_percentile)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Return func(*args, **kwargs), raising DeadlineExceededError when no attempt
+        finishes within the deadline and CircuitOpenError while the circuit is open.
+        """
+        if not self.breaker.allow():
+            self._count('circuit_open')
+            raise CircuitOpenError('Vision service circuit is open')
+
+        start_time = time.monotonic()
+        deadline_at = start_time + self.deadline
+        hedge_delay = self.hedge_delay()
+        hedge_at = start_time + hedge_delay if hedge_delay is not None else None
+        primary = self.pool.submit(func, *args, **kwargs)
+        in_flight = {primary}
+        hedge = None
+        last_error = None
+
+        while in_flight:
+            now = time.monotonic()
+            if now >= deadline_at:
+                break
+            wait_until = deadline_at if hedge is not None or hedge_at is None else min(deadline_at, hedge_at)
+            done, in_flight = wait(in_flight, timeout=max(0, wait_until - now), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    latency = time.monotonic() - start_time
+                    with self._lock:
+                        self.latencies.append(latency)
+                    self.breaker.record_success()
+                    self._count('success')
+                    if future is hedge:
+                        self._count('hedge_won')
+                    return future.result()
+                last_error = future.exception()
+
+            # Start the hedge when the primary is slow, or retry at once when it failed
+            if hedge is None and hedge_at is not None and (not in_flight or time.monotonic() >= hedge_at):
+                hedge = self.pool.submit(func, *args, **kwargs)
+                in_flight.add(hedge)
+                self._count('hedged')
+
+        self.breaker.record_failure()
+        if in_flight or last_error is None:
+            self._count('timeout')
+            raise DeadlineExceededError(f'No response within {self.deadline}s')
+        self._count('error')
+        raise last_error
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self.latencies)
+            outcomes = dict(self.outcomes)
+        return {
+            'circuit': self.breaker.state,
+            'deadline_seconds': self.deadline,
+            'hedge_percentile': self.hedge_percentile,
+            'outcomes': outcomes,
+            'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        }